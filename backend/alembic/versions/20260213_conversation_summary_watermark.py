@@ -0,0 +1,50 @@
+"""add message counter and summary watermark to conversations
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2026-02-13
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "f6a7b8c9d0e1"
+down_revision: Union[str, None] = "e5f6a7b8c9d0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "conversations",
+        sa.Column("message_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("summary_message_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("summarized_until", sa.DateTime(timezone=True), nullable=True),
+    )
+
+    # 回填已有对话的消息计数
+    op.execute(
+        "UPDATE conversations c SET message_count = "
+        "(SELECT COUNT(*) FROM conversation_messages m WHERE m.conversation_id = c.id)"
+    )
+    # 已有摘要视为覆盖到当前所有消息
+    op.execute(
+        "UPDATE conversations SET summary_message_count = message_count, "
+        "summarized_until = updated_at WHERE summary IS NOT NULL"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("conversations", "summarized_until")
+    op.drop_column("conversations", "summary_message_count")
+    op.drop_column("conversations", "message_count")
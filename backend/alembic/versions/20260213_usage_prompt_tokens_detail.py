@@ -0,0 +1,30 @@
+"""add prompt_tokens_detail to ai_usage_logs
+
+Revision ID: a7b8c9d0e1f2
+Revises: f6a7b8c9d0e1
+Create Date: 2026-02-13
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "a7b8c9d0e1f2"
+down_revision: Union[str, None] = "f6a7b8c9d0e1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 每轮对话 prompt 各部分的 token 报告
+    op.add_column(
+        "ai_usage_logs",
+        sa.Column("prompt_tokens_detail", sa.JSON(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("ai_usage_logs", "prompt_tokens_detail")
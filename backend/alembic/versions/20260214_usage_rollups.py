@@ -0,0 +1,60 @@
+"""add ai_usage_rollups and rollup watermarks
+
+Revision ID: c9d0e1f2a3b4
+Revises: b8c9d0e1f2a3
+Create Date: 2026-02-14
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c9d0e1f2a3b4"
+down_revision: Union[str, None] = "b8c9d0e1f2a3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # 使用量按小时 / 天预聚合，统计接口不再扫描全部使用日志
+    op.create_table(
+        "ai_usage_rollups",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("period", sa.String(10), nullable=False),  # hour | day
+        sa.Column("bucket_start", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("model_id", sa.Uuid(), nullable=False),
+        sa.Column("user_id", sa.Uuid(), nullable=False),
+        sa.Column("status", sa.String(20), nullable=False),
+        sa.Column("requests", sa.Integer(), nullable=True, server_default="0"),
+        sa.Column("request_tokens", sa.BigInteger(), nullable=True, server_default="0"),
+        sa.Column("response_tokens", sa.BigInteger(), nullable=True, server_default="0"),
+        sa.Column("total_tokens", sa.BigInteger(), nullable=True, server_default="0"),
+        sa.Column("cached_tokens", sa.BigInteger(), nullable=True, server_default="0"),
+        sa.Column("cost", sa.Numeric(14, 4), nullable=True, server_default="0"),
+        sa.Column("latency_ms_sum", sa.BigInteger(), nullable=True, server_default="0"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "period", "bucket_start", "model_id", "user_id", "status",
+            name="uq_usage_rollups_bucket",
+        ),
+    )
+    op.create_index(
+        "idx_usage_rollups_period_bucket", "ai_usage_rollups", ["period", "bucket_start"]
+    )
+
+    op.create_table(
+        "ai_usage_rollup_watermarks",
+        sa.Column("period", sa.String(10), nullable=False),
+        sa.Column("rolled_until", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("period"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("ai_usage_rollup_watermarks")
+    op.drop_index("idx_usage_rollups_period_bucket", table_name="ai_usage_rollups")
+    op.drop_table("ai_usage_rollups")
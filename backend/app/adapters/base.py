@@ -1,29 +1,243 @@
 """LLM 适配器抽象基类"""
 
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
+import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from dataclasses import dataclass, field
-from typing import AsyncIterator
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+import httpx
+
+from app.adapters.guard import ProviderGuard, get_provider_guard
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+T = TypeVar("T")
+
+# 所有 HTTP 类适配器共享的 keep-alive 连接池（按需创建，应用关闭时释放）
+_shared_http_client: httpx.AsyncClient | None = None
+
+
+def get_shared_http_client() -> httpx.AsyncClient:
+    """获取共享的 httpx.AsyncClient，复用 TLS 连接避免每次调用重新握手"""
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=200,
+                max_keepalive_connections=50,
+                keepalive_expiry=120,
+            ),
+        )
+    return _shared_http_client
+
+
+async def close_shared_http_client() -> None:
+    """关闭共享连接池（应用 shutdown 时调用）"""
+    global _shared_http_client
+    if _shared_http_client is not None and not _shared_http_client.is_closed:
+        await _shared_http_client.aclose()
+    _shared_http_client = None
+
+
+class StreamThreadPool:
+    """同步 SDK 流式调用专用线程池
+
+    通义、Gemini、混元的每条流在整个生成期间占用一个线程。与默认线程池
+    （asyncio.to_thread：非流式调用、embedding）隔离，进行中的流不会让它们排队；
+    并发流超过 LLM_STREAM_THREADS 时新的流等待空闲线程，计入 waited。
+    """
+
+    def __init__(self, max_threads: int | None = None):
+        self.max_threads = max_threads or settings.LLM_STREAM_THREADS
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self.stats = {"active": 0, "waiting": 0, "peak": 0, "waited": 0}
+
+    def run(self, fn: Callable[[], None]) -> asyncio.Future:
+        """在池中执行 fn（须在事件循环中调用）"""
+        with self._lock:
+            if self.stats["active"] + self.stats["waiting"] >= self.max_threads:
+                self.stats["waited"] += 1
+            self.stats["waiting"] += 1
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_threads, thread_name_prefix="llm-stream")
+        return asyncio.get_running_loop().run_in_executor(self._executor, self._run, fn)
+
+    def _run(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            self.stats["waiting"] -= 1
+            self.stats["active"] += 1
+            self.stats["peak"] = max(self.stats["peak"], self.stats["active"])
+        try:
+            fn()
+        finally:
+            with self._lock:
+                self.stats["active"] -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"max_threads": self.max_threads, **self.stats}
+
+    def shutdown(self) -> None:
+        """停止接收新的流（应用 shutdown 时调用）；进行中的流由消费端关闭后自行结束"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+stream_threads = StreamThreadPool()
+
+_STREAM_END = object()
+
+
+async def iterate_in_thread(
+    produce: Callable[[], Iterator[T]], max_buffer: int = 32
+) -> AsyncIterator[T]:
+    """在线程中消费同步 SDK 的流式迭代器，逐块桥接为异步迭代器
+
+    - 每个 chunk 到达即 yield，不等整个响应结束
+    - 队列满时生产线程阻塞等待（背压）
+    - 消费端提前退出（如客户端断开）时通知线程停止并关闭上游迭代器
+    - 线程取自 stream_threads，不占用默认线程池
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffer)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        try:
+            fut = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        except RuntimeError:  # 事件循环已关闭
+            return False
+        while True:
+            try:
+                fut.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    fut.cancel()
+                    return False
+
+    def _run() -> None:
+        error: BaseException | None = None
+        iterator = None
+        try:
+            iterator = produce()
+            for chunk in iterator:
+                if stop.is_set() or not _put((chunk, None)):
+                    break
+        except BaseException as e:  # noqa: BLE001 — 转交给消费端抛出
+            error = e
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+        if not stop.is_set():
+            _put((_STREAM_END, error))
+
+    stream_threads.run(_run)
+    try:
+        while True:
+            chunk, error = await queue.get()
+            if chunk is _STREAM_END:
+                if error is not None:
+                    raise error
+                break
+            yield chunk
+    finally:
+        stop.set()
 
 
 @dataclass
 class ChatMessage:
     role: str  # "system" | "user" | "assistant"
     content: str
+    # 属于跨轮次不变的前缀（如静态 system prompt），可被厂商 prompt 缓存复用
+    cacheable: bool = False
+
+
+@dataclass
+class ToolCall:
+    """模型发起的函数调用；arguments 为 None 表示参数不是合法 JSON"""
+
+    name: str
+    arguments: dict | None
+
+    @classmethod
+    def from_json(cls, name: str, raw: str | dict | None) -> "ToolCall":
+        if isinstance(raw, dict):
+            return cls(name, raw)
+        try:
+            arguments = json.loads(raw or "{}")
+        except (TypeError, ValueError):
+            return cls(name, None)
+        return cls(name, arguments if isinstance(arguments, dict) else None)
 
 
 @dataclass
 class ChatResponse:
     content: str
-    input_tokens: int = 0
+    input_tokens: int = 0  # 含命中缓存的部分
     output_tokens: int = 0
     total_tokens: int = 0
     cost: float = 0.0
     latency_ms: int = 0
+    cached_tokens: int = 0  # 命中厂商 prompt 缓存的输入 token 数
+    tool_calls: list[ToolCall] = field(default_factory=list)
+
+
+def prefix_ordered(messages: list[ChatMessage]) -> list[ChatMessage]:
+    """把可缓存消息稳定地排在最前，保证前缀逐字节一致以命中厂商缓存"""
+    if not any(m.cacheable for m in messages):
+        return messages
+    return [m for m in messages if m.cacheable] + [m for m in messages if not m.cacheable]
+
+
+def prefix_digest(messages: list[ChatMessage]) -> str:
+    """可缓存前缀的摘要，用作上下文缓存句柄的键"""
+    h = hashlib.sha256()
+    for m in messages:
+        if m.cacheable:
+            h.update(m.role.encode())
+            h.update(b"\x00")
+            h.update(m.content.encode())
+            h.update(b"\x00")
+    return h.hexdigest()
 
 
 class BaseLLMAdapter(ABC):
-    """LLM 适配器抽象基类，所有厂商适配器必须实现此接口"""
+    """LLM 适配器抽象基类，所有厂商适配器必须实现此接口
+
+    prompt 缓存能力（类属性 PROMPT_CACHE 为厂商默认值，实例按模型 config 取 prompt_cache_mode）：
+    - "none"：厂商不支持
+    - "auto"：厂商按前缀自动缓存（OpenAI / DeepSeek），只需保证前缀稳定
+    - "explicit"：需在请求中标记缓存断点（Claude cache_control）
+    - "handle"：需先创建上下文缓存再以句柄引用（Kimi，需在模型 config 中开启 context_cache）
+
+    函数调用（SUPPORTS_TOOLS）：支持的厂商接收 OpenAI 格式的 tools 定义，
+    在各自接口格式间转换，调用结果统一放在 ChatResponse.tool_calls。
+    """
+
+    PROMPT_CACHE = "none"
+    SUPPORTS_TOOLS = False
+    # 命中缓存的输入 token 相对原价的计费比例
+    CACHED_INPUT_PRICE_RATIO = 1.0
+    # 上下文缓存句柄有效期（秒）
+    CONTEXT_CACHE_TTL = 3600
 
     def __init__(
         self,
@@ -40,17 +254,51 @@ class BaseLLMAdapter(ABC):
         self.max_tokens = self.config.get("max_tokens", 2048)
         self.top_p = self.config.get("top_p", 1.0)
         self.timeout = self.config.get("timeout", 60)
+        self.prompt_cache_mode = self.PROMPT_CACHE
+        # 可缓存前缀摘要 -> (句柄, 过期时间)
+        self._context_cache_handles: dict[str, tuple[str, float]] = {}
+
+    @property
+    def guard_key(self) -> str:
+        """上游标识：同一厂商地址的所有模型共享并发限制与熔断"""
+        return self.api_endpoint or type(self).__name__
+
+    @property
+    def guard(self) -> ProviderGuard:
+        return get_provider_guard(self.guard_key)
+
+    async def chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
+        """同步调用，返回完整响应（经上游并发限制与熔断保护）
+
+        tools 为 OpenAI 格式的函数定义；厂商不支持函数调用时忽略。
+        """
+        async with self.guard.slot():
+            if tools and self.SUPPORTS_TOOLS:
+                return await self._chat_completion(messages, tools=tools)
+            return await self._chat_completion(messages)
+
+    async def chat_completion_stream(
+        self, messages: list[ChatMessage]
+    ) -> AsyncIterator[str]:
+        """流式调用，逐 token 返回（名额占用到流结束，首 token 延迟作为拥塞信号）"""
+        async with self.guard.slot(streaming=True) as slot:
+            async with aclosing(self._chat_completion_stream(messages)) as stream:
+                async for token in stream:
+                    slot.mark_latency()
+                    yield token
 
     @abstractmethod
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
-        """同步调用，返回完整响应"""
+    async def _chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+        """厂商实现：同步调用（SUPPORTS_TOOLS 的厂商另接收 tools 关键字参数）"""
         ...
 
     @abstractmethod
-    async def chat_completion_stream(
+    def _chat_completion_stream(
         self, messages: list[ChatMessage]
     ) -> AsyncIterator[str]:
-        """流式调用，逐 token 返回"""
+        """厂商实现：流式调用"""
         ...
 
     @abstractmethod
@@ -58,6 +306,35 @@ class BaseLLMAdapter(ABC):
         """计算成本（元）"""
         ...
 
+    def cost_with_cache(self, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+        """计算成本，命中缓存的输入 token 按折扣计费"""
+        cached = min(cached_tokens, input_tokens)
+        billable_input = input_tokens - cached + cached * self.CACHED_INPUT_PRICE_RATIO
+        return self.calculate_cost(billable_input, output_tokens)
+
+    async def get_context_cache_handle(self, messages: list[ChatMessage]) -> str | None:
+        """取得可缓存前缀的上下文缓存句柄（进程内复用，过期后重建）"""
+        if self.prompt_cache_mode != "handle" or not any(m.cacheable for m in messages):
+            return None
+        key = prefix_digest(messages)
+        cached = self._context_cache_handles.get(key)
+        now = time.monotonic()
+        if cached and cached[1] > now:
+            return cached[0]
+        try:
+            handle = await self._create_context_cache([m for m in messages if m.cacheable])
+        except Exception as e:
+            logger.warning("创建上下文缓存失败 (%s): %s", self.model_name, e)
+            return None
+        if handle:
+            # 提前 60 秒视为过期，避免引用到刚失效的句柄
+            self._context_cache_handles[key] = (handle, now + self.CONTEXT_CACHE_TTL - 60)
+        return handle
+
+    async def _create_context_cache(self, prefix: list[ChatMessage]) -> str | None:
+        """创建上下文缓存，返回句柄；prompt_cache_mode="handle" 的厂商实现"""
+        return None
+
     def _measure_start(self) -> float:
         return time.monotonic()
 
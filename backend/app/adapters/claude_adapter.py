@@ -4,7 +4,14 @@ from typing import AsyncIterator
 
 from anthropic import AsyncAnthropic
 
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import (
+    BaseLLMAdapter,
+    ChatMessage,
+    ChatResponse,
+    ToolCall,
+    get_shared_http_client,
+    prefix_ordered,
+)
 
 CLAUDE_PRICING = {
     "claude-sonnet-4-5-20250929": (0.021, 0.105),
@@ -16,27 +23,43 @@ CLAUDE_PRICING = {
 }
 
 
+# 缓存写入按输入价 1.25 倍计费，读取按 0.1 倍
+CACHE_WRITE_PRICE_RATIO = 1.25
+
+
 class ClaudeAdapter(BaseLLMAdapter):
     """Anthropic Claude 适配器"""
 
+    PROMPT_CACHE = "explicit"
+    CACHED_INPUT_PRICE_RATIO = 0.1
+    SUPPORTS_TOOLS = True
+
     def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
         super().__init__(api_key, model_name, api_endpoint, config)
-        kwargs = {"api_key": api_key, "timeout": self.timeout}
+        kwargs = {
+            "api_key": api_key,
+            "timeout": self.timeout,
+            "http_client": get_shared_http_client(),
+        }
         if api_endpoint:
             kwargs["base_url"] = api_endpoint
         self.client = AsyncAnthropic(**kwargs)
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
-        start = self._measure_start()
-
-        # Claude 的 system 消息需要单独传
-        system_msg = None
+    def _build_request(self, messages: list[ChatMessage], tools: list[dict] | None = None) -> dict:
+        """组装请求：所有 system 消息按顺序合并为 system 块，
+        最后一个可缓存块打上 cache_control 断点，其前缀跨轮次复用"""
+        system_blocks = []
+        last_cacheable = None
         chat_msgs = []
-        for m in messages:
+        for m in prefix_ordered(messages):
             if m.role == "system":
-                system_msg = m.content
+                if m.cacheable:
+                    last_cacheable = len(system_blocks)
+                system_blocks.append({"type": "text", "text": m.content})
             else:
                 chat_msgs.append({"role": m.role, "content": m.content})
+        if last_cacheable is not None:
+            system_blocks[last_cacheable]["cache_control"] = {"type": "ephemeral"}
 
         kwargs = {
             "model": self.model_name,
@@ -45,46 +68,58 @@ class ClaudeAdapter(BaseLLMAdapter):
             "temperature": self.temperature,
             "top_p": self.top_p,
         }
-        if system_msg:
-            kwargs["system"] = system_msg
+        if system_blocks:
+            kwargs["system"] = system_blocks
+        if tools:
+            # OpenAI 格式 -> Claude tools（input_schema 即 JSON Schema）
+            kwargs["tools"] = [
+                {
+                    "name": t["function"]["name"],
+                    "description": t["function"].get("description", ""),
+                    "input_schema": t["function"]["parameters"],
+                }
+                for t in tools
+            ]
+        return kwargs
+
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
+        start = self._measure_start()
 
-        response = await self.client.messages.create(**kwargs)
+        response = await self.client.messages.create(**self._build_request(messages, tools))
         latency = self._measure_latency(start)
 
-        content = response.content[0].text if response.content else ""
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
-
+        # 调用工具时回复由 text 块与 tool_use 块组成
+        content = "".join(b.text for b in response.content if b.type == "text")
+        usage = response.usage
+        # input_tokens 仅为未命中缓存的部分，缓存写入 / 读取单独计数
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        input_tokens = usage.input_tokens + cache_write + cache_read
+        output_tokens = usage.output_tokens
+
+        billable_input = (
+            usage.input_tokens
+            + cache_write * CACHE_WRITE_PRICE_RATIO
+            + cache_read * self.CACHED_INPUT_PRICE_RATIO
+        )
         return ChatResponse(
             content=content,
             input_tokens=input_tokens,
             output_tokens=output_tokens,
             total_tokens=input_tokens + output_tokens,
-            cost=self.calculate_cost(input_tokens, output_tokens),
+            cost=self.calculate_cost(billable_input, output_tokens),
             latency_ms=latency,
+            cached_tokens=cache_read,
+            tool_calls=[
+                ToolCall.from_json(b.name, b.input)
+                for b in response.content if b.type == "tool_use"
+            ],
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
-        system_msg = None
-        chat_msgs = []
-        for m in messages:
-            if m.role == "system":
-                system_msg = m.content
-            else:
-                chat_msgs.append({"role": m.role, "content": m.content})
-
-        kwargs = {
-            "model": self.model_name,
-            "messages": chat_msgs,
-            "max_tokens": self.max_tokens,
-            "temperature": self.temperature,
-            "top_p": self.top_p,
-            "stream": True,
-        }
-        if system_msg:
-            kwargs["system"] = system_msg
-
-        async with self.client.messages.stream(**kwargs) as stream:
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+        async with self.client.messages.stream(**self._build_request(messages)) as stream:
             async for text in stream.text_stream:
                 yield text
 
@@ -1,10 +1,17 @@
 """LLM 适配器工厂 — 延迟导入各适配器以避免缺少 SDK 时导入失败"""
 
-from sqlalchemy import select
+import hashlib
+import json
+import uuid
+from typing import TYPE_CHECKING
+
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.adapters.base import BaseLLMAdapter
 
+if TYPE_CHECKING:
+    from app.models.ai_model import AIModel
+
 # provider -> (module_path, class_name)
 _ADAPTER_REGISTRY: dict[str, tuple[str, str]] = {
     "openai": ("app.adapters.openai_adapter", "OpenAICompatibleAdapter"),
@@ -15,6 +22,8 @@ _ADAPTER_REGISTRY: dict[str, tuple[str, str]] = {
     "minimax": ("app.adapters.minimax_adapter", "MiniMaxAdapter"),
     "gemini": ("app.adapters.gemini_adapter", "GeminiAdapter"),
     "hunyuan": ("app.adapters.hunyuan_adapter", "HunyuanAdapter"),
+    # 确定性模拟模型，仅用于压测（scripts/load_conversations.py），不经管理接口创建
+    "stub": ("app.adapters.stub_adapter", "StubAdapter"),
 }
 
 
@@ -29,6 +38,26 @@ def _load_adapter_class(provider: str) -> type[BaseLLMAdapter]:
     return getattr(module, class_name)
 
 
+# model_id -> (配置指纹, 适配器实例)
+_adapter_pool: dict[uuid.UUID, tuple[str, BaseLLMAdapter]] = {}
+
+
+def _model_fingerprint(model: "AIModel") -> str:
+    """模型配置指纹：任一影响适配器的字段变化都会使池中实例失效"""
+    raw = json.dumps(
+        [
+            model.provider,
+            model.model_name,
+            model.api_endpoint,
+            model.api_key_encrypted,
+            model.config,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
 class LLMAdapterFactory:
     """LLM 适配器工厂"""
 
@@ -49,23 +78,44 @@ class LLMAdapterFactory:
         )
 
     @staticmethod
-    async def get_default_adapter(db: AsyncSession) -> BaseLLMAdapter:
-        """从数据库获取默认模型并创建适配器"""
-        from app.models.ai_model import AIModel
+    def get_adapter(model: "AIModel") -> BaseLLMAdapter:
+        """按 (model id, 配置指纹) 获取长期复用的适配器实例
+
+        命中时不再解密 API Key、不再新建 SDK 客户端；
+        配置变化（含 API Key 轮换）时自动重建。
+        """
         from app.utils.encryption import decrypt_api_key
 
-        result = await db.execute(
-            select(AIModel).where(AIModel.is_default == True, AIModel.is_active == True)
-        )
-        model = result.scalar_one_or_none()
-        if not model:
-            raise ValueError("未配置默认 AI 模型")
+        fingerprint = _model_fingerprint(model)
+        entry = _adapter_pool.get(model.id)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
 
-        api_key = decrypt_api_key(model.api_key_encrypted)
-        return LLMAdapterFactory.create_adapter(
+        adapter = LLMAdapterFactory.create_adapter(
             provider=model.provider,
-            api_key=api_key,
+            api_key=decrypt_api_key(model.api_key_encrypted),
             model_name=model.model_name,
             api_endpoint=model.api_endpoint,
             config=model.config,
         )
+        _adapter_pool[model.id] = (fingerprint, adapter)
+        return adapter
+
+    @staticmethod
+    def invalidate(model_id: uuid.UUID | None = None) -> None:
+        """移除池中的适配器；model_id 为空时清空整个池"""
+        if model_id is None:
+            _adapter_pool.clear()
+        else:
+            _adapter_pool.pop(model_id, None)
+
+    @staticmethod
+    async def get_default_adapter(db: AsyncSession) -> BaseLLMAdapter:
+        """获取默认模型（进程内缓存）并返回池化适配器"""
+        from app.services.ai_model_cache import ai_model_cache
+
+        model = await ai_model_cache.get_default(db)
+        if not model:
+            raise ValueError("未配置默认 AI 模型")
+
+        return LLMAdapterFactory.get_adapter(model)
@@ -1,11 +1,12 @@
 """Google Gemini 适配器"""
 
 import asyncio
+from collections.abc import Mapping, Sequence
 from typing import AsyncIterator
 
 import google.generativeai as genai
 
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, ToolCall, iterate_in_thread
 
 GEMINI_PRICING = {
     "gemini-pro": (0.0035, 0.0105),
@@ -14,16 +15,50 @@ GEMINI_PRICING = {
     "gemini-2.0-flash": (0.007, 0.021),
 }
 
+# Gemini 函数声明只支持 OpenAPI Schema 的子集
+_SCHEMA_KEYS = {"type", "description", "enum", "properties", "required", "items", "format", "nullable"}
+
+
+def _gemini_schema(schema: dict) -> dict:
+    """裁剪为 Gemini 支持的 schema：去掉不支持的关键字与没有 properties 的 object 字段"""
+    out = {k: v for k, v in schema.items() if k in _SCHEMA_KEYS}
+    if "properties" in out:
+        out["properties"] = {
+            name: _gemini_schema(prop)
+            for name, prop in out["properties"].items()
+            if prop.get("type") != "object" or prop.get("properties")
+        }
+        if "required" in out:
+            out["required"] = [r for r in out["required"] if r in out["properties"]]
+    if "items" in out:
+        out["items"] = _gemini_schema(out["items"])
+    return out
+
+
+def _plain(value):
+    """把 proto 的 MapComposite / RepeatedComposite 转为 dict / list（整数值的浮点数还原为 int）"""
+    if isinstance(value, Mapping):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [_plain(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
 
 class GeminiAdapter(BaseLLMAdapter):
     """Google Gemini 适配器"""
 
+    SUPPORTS_TOOLS = True
+
     def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
         super().__init__(api_key, model_name, api_endpoint, config)
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel(model_name)
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
         start = self._measure_start()
 
         # 将消息转换为 Gemini 格式
@@ -39,6 +74,19 @@ class GeminiAdapter(BaseLLMAdapter):
             elif m.role == "assistant":
                 history.append({"role": "model", "parts": [m.content]})
 
+        kwargs = {}
+        if tools:
+            kwargs["tools"] = [{
+                "function_declarations": [
+                    {
+                        "name": t["function"]["name"],
+                        "description": t["function"].get("description", ""),
+                        "parameters": _gemini_schema(t["function"]["parameters"]),
+                    }
+                    for t in tools
+                ],
+            }]
+
         chat = self.model.start_chat(history=history)
         response = await asyncio.to_thread(
             chat.send_message,
@@ -48,10 +96,18 @@ class GeminiAdapter(BaseLLMAdapter):
                 max_output_tokens=self.max_tokens,
                 top_p=self.top_p,
             ),
+            **kwargs,
         )
         latency = self._measure_latency(start)
 
-        content = response.text
+        # 含函数调用时 response.text 不可用，逐 part 取文本与调用
+        parts = response.candidates[0].content.parts if response.candidates else []
+        content = "".join(p.text for p in parts if getattr(p, "text", ""))
+        tool_calls = [
+            ToolCall.from_json(p.function_call.name, _plain(p.function_call.args))
+            for p in parts
+            if getattr(p, "function_call", None) and p.function_call.name
+        ]
         # Gemini 的 token 计数
         input_tokens = response.usage_metadata.prompt_token_count if hasattr(response, "usage_metadata") and response.usage_metadata else 0
         output_tokens = response.usage_metadata.candidates_token_count if hasattr(response, "usage_metadata") and response.usage_metadata else 0
@@ -63,9 +119,10 @@ class GeminiAdapter(BaseLLMAdapter):
             total_tokens=input_tokens + output_tokens,
             cost=self.calculate_cost(input_tokens, output_tokens),
             latency_ms=latency,
+            tool_calls=tool_calls,
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
         history = []
         last_content = ""
         for m in messages:
@@ -78,19 +135,24 @@ class GeminiAdapter(BaseLLMAdapter):
                 history.append({"role": "model", "parts": [m.content]})
 
         chat = self.model.start_chat(history=history)
-        response = await asyncio.to_thread(
-            chat.send_message,
-            last_content,
-            generation_config=genai.types.GenerationConfig(
-                temperature=self.temperature,
-                max_output_tokens=self.max_tokens,
-                top_p=self.top_p,
-            ),
-            stream=True,
-        )
-        for chunk in response:
-            if chunk.text:
-                yield chunk.text
+
+        def _stream():
+            response = chat.send_message(
+                last_content,
+                generation_config=genai.types.GenerationConfig(
+                    temperature=self.temperature,
+                    max_output_tokens=self.max_tokens,
+                    top_p=self.top_p,
+                ),
+                stream=True,
+            )
+            for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
+        # 流式响应的迭代本身会阻塞（逐块网络读取），放到线程中桥接
+        async for chunk in iterate_in_thread(_stream):
+            yield chunk
 
     def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
         pricing = GEMINI_PRICING.get(self.model_name, (0.0035, 0.0105))
@@ -0,0 +1,273 @@
+"""LLM 上游保护 — 按厂商（上游地址）的自适应并发限制与熔断
+
+厂商变慢时请求会在协程中堆积，而对话接口在 LLM 调用期间持有数据库会话，
+堆积的请求会耗尽连接池、拖垮无关接口。这里在适配器层为每个上游加一道闸：
+- 自适应并发（AIMD）：调用成功且不慢时上限缓慢增加（每个窗口 +1），失败或过慢
+  （完整调用超过 LLM_SLOW_CALL_SECONDS、流式首 token 超过 LLM_SLOW_FIRST_TOKEN_SECONDS）
+  时上限减半，在 [1, LLM_MAX_CONCURRENCY] 间调整
+- 取消：等待结果已超过慢调用阈值后被取消（对冲落败、首 token 超时）同样按过慢减半；
+  首 token 超时由路由经 record_timeout 报告，计为失败
+- 排队：超出上限的请求排队等待，等待超过 LLM_QUEUE_TIMEOUT 或队列已满时立即失败，
+  不无限挂起（失败由多模型路由降级到其他模型）
+- 熔断：连续失败 LLM_BREAKER_FAILURES 次后打开，冷却 LLM_BREAKER_COOLDOWN 秒后
+  进入半开状态，只放行一个探测请求；探测成功则关闭，失败则重新打开
+- 指标：当前上限、在途 / 排队数、排队耗时、拒绝次数、熔断状态
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderUnavailable(Exception):
+    """上游受保护，本次调用未发出"""
+
+
+class CircuitOpenError(ProviderUnavailable):
+    """熔断打开中"""
+
+
+class ProviderOverloaded(ProviderUnavailable):
+    """并发已满且排队超时 / 队列已满"""
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器（半开时只放行一个探测）"""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+
+    def allow(self) -> bool:
+        """是否放行本次调用；放行半开探测时占用探测名额"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info("上游探测成功，熔断关闭")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opens += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self) -> None:
+        """探测请求未得出结论（如被取消）时归还名额"""
+        self._probing = False
+
+
+class AdaptiveLimiter:
+    """AIMD 并发限制器：成功加性增加，失败 / 过慢乘性减少"""
+
+    def __init__(self, initial: int, max_limit: int, max_queue: int):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(min(max(1, initial), self.max_limit))
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise ProviderOverloaded(f"并发已满（上限 {int(self.limit)}），排队已满")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # 已分到名额但来不及使用，归还
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise ProviderOverloaded(f"排队超过 {timeout}s（并发上限 {int(self.limit)}）") from None
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def on_success(self) -> None:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_drop(self) -> None:
+        self.limit = max(1.0, self.limit / 2)
+
+
+class ProviderGuard:
+    """单个上游的并发限制 + 熔断 + 排队指标"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.limiter = AdaptiveLimiter(
+            settings.LLM_INITIAL_CONCURRENCY, settings.LLM_MAX_CONCURRENCY, settings.LLM_MAX_QUEUE
+        )
+        self.breaker = CircuitBreaker(settings.LLM_BREAKER_FAILURES, settings.LLM_BREAKER_COOLDOWN)
+        self.queue_timeout = settings.LLM_QUEUE_TIMEOUT
+        self.slow_call = settings.LLM_SLOW_CALL_SECONDS
+        self.slow_first_token = settings.LLM_SLOW_FIRST_TOKEN_SECONDS
+        self.stats = {
+            "calls": 0, "failures": 0, "timeouts": 0, "slow_calls": 0,
+            "rejected_open": 0, "rejected_overload": 0,
+            "queued": 0, "queue_ms_total": 0.0, "queue_ms_max": 0.0,
+        }
+
+    @asynccontextmanager
+    async def slot(self, streaming: bool = False) -> AsyncIterator["GuardSlot"]:
+        """占用一个调用名额；流式调用在首 token 到达时通过 GuardSlot.mark_latency 报告延迟信号"""
+        if not self.breaker.allow():
+            self.stats["rejected_open"] += 1
+            raise CircuitOpenError(f"{self.key} 熔断中，{self.breaker.cooldown:.0f}s 冷却后探测")
+
+        start = time.monotonic()
+        queued = self.limiter.in_flight >= int(self.limiter.limit) or self.limiter.queued > 0
+        try:
+            await self.limiter.acquire(self.queue_timeout)
+        except BaseException as e:
+            self.breaker.release_probe()
+            if isinstance(e, ProviderOverloaded):
+                self.stats["rejected_overload"] += 1
+            raise
+        if queued:
+            waited = (time.monotonic() - start) * 1000
+            self.stats["queued"] += 1
+            self.stats["queue_ms_total"] += waited
+            self.stats["queue_ms_max"] = max(self.stats["queue_ms_max"], waited)
+
+        slot = GuardSlot()
+        threshold = self.slow_first_token if streaming else self.slow_call
+        try:
+            yield slot
+        except (asyncio.CancelledError, GeneratorExit):
+            # 调用方放弃：已拿到结果信号（首 token）或等待未超过慢调用阈值时不作为健康信号；
+            # 等待已超过阈值（对冲落败、首 token 超时）则按过慢减半
+            self.breaker.release_probe()
+            if slot.latency is None and time.monotonic() - slot.start > threshold:
+                self.stats["slow_calls"] += 1
+                self.limiter.on_drop()
+            raise
+        except Exception:
+            self.stats["calls"] += 1
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            self.limiter.on_drop()
+            raise
+        else:
+            self.stats["calls"] += 1
+            self.breaker.record_success()
+            elapsed = slot.latency if slot.latency is not None else time.monotonic() - slot.start
+            if elapsed > threshold:
+                self.stats["slow_calls"] += 1
+                self.limiter.on_drop()
+            else:
+                self.limiter.on_success()
+        finally:
+            self.limiter.release()
+
+    def record_timeout(self) -> None:
+        """调用方超时放弃（流式首 token 超时）：计为失败，累计熔断
+
+        名额与并发上限已在 slot 退出时按取消处理，这里不再减半。
+        """
+        self.stats["calls"] += 1
+        self.stats["failures"] += 1
+        self.stats["timeouts"] += 1
+        self.breaker.record_failure()
+
+    def snapshot(self) -> dict:
+        return {
+            "key": self.key,
+            "state": self.breaker.state,
+            "limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "waiting": self.limiter.queued,
+            **self.stats,
+            "queue_ms_avg": (
+                self.stats["queue_ms_total"] / self.stats["queued"] if self.stats["queued"] else 0.0
+            ),
+        }
+
+
+class GuardSlot:
+    """已占用的调用名额；流式调用以首 token 延迟作为拥塞信号"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.latency: float | None = None
+
+    def mark_latency(self) -> None:
+        if self.latency is None:
+            self.latency = time.monotonic() - self.start
+
+
+# 上游 key -> 保护器（进程内）
+_guards: dict[str, ProviderGuard] = {}
+
+
+def get_provider_guard(key: str) -> ProviderGuard:
+    guard = _guards.get(key)
+    if guard is None:
+        guard = _guards[key] = ProviderGuard(key)
+    return guard
+
+
+def get_guard_stats() -> list[dict]:
+    return [guard.snapshot() for guard in _guards.values()]
+
+
+def reset_provider_guards() -> None:
+    _guards.clear()
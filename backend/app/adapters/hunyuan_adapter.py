@@ -4,7 +4,7 @@ import asyncio
 import json
 from typing import AsyncIterator
 
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, iterate_in_thread
 
 HUNYUAN_PRICING = {
     "hunyuan-lite": (0.008, 0.008),
@@ -24,16 +24,19 @@ class HunyuanAdapter(BaseLLMAdapter):
             raise ValueError("混元 API Key 格式应为 'secret_id:secret_key'")
         self.secret_id = parts[0]
         self.secret_key = parts[1]
+        self._client = None
 
     def _get_client(self):
+        """复用 HunyuanClient（适配器实例由工厂池化，长期存活）"""
         from tencentcloud.common import credential
         from tencentcloud.hunyuan.v20230901 import hunyuan_client, models
 
-        cred = credential.Credential(self.secret_id, self.secret_key)
-        client = hunyuan_client.HunyuanClient(cred, "")
-        return client, models
+        if self._client is None:
+            cred = credential.Credential(self.secret_id, self.secret_key)
+            self._client = hunyuan_client.HunyuanClient(cred, "")
+        return self._client, models
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+    async def _chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
         start = self._measure_start()
 
         def _call():
@@ -66,7 +69,7 @@ class HunyuanAdapter(BaseLLMAdapter):
             latency_ms=latency,
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
         def _stream():
             client, models = self._get_client()
             req = models.ChatCompletionsRequest()
@@ -79,17 +82,15 @@ class HunyuanAdapter(BaseLLMAdapter):
             req.TopP = self.top_p
             req.Stream = True
             resp = client.ChatCompletions(req)
-            results = []
             for event in resp:
                 data = json.loads(event["data"])
                 if data.get("Choices"):
                     delta = data["Choices"][0].get("Delta", {})
                     if delta.get("Content"):
-                        results.append(delta["Content"])
-            return results
+                        yield delta["Content"]
 
-        chunks = await asyncio.to_thread(_stream)
-        for chunk in chunks:
+        # 腾讯云 SDK 的 SSE 为同步迭代，在线程中逐块桥接为异步流
+        async for chunk in iterate_in_thread(_stream):
             yield chunk
 
     def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
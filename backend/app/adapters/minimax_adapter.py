@@ -2,9 +2,7 @@
 
 from typing import AsyncIterator
 
-import httpx
-
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, get_shared_http_client
 
 MINIMAX_PRICING = {
     "abab6.5-chat": (0.03, 0.03),
@@ -22,7 +20,7 @@ class MiniMaxAdapter(BaseLLMAdapter):
         super().__init__(api_key, model_name, api_endpoint, config)
         self.endpoint = api_endpoint or DEFAULT_ENDPOINT
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+    async def _chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
         start = self._measure_start()
 
         headers = {
@@ -37,10 +35,12 @@ class MiniMaxAdapter(BaseLLMAdapter):
             "top_p": self.top_p,
         }
 
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            resp = await client.post(self.endpoint, json=payload, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
+        client = get_shared_http_client()
+        resp = await client.post(
+            self.endpoint, json=payload, headers=headers, timeout=self.timeout
+        )
+        resp.raise_for_status()
+        data = resp.json()
 
         latency = self._measure_latency(start)
 
@@ -62,7 +62,7 @@ class MiniMaxAdapter(BaseLLMAdapter):
             latency_ms=latency,
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -77,18 +77,20 @@ class MiniMaxAdapter(BaseLLMAdapter):
         }
 
         import json
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            async with client.stream("POST", self.endpoint, json=payload, headers=headers) as resp:
-                resp.raise_for_status()
-                async for line in resp.aiter_lines():
-                    if line.startswith("data: "):
-                        chunk_data = line[6:]
-                        if chunk_data == "[DONE]":
-                            break
-                        chunk = json.loads(chunk_data)
-                        delta = chunk.get("choices", [{}])[0].get("delta", {})
-                        if delta.get("content"):
-                            yield delta["content"]
+        client = get_shared_http_client()
+        async with client.stream(
+            "POST", self.endpoint, json=payload, headers=headers, timeout=self.timeout
+        ) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if line.startswith("data: "):
+                    chunk_data = line[6:]
+                    if chunk_data == "[DONE]":
+                        break
+                    chunk = json.loads(chunk_data)
+                    delta = chunk.get("choices", [{}])[0].get("delta", {})
+                    if delta.get("content"):
+                        yield delta["content"]
 
     def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
         pricing = MINIMAX_PRICING.get(self.model_name, (0.01, 0.01))
@@ -4,7 +4,14 @@ from typing import AsyncIterator
 
 from openai import AsyncOpenAI
 
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import (
+    BaseLLMAdapter,
+    ChatMessage,
+    ChatResponse,
+    ToolCall,
+    get_shared_http_client,
+    prefix_ordered,
+)
 
 # 定价（元/千token）：input, output
 OPENAI_PRICING = {
@@ -31,44 +38,94 @@ class OpenAICompatibleAdapter(BaseLLMAdapter):
 
     DEFAULT_BASE_URL = "https://api.openai.com/v1"
     PRICING: dict[str, tuple[float, float]] = OPENAI_PRICING
+    # OpenAI 对 1024 token 以上的相同前缀自动缓存，命中部分半价
+    PROMPT_CACHE = "auto"
+    CACHED_INPUT_PRICE_RATIO = 0.5
+    SUPPORTS_TOOLS = True
 
     def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
         super().__init__(api_key, model_name, api_endpoint, config)
+        self.base_url = api_endpoint or self.DEFAULT_BASE_URL
         self.client = AsyncOpenAI(
             api_key=api_key,
-            base_url=api_endpoint or self.DEFAULT_BASE_URL,
+            base_url=self.base_url,
             timeout=self.timeout,
+            http_client=get_shared_http_client(),
         )
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+    async def _to_api_messages(self, messages: list[ChatMessage]) -> list[dict]:
+        """转换为接口消息格式：可缓存前缀置前；有上下文缓存句柄时以句柄代替前缀"""
+        ordered = prefix_ordered(messages)
+        handle = await self.get_context_cache_handle(ordered)
+        if handle:
+            return [self._cache_reference(handle)] + [
+                {"role": m.role, "content": m.content} for m in ordered if not m.cacheable
+            ]
+        return [{"role": m.role, "content": m.content} for m in ordered]
+
+    def _cache_reference(self, handle: str) -> dict:
+        return {"role": "cache", "content": handle}
+
+    @staticmethod
+    def _cached_tokens(usage) -> int:
+        """从 usage 中读取命中缓存的 token 数（各兼容厂商字段不同）"""
+        if usage is None:
+            return 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens")
+        else:
+            cached = getattr(details, "cached_tokens", None)
+        if cached:
+            return int(cached)
+        # DeepSeek: prompt_cache_hit_tokens；Kimi: cached_tokens
+        for attr in ("prompt_cache_hit_tokens", "cached_tokens"):
+            cached = getattr(usage, attr, None)
+            if cached:
+                return int(cached)
+        return 0
+
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
         start = self._measure_start()
+        kwargs = {"tools": tools, "tool_choice": "auto"} if tools else {}
         response = await self.client.chat.completions.create(
             model=self.model_name,
-            messages=[{"role": m.role, "content": m.content} for m in messages],
+            messages=await self._to_api_messages(messages),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             top_p=self.top_p,
+            **kwargs,
         )
         latency = self._measure_latency(start)
+        message = response.choices[0].message
 
         usage = response.usage
         input_tokens = usage.prompt_tokens if usage else 0
         output_tokens = usage.completion_tokens if usage else 0
         total_tokens = usage.total_tokens if usage else 0
+        cached_tokens = self._cached_tokens(usage)
 
         return ChatResponse(
-            content=response.choices[0].message.content or "",
+            content=message.content or "",
             input_tokens=input_tokens,
             output_tokens=output_tokens,
             total_tokens=total_tokens,
-            cost=self.calculate_cost(input_tokens, output_tokens),
+            cost=self.cost_with_cache(input_tokens, output_tokens, cached_tokens),
             latency_ms=latency,
+            cached_tokens=cached_tokens,
+            tool_calls=[
+                ToolCall.from_json(c.function.name, c.function.arguments)
+                for c in (message.tool_calls or [])
+                if c.type == "function"
+            ],
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
         stream = await self.client.chat.completions.create(
             model=self.model_name,
-            messages=[{"role": m.role, "content": m.content} for m in messages],
+            messages=await self._to_api_messages(messages),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             top_p=self.top_p,
@@ -86,14 +143,43 @@ class OpenAICompatibleAdapter(BaseLLMAdapter):
 
 
 class KimiAdapter(OpenAICompatibleAdapter):
-    """Kimi（月之暗面）适配器 — OpenAI 兼容"""
+    """Kimi（月之暗面）适配器 — OpenAI 兼容
+
+    模型 config 中设置 {"context_cache": true} 时，静态前缀通过 Context Caching
+    接口创建缓存，之后以 role="cache" 的句柄消息引用。
+    """
 
     DEFAULT_BASE_URL = "https://api.moonshot.cn/v1"
     PRICING = KIMI_PRICING
+    PROMPT_CACHE = "none"
+    CACHE_MODEL = "moonshot-v1"
+
+    def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
+        super().__init__(api_key, model_name, api_endpoint, config)
+        if self.config.get("context_cache"):
+            self.prompt_cache_mode = "handle"
+
+    async def _create_context_cache(self, prefix: list[ChatMessage]) -> str | None:
+        resp = await get_shared_http_client().post(
+            f"{self.base_url.rstrip('/')}/caching",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json={
+                "model": self.CACHE_MODEL,
+                "messages": [{"role": m.role, "content": m.content} for m in prefix],
+                "ttl": self.CONTEXT_CACHE_TTL,
+            },
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        return resp.json().get("id")
+
+    def _cache_reference(self, handle: str) -> dict:
+        return {"role": "cache", "content": f"cache_id={handle};reset_ttl={self.CONTEXT_CACHE_TTL}"}
 
 
 class DeepSeekAdapter(OpenAICompatibleAdapter):
-    """DeepSeek 适配器 — OpenAI 兼容"""
+    """DeepSeek 适配器 — OpenAI 兼容（硬盘缓存自动生效，命中部分约一折）"""
 
     DEFAULT_BASE_URL = "https://api.deepseek.com"
     PRICING = DEEPSEEK_PRICING
+    CACHED_INPUT_PRICE_RATIO = 0.1
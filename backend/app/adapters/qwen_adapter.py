@@ -2,10 +2,9 @@
 
 from typing import AsyncIterator
 
-import dashscope
 from dashscope import Generation
 
-from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, ToolCall, iterate_in_thread
 
 QWEN_PRICING = {
     "qwen-max": (0.04, 0.12),
@@ -18,30 +17,42 @@ QWEN_PRICING = {
 class QwenAdapter(BaseLLMAdapter):
     """通义千问适配器（DashScope SDK）"""
 
+    SUPPORTS_TOOLS = True
+
     def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
         super().__init__(api_key, model_name, api_endpoint, config)
-        dashscope.api_key = api_key
 
-    async def chat_completion(self, messages: list[ChatMessage]) -> ChatResponse:
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
         start = self._measure_start()
 
-        # DashScope 同步调用，在线程池中运行
+        # DashScope 同步调用，在线程池中运行；tools 与 OpenAI 格式一致
         import asyncio
+        kwargs = {"tools": tools} if tools else {}
         response = await asyncio.to_thread(
             Generation.call,
+            api_key=self.api_key,
             model=self.model_name,
             messages=[{"role": m.role, "content": m.content} for m in messages],
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             top_p=self.top_p,
             result_format="message",
+            **kwargs,
         )
         latency = self._measure_latency(start)
 
         if response.status_code != 200:
             raise RuntimeError(f"Qwen API error: {response.code} - {response.message}")
 
-        content = response.output.choices[0].message.content
+        message = response.output.choices[0].message
+        content = message.get("content") or ""
+        tool_calls = [
+            ToolCall.from_json(c["function"]["name"], c["function"].get("arguments"))
+            for c in (message.get("tool_calls") or [])
+            if c.get("type", "function") == "function"
+        ]
         usage = response.usage
         input_tokens = usage.get("input_tokens", 0)
         output_tokens = usage.get("output_tokens", 0)
@@ -53,13 +64,13 @@ class QwenAdapter(BaseLLMAdapter):
             total_tokens=input_tokens + output_tokens,
             cost=self.calculate_cost(input_tokens, output_tokens),
             latency_ms=latency,
+            tool_calls=tool_calls,
         )
 
-    async def chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
-        import asyncio
-
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
         def _stream():
             responses = Generation.call(
+                api_key=self.api_key,
                 model=self.model_name,
                 messages=[{"role": m.role, "content": m.content} for m in messages],
                 temperature=self.temperature,
@@ -70,13 +81,14 @@ class QwenAdapter(BaseLLMAdapter):
                 incremental_output=True,
             )
             for response in responses:
-                if response.status_code == 200:
-                    yield response.output.choices[0].message.content
-
-        loop = asyncio.get_event_loop()
-        # 将同步生成器包装为异步
-        chunks = await asyncio.to_thread(lambda: list(_stream()))
-        for chunk in chunks:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Qwen API error: {response.code} - {response.message}")
+                content = response.output.choices[0].message.content
+                if content:
+                    yield content
+
+        # DashScope SDK 为同步生成器，在线程中逐块桥接为异步流
+        async for chunk in iterate_in_thread(_stream):
             yield chunk
 
     def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
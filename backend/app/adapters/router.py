@@ -0,0 +1,278 @@
+"""多模型路由 — 在 LLMAdapterFactory 之上按任务选择模型，主模型慢或失败时对冲 / 降级
+
+- 候选顺序：config.tasks 声明承担该任务的模型 → 默认模型 → 其他启用模型；
+  近期错误率过高的模型排到最后
+- 每个模型记录最近 ROUTER_WINDOW 次调用的延迟与成败，提供 p50 / p95 / 错误率
+- 非流式：主模型超过其 p95 延迟仍未返回时，向下一个模型发出对冲请求，取先成功者；
+  失败则立即降级到下一个模型；落败被取消的请求仍已计费，随结果返回以记录使用日志
+- 流式：首个 token 到达前失败或超时则降级；开始输出后不再切换
+- 函数调用：全部候选模型都支持时才下发 tools，降级到任一模型 prompt 格式都适用
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable
+
+from app.adapters.base import ChatMessage, ChatResponse
+from app.adapters.factory import LLMAdapterFactory, _load_adapter_class
+from app.core.config import get_settings
+
+if TYPE_CHECKING:
+    from app.models.ai_model import AIModel
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# 路由任务
+TASK_CHAT = "chat"  # 对话回复 + 病历信息提取
+TASK_SUMMARY = "summary"  # 对话摘要
+
+ROUTER_WINDOW = 50
+MIN_SAMPLES = 5
+UNHEALTHY_ERROR_RATE = 0.5
+# 对冲等待时间下限 / 上限（秒），样本不足时用 LLM_HEDGE_DELAY
+HEDGE_MIN_DELAY = 1.0
+HEDGE_MAX_DELAY = 30.0
+
+ModelFilter = Callable[["AIModel"], Awaitable[bool]]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+@dataclass
+class ModelStats:
+    """单个模型最近调用的延迟（毫秒，仅成功）与成败"""
+
+    latencies: deque = field(default_factory=lambda: deque(maxlen=ROUTER_WINDOW))
+    outcomes: deque = field(default_factory=lambda: deque(maxlen=ROUTER_WINDOW))
+
+    def record(self, latency_ms: float, ok: bool) -> None:
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency_ms)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    @property
+    def p50(self) -> float | None:
+        return _percentile(list(self.latencies), 0.5) if self.latencies else None
+
+    @property
+    def p95(self) -> float | None:
+        return _percentile(list(self.latencies), 0.95) if self.latencies else None
+
+    @property
+    def healthy(self) -> bool:
+        return len(self.outcomes) < MIN_SAMPLES or self.error_rate < UNHEALTHY_ERROR_RATE
+
+
+# model_id -> 统计（进程内）
+_model_stats: dict[uuid.UUID, ModelStats] = {}
+
+
+def get_model_stats(model_id: uuid.UUID) -> ModelStats:
+    stats = _model_stats.get(model_id)
+    if stats is None:
+        stats = _model_stats[model_id] = ModelStats()
+    return stats
+
+
+def reset_model_stats() -> None:
+    _model_stats.clear()
+
+
+def _supports_tools(model: "AIModel") -> bool:
+    """模型是否走函数调用：适配器支持且模型 config 未关闭 structured_output"""
+    if (model.config or {}).get("structured_output") is False:
+        return False
+    try:
+        return _load_adapter_class(model.provider).SUPPORTS_TOOLS
+    except (ImportError, ValueError):
+        return False
+
+
+class RouteExhausted(Exception):
+    """所有候选模型都不可用（无可用模型、超出限额或全部调用失败）"""
+
+    def __init__(self, failures: list[tuple["AIModel", Exception]]):
+        self.failures = failures
+        super().__init__(
+            "; ".join(f"{m.provider}/{m.model_name}: {e}" for m, e in failures) or "无可用模型"
+        )
+
+
+@dataclass
+class RouteResult:
+    response: ChatResponse
+    model: "AIModel"
+    # 本次路由中失败的尝试（用于记录错误日志）
+    failures: list[tuple["AIModel", Exception]] = field(default_factory=list)
+    # 对冲落败、被取消的尝试（上游已收到请求，按 prompt 估算记录使用日志）
+    cancelled: list["AIModel"] = field(default_factory=list)
+
+
+class LLMRouter:
+    """按任务路由到多个模型"""
+
+    def __init__(self, models: list["AIModel"], task: str = TASK_CHAT, hedge: bool | None = None):
+        self.task = task
+        self.hedge = settings.LLM_HEDGING if hedge is None else hedge
+        self.models = self._order(models)
+
+    def _order(self, models: list["AIModel"]) -> list["AIModel"]:
+        def rank(model: "AIModel") -> tuple[int, int]:
+            tasks = (model.config or {}).get("tasks") or []
+            group = 0 if self.task in tasks else (1 if model.is_default else 2)
+            return (0 if get_model_stats(model.id).healthy else 1, group)
+
+        return sorted(models, key=rank)
+
+    async def _candidates(self, allow: ModelFilter | None) -> AsyncIterator["AIModel"]:
+        for model in self.models:
+            if allow is None or await allow(model):
+                yield model
+
+    def _hedge_delay(self, model: "AIModel") -> float:
+        p95 = get_model_stats(model.id).p95
+        delay = p95 / 1000 if p95 is not None else settings.LLM_HEDGE_DELAY
+        return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    @property
+    def supports_tools(self) -> bool:
+        """全部候选模型都支持函数调用（降级到任一模型时 prompt 格式仍然适用）"""
+        return bool(self.models) and all(_supports_tools(m) for m in self.models)
+
+    async def _attempt(
+        self, model: "AIModel", messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
+        adapter = LLMAdapterFactory.get_adapter(model)
+        stats = get_model_stats(model.id)
+        start = time.monotonic()
+        try:
+            if tools:
+                response = await adapter.chat_completion(messages, tools=tools)
+            else:
+                response = await adapter.chat_completion(messages)
+        except asyncio.CancelledError:
+            raise  # 对冲落败被取消，不计入统计
+        except Exception:
+            stats.record((time.monotonic() - start) * 1000, ok=False)
+            raise
+        stats.record((time.monotonic() - start) * 1000, ok=True)
+        return response
+
+    async def chat_completion(
+        self,
+        messages: list[ChatMessage],
+        allow: ModelFilter | None = None,
+        tools: list[dict] | None = None,
+    ) -> RouteResult:
+        """非流式调用：失败降级，慢则对冲；allow 用于跳过超出限额等不可用的模型
+
+        tools 为 OpenAI 格式的函数定义，应先确认 supports_tools。
+        """
+        candidates = aiter(self._candidates(allow))
+        failures: list[tuple["AIModel", Exception]] = []
+        pending: dict[asyncio.Task, "AIModel"] = {}
+        exhausted = False
+
+        async def _launch() -> bool:
+            nonlocal exhausted
+            if exhausted:
+                return False
+            model = await anext(candidates, None)
+            if model is None:
+                exhausted = True
+                return False
+            task = asyncio.create_task(self._attempt(model, messages, tools))
+            pending[task] = model
+            return True
+
+        try:
+            await _launch()
+            while pending:
+                # 还有候选时，按最近发出请求的模型 p95 决定是否对冲
+                timeout = None
+                if self.hedge and not exhausted:
+                    timeout = self._hedge_delay(list(pending.values())[-1])
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if await _launch():
+                        logger.info("模型 %s 响应慢，发出对冲请求", list(pending.values())[0].model_name)
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    if task.exception() is None:
+                        return RouteResult(task.result(), model, failures, list(pending.values()))
+                    failures.append((model, task.exception()))
+                    logger.warning("模型 %s 调用失败，尝试降级: %s", model.model_name, task.exception())
+                if not pending:
+                    await _launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise RouteExhausted(failures)
+
+    async def open_stream(
+        self, messages: list[ChatMessage], allow: ModelFilter | None = None
+    ) -> tuple["AIModel", AsyncIterator[str], list[tuple["AIModel", Exception]]]:
+        """流式调用：依次尝试候选模型，首个 token 到达后返回 (模型, token 流, 失败列表)"""
+        failures: list[tuple["AIModel", Exception]] = []
+        remaining = [m async for m in self._candidates(allow)]
+        for index, model in enumerate(remaining):
+            adapter = LLMAdapterFactory.get_adapter(model)
+            stats = get_model_stats(model.id)
+            start = time.monotonic()
+            stream = adapter.chat_completion_stream(messages)
+            # 最后一个候选不设首 token 超时
+            timeout = settings.LLM_FIRST_TOKEN_TIMEOUT if index < len(remaining) - 1 else None
+            try:
+                first = await asyncio.wait_for(anext(stream), timeout)
+            except StopAsyncIteration:
+                first = None
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = TimeoutError(f"首个 token 超过 {timeout}s 未到达")
+                    # 超时取消在上游保护看来只是调用方放弃，这里显式报告为失败
+                    adapter.guard.record_timeout()
+                stats.record((time.monotonic() - start) * 1000, ok=False)
+                failures.append((model, e))
+                logger.warning("模型 %s 流式调用失败，尝试降级: %s", model.model_name, e)
+                try:
+                    await stream.aclose()
+                except Exception:
+                    pass
+                continue
+            return model, self._relay(stream, first, stats, start), failures
+        raise RouteExhausted(failures)
+
+    @staticmethod
+    async def _relay(
+        stream: AsyncIterator[str], first: str | None, stats: ModelStats, start: float
+    ) -> AsyncIterator[str]:
+        try:
+            async with aclosing(stream):
+                if first is not None:
+                    yield first
+                    async for token in stream:
+                        yield token
+        except Exception:
+            stats.record((time.monotonic() - start) * 1000, ok=False)
+            raise
+        # 客户端提前断开（GeneratorExit）不计入统计
+        stats.record((time.monotonic() - start) * 1000, ok=True)
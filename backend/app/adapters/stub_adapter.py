@@ -0,0 +1,143 @@
+"""确定性模拟适配器 — 不访问网络，用于压测与回归基准
+
+回复内容只取决于对话轮次（消息中用户消息的条数），按脚本依次提取基本信息、症状、
+诊断与治疗，覆盖信息合并、相似病例检索与确认等完整对话路径。
+模型 config 中的参数：
+- latency_ms / jitter_ms：首 token 延迟及随机抖动（毫秒）
+- tokens_per_second：输出速度，同步调用按输出长度折算总耗时
+- failure_rate：注入失败的概率（首 token 前抛出，路由按上游失败处理）
+- seed：抖动与失败注入的随机种子，相同种子得到相同序列
+- reply_chars：回复文本长度
+"""
+
+import asyncio
+import json
+import random
+from typing import AsyncIterator
+
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, ToolCall
+
+# 第 n 轮（从 1 开始）提取的字段与建议阶段；超出后不再提取
+STUB_SCRIPT: list[tuple[dict, str]] = [
+    (
+        {"poultry_type": "鸡", "breed": "蛋鸡", "age_days": 45, "affected_count": 30, "total_flock": 500},
+        "collecting_symptoms",
+    ),
+    ({"symptoms": ["打喷嚏", "流鼻涕", "甩头"], "onset_date": "3天前"}, "collecting_diagnosis"),
+    ({"primary_diagnosis": "疑似传染性支气管炎", "severity": "moderate"}, "collecting_treatment"),
+    (
+        {"treatment": {"drug": "恩诺沙星", "method": "饮水", "dosage": "0.1%", "duration": "5天"}},
+        "confirming",
+    ),
+]
+
+STUB_FILLER = "请继续描述鸡群的精神、采食、粪便与死亡情况。"
+
+# 按字符数估算 token（约 2 个字符一个 token），不调用分词器以免占用压测进程的 CPU
+CHARS_PER_TOKEN = 2
+STREAM_CHUNK_CHARS = 4
+
+
+class StubAdapterError(RuntimeError):
+    """注入的上游失败"""
+
+
+class StubAdapter(BaseLLMAdapter):
+    """确定性模拟适配器（支持函数调用模式）"""
+
+    SUPPORTS_TOOLS = True
+
+    def __init__(self, api_key: str, model_name: str, api_endpoint: str | None = None, config: dict | None = None):
+        super().__init__(api_key, model_name, api_endpoint, config)
+        self.latency_ms = float(self.config.get("latency_ms", 200))
+        self.jitter_ms = float(self.config.get("jitter_ms", 0))
+        self.tokens_per_second = float(self.config.get("tokens_per_second", 50))
+        self.failure_rate = float(self.config.get("failure_rate", 0))
+        self.reply_chars = int(self.config.get("reply_chars", 60))
+        self._random = random.Random(self.config.get("seed", 0))
+
+    # ---- 脚本化输出 ----
+
+    def _turn(self, messages: list[ChatMessage]) -> tuple[str, dict, str]:
+        """(回复文本, 本轮提取的字段, 建议阶段)"""
+        n = sum(1 for m in messages if m.role == "user")
+        extracted, state = STUB_SCRIPT[n - 1] if 0 < n <= len(STUB_SCRIPT) else ({}, "confirming")
+        head = f"（模拟回复）第{n}轮信息已记录。"
+        pad = max(self.reply_chars - len(head), 0)
+        filler = STUB_FILLER * (pad // len(STUB_FILLER) + 1)
+        return head + filler[:pad], extracted, state
+
+    def _envelope(self, messages: list[ChatMessage]) -> str:
+        reply, extracted, state = self._turn(messages)
+        return json.dumps(
+            {
+                "reply": reply,
+                "extracted_info": extracted,
+                "confidence_scores": {k: 0.9 for k in extracted},
+                "needs_confirmation": [],
+                "suggested_state": state,
+            },
+            ensure_ascii=False,
+        )
+
+    def _input_tokens(self, messages: list[ChatMessage]) -> int:
+        return sum(len(m.content) for m in messages) // CHARS_PER_TOKEN
+
+    # ---- 延迟与失败注入 ----
+
+    async def _first_token_delay(self) -> None:
+        delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+        fail = self._random.random() < self.failure_rate
+        await asyncio.sleep(delay / 1000)
+        if fail:
+            raise StubAdapterError(f"Stub 注入失败 ({self.model_name})")
+
+    def _output_seconds(self, chars: int) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return chars / CHARS_PER_TOKEN / self.tokens_per_second
+
+    # ---- 接口实现 ----
+
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
+        start = self._measure_start()
+        await self._first_token_delay()
+
+        if tools:
+            reply, extracted, state = self._turn(messages)
+            content = reply
+            tool_calls = [ToolCall(tools[0]["function"]["name"], {
+                **extracted,
+                "confidence_scores": {k: 0.9 for k in extracted},
+                "needs_confirmation": [],
+                "suggested_state": state,
+            })] if extracted else []
+        else:
+            content = self._envelope(messages)
+            tool_calls = []
+        await asyncio.sleep(self._output_seconds(len(content)))
+
+        input_tokens = self._input_tokens(messages)
+        output_tokens = len(content) // CHARS_PER_TOKEN
+        return ChatResponse(
+            content=content,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=input_tokens + output_tokens,
+            latency_ms=self._measure_latency(start),
+            tool_calls=tool_calls,
+        )
+
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+        await self._first_token_delay()
+        content = self._envelope(messages)
+        interval = self._output_seconds(STREAM_CHUNK_CHARS)
+        for i in range(0, len(content), STREAM_CHUNK_CHARS):
+            if i:
+                await asyncio.sleep(interval)
+            yield content[i:i + STREAM_CHUNK_CHARS]
+
+    def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
+        return 0.0
@@ -3,12 +3,12 @@ from typing import Callable
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.database import get_db
 from app.core.security import decode_token
 from app.models.user import User
+from app.services.principal_cache import principal_cache
 
 security_scheme = HTTPBearer()
 
@@ -25,8 +25,8 @@ async def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="无效的认证凭据",
         )
-    result = await db.execute(select(User).where(User.id == uuid.UUID(user_id)))
-    user = result.scalar_one_or_none()
+    # 命中进程内缓存时不查询 users 表（禁用等变更提交后即失效）
+    user = await principal_cache.get_user(db, uuid.UUID(user_id))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -74,8 +74,10 @@ async def update_user_status(
         from fastapi import HTTPException, status
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用户不存在")
 
+    # 提交后各 worker 的当前用户缓存随之失效，禁用立即生效
     user.is_active = data.is_active
     await db.flush()
+    await db.refresh(user)
 
     await log_action(
         db,
@@ -179,6 +181,15 @@ class EmbeddingStatsResponse(BaseModel):
     skipped: int
 
 
+class EmbeddingCacheStatsResponse(BaseModel):
+    local_hits: int
+    redis_hits: int
+    misses: int
+    hit_rate: float
+    local_size: int
+    max_entries: int
+
+
 @router.post("/embeddings/generate", response_model=EmbeddingBatchResponse)
 async def generate_embeddings(
     data: EmbeddingBatchRequest = EmbeddingBatchRequest(),
@@ -243,6 +254,16 @@ async def embedding_stats(
     return EmbeddingStatsResponse(total=total, **stats)
 
 
+@router.get("/embeddings/cache-stats", response_model=EmbeddingCacheStatsResponse)
+async def embedding_cache_stats(
+    master: User = Depends(require_master),
+):
+    """获取查询向量缓存命中统计（当前进程）"""
+    from app.services.embedding_service import get_query_cache_stats
+
+    return EmbeddingCacheStatsResponse(**get_query_cache_stats())
+
+
 @router.get("/audit-logs")
 async def audit_logs(
     page: int = Query(1, ge=1),
@@ -16,6 +16,9 @@ from app.schemas.ai_model import (
     AIModelTestRequest,
     AIModelTestResponse,
     AIModelUpdate,
+    ExtractionStatsResponse,
+    ProviderGuardStatsResponse,
+    StreamThreadStatsResponse,
     UsageStatsResponse,
 )
 from app.schemas.common import MessageResponse
@@ -57,6 +60,36 @@ async def usage_stats(
     return await ai_model_service.get_usage_stats(db, start_date, end_date, model_id, user_id)
 
 
+@router.get("/provider-stats", response_model=list[ProviderGuardStatsResponse])
+async def provider_stats(
+    master: User = Depends(require_master),
+):
+    """获取各 LLM 上游的并发上限、排队与熔断状态（当前进程）"""
+    from app.adapters.guard import get_guard_stats
+
+    return [ProviderGuardStatsResponse(**s) for s in get_guard_stats()]
+
+
+@router.get("/stream-thread-stats", response_model=StreamThreadStatsResponse)
+async def stream_thread_stats(
+    master: User = Depends(require_master),
+):
+    """获取同步 SDK 流式调用线程池的占用与排队情况（当前进程）"""
+    from app.adapters.base import stream_threads
+
+    return StreamThreadStatsResponse(**stream_threads.snapshot())
+
+
+@router.get("/extraction-stats", response_model=list[ExtractionStatsResponse])
+async def extraction_stats(
+    master: User = Depends(require_master),
+):
+    """获取各模型对话信息提取的函数调用命中率与解析失败率（当前进程）"""
+    from app.services.conversation_service import get_extraction_stats
+
+    return [ExtractionStatsResponse(**s) for s in get_extraction_stats()]
+
+
 @router.get("/{model_id}", response_model=AIModelResponse)
 async def get_model(
     model_id: uuid.UUID,
@@ -8,6 +8,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api.deps import get_current_user
 from app.core.database import get_db
+from app.core.event_bus import publish_after_commit
 from app.models.user import User
 from app.schemas.common import MessageResponse, PaginatedResponse
 from app.schemas.conversation import (
@@ -92,6 +93,17 @@ async def send_message(
         db, conversation_id, current_user,
         content=data.content, audio_url=data.audio_url,
     )
+    # 同一对话的 WebSocket 观察者（可能在其他 worker）在提交后收到本轮消息
+    publish_after_commit(db, conversation_id, {"type": "user_message", "content": data.content})
+    publish_after_commit(db, conversation_id, {
+        "type": "assistant_message",
+        "content": result["message"].content,
+        "collected_info": result["collected_info"],
+        "confidence_scores": result["confidence_scores"],
+        "needs_confirmation": result["needs_confirmation"],
+        "completeness": result["completeness"],
+        "similar_cases": result.get("similar_cases", []),
+    })
     similar_cases = [
         SimilarCaseItem(**c) for c in result.get("similar_cases", [])
     ]
@@ -143,6 +155,11 @@ async def complete_conversation(
         db, conversation_id, current_user,
         confirmed=data.confirmed, corrections=data.corrections,
     )
+    publish_after_commit(db, conversation_id, {
+        "type": "completed",
+        "record_id": str(result["record_id"]),
+        "record_no": result["record_no"],
+    })
     return ConversationCompleteResponse(
         conversation=ConversationResponse.model_validate(result["conversation"]),
         record_id=result["record_id"],
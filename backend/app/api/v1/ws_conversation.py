@@ -1,15 +1,20 @@
 """AI 对话 WebSocket 端点"""
 
 import json
+import time
 import uuid
 import logging
+from contextlib import aclosing
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.database import AsyncSessionLocal
+from app.core.db_profiler import log_profile, profile_queries
+from app.core.event_bus import TurnPublisher, event_bus
 from app.core.security import decode_token
+from app.core.ws_manager import ConnectionClosed, WSConnection, ws_manager
 from app.models.user import User
 from app.schemas.conversation import (
     ConversationCompleteResponse,
@@ -55,11 +60,17 @@ async def conversation_ws(
     - {"type": "confirm", "confirmed": true, "corrections": {...}}
 
     出站消息格式:
-    - {"type": "stream_token", "content": "..."}
+    - {"type": "stream_token", "content": "..."}  （仅 reply 的解码文本）
+    - {"type": "info_delta", "collected_info": {"字段": 值}}  （extracted_info 字段闭合即推送）
     - {"type": "stream_end", "content": "...", "collected_info": {...}, ...}
     - {"type": "assistant_message", "content": "...", "collected_info": {...}, ...}
+    - {"type": "user_message", "content": "..."}  （其他设备 / REST 发送的用户消息）
+    - {"type": "completed", "record_id": "...", "record_no": "..."}
     - {"type": "pong"}
     - {"type": "error", "error": "..."}
+
+    同一对话的事件经对话事件总线广播，连接到任一 worker 的观察者都会收到
+    其他连接发起的回复（stream_token / info_delta / stream_end）与 REST 请求的结果。
     """
     if not token:
         await websocket.close(code=4001, reason="缺少认证 token")
@@ -87,6 +98,10 @@ async def conversation_ws(
         await websocket.accept()
         logger.info("WebSocket 连接建立: conversation=%s user=%s", conversation_id, user.id)
 
+    conn = ws_manager.connect(websocket, str(conversation_id))
+    # 订阅对话事件：其他设备、REST 请求或其他 worker 上的回复也推送到本连接
+    await event_bus.join(conn)
+    close_code = 1000
     try:
         while True:
             raw = await websocket.receive_text()
@@ -95,39 +110,28 @@ async def conversation_ws(
                 data = json.loads(raw)
                 msg = WSIncomingMessage(**data)
             except (json.JSONDecodeError, Exception) as e:
-                await websocket.send_json(
-                    WSOutgoingMessage(type="error", error=f"消息格式错误: {e}").model_dump()
-                )
+                await _send_model(conn, WSOutgoingMessage(type="error", error=f"消息格式错误: {e}"))
                 continue
 
             if msg.type == "ping":
-                await websocket.send_json(WSOutgoingMessage(type="pong").model_dump())
+                await _send_model(conn, WSOutgoingMessage(type="pong"))
+                continue
+
+            if msg.type in ("user_message", "confirm") and conn.busy:
+                await _send_model(
+                    conn, WSOutgoingMessage(type="error", error="上一条消息仍在处理中，请稍候")
+                )
                 continue
 
             if msg.type == "user_message":
                 if not msg.content:
-                    await websocket.send_json(
-                        WSOutgoingMessage(type="error", error="消息内容不能为空").model_dump()
-                    )
+                    await _send_model(conn, WSOutgoingMessage(type="error", error="消息内容不能为空"))
                     continue
 
-                # 使用独立 session 处理每条消息
-                async with AsyncSessionLocal() as db:
-                    try:
-                        async for chunk in conversation_service.send_message_stream(
-                            db, conversation_id, user,
-                            content=msg.content, audio_url=msg.audio_url,
-                        ):
-                            await websocket.send_json(
-                                WSOutgoingMessage(**chunk).model_dump(exclude_none=True)
-                            )
-                        await db.commit()
-                    except Exception as e:
-                        await db.rollback()
-                        logger.error("WebSocket 消息处理失败: %s", e)
-                        await websocket.send_json(
-                            WSOutgoingMessage(type="error", error=str(e)).model_dump()
-                        )
+                # 在独立任务中生成回复：读循环保持运行，断开时可立即取消上游 LLM 请求
+                conn.run_turn(_profiled(
+                    _stream_reply(conn, conversation_id, user, msg), conversation_id,
+                ))
 
             elif msg.type == "confirm":
                 async with AsyncSessionLocal() as db:
@@ -138,27 +142,88 @@ async def conversation_ws(
                             corrections=msg.corrections,
                         )
                         await db.commit()
-                        await websocket.send_json({
+                        completed = {
                             "type": "completed",
                             "record_id": str(result["record_id"]),
                             "record_no": result["record_no"],
-                        })
+                        }
+                        await conn.send_json(completed)
+                        event_bus.publish_soon(conversation_id, completed, origin=conn.id)
+                    except ConnectionClosed:
+                        raise
                     except Exception as e:
                         await db.rollback()
                         logger.error("WebSocket 确认保存失败: %s", e)
-                        await websocket.send_json(
-                            WSOutgoingMessage(type="error", error=str(e)).model_dump()
-                        )
+                        await _send_model(conn, WSOutgoingMessage(type="error", error=str(e)))
             else:
-                await websocket.send_json(
-                    WSOutgoingMessage(type="error", error=f"未知消息类型: {msg.type}").model_dump()
+                await _send_model(
+                    conn, WSOutgoingMessage(type="error", error=f"未知消息类型: {msg.type}")
                 )
 
     except WebSocketDisconnect:
         logger.info("WebSocket 断开: conversation=%s", conversation_id)
+    except ConnectionClosed:
+        logger.info("WebSocket 连接已关闭: conversation=%s", conversation_id)
     except Exception as e:
         logger.error("WebSocket 异常: %s", e)
+        close_code = 1011
+    finally:
+        # 断开时取消进行中的回复，aclosing 逐层关闭到适配器，中止上游 LLM 请求
+        await event_bus.leave(conn)
+        await ws_manager.disconnect(conn, code=close_code)
+
+
+async def _send_model(conn: WSConnection, message: WSOutgoingMessage, **dump_options) -> None:
+    await conn.send_frame(message.model_dump_json(**dump_options))
+
+
+async def _profiled(coro, conversation_id: uuid.UUID) -> None:
+    """统计一轮回复的 SQL（WebSocket 不经过 HTTP 中间件）"""
+    start = time.perf_counter()
+    with profile_queries() as profile:
         try:
-            await websocket.close(code=1011, reason="服务器内部错误")
-        except Exception:
-            pass
+            await coro
+        finally:
+            log_profile(
+                profile, (time.perf_counter() - start) * 1000,
+                channel="ws", conversation=str(conversation_id),
+            )
+
+
+async def _stream_reply(
+    conn: WSConnection, conversation_id: uuid.UUID, user: User, msg: WSIncomingMessage
+) -> None:
+    """一轮流式回复：token 进入合并缓冲，其他事件经发送队列，均不等待客户端接收
+
+    同时发布到对话事件总线，观察同一对话的其他连接（含其他 worker）同步收到。
+    """
+    publisher = TurnPublisher(event_bus, conversation_id, origin=conn.id)
+    # 使用独立 session 处理每条消息
+    async with AsyncSessionLocal() as db:
+        try:
+            async with aclosing(conversation_service.send_message_stream(
+                db, conversation_id, user,
+                content=msg.content, audio_url=msg.audio_url,
+            )) as stream:
+                async for chunk in stream:
+                    if not publisher.started:
+                        # 首个事件到达时用户消息已提交，再通知其他观察者
+                        publisher.event({"type": "user_message", "content": msg.content})
+                    if chunk["type"] == "stream_token":
+                        conn.send_token(chunk["content"])
+                        publisher.token(chunk["content"])
+                    else:
+                        await _send_model(conn, WSOutgoingMessage(**chunk), exclude_none=True)
+                        if chunk["type"] != "error":
+                            publisher.event(chunk)
+            await db.commit()
+        except ConnectionClosed:
+            await db.rollback()
+            logger.info("WebSocket 已关闭，放弃本轮回复: conversation=%s", conversation_id)
+        except Exception as e:
+            await db.rollback()
+            logger.error("WebSocket 消息处理失败: %s", e)
+            try:
+                await _send_model(conn, WSOutgoingMessage(type="error", error=str(e)))
+            except ConnectionClosed:
+                pass
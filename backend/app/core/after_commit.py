@@ -0,0 +1,76 @@
+"""事务提交后回调 — 把副作用（后台任务、缓存失效、对话事件）挂到当前事务
+
+- 业务代码通过 defer(db, key, item) 登记，事务提交后同一 key 的全部条目按登记顺序
+  交给 register(key, handler) 注册的处理函数；回滚则丢弃
+- 只在最外层事务提交后执行：保存点（begin_nested）释放同样触发 after_commit，此时不执行
+- 保存点回滚（如 _save_reply 版本冲突重试）同样触发 after_rollback，这里只丢弃在该保存点
+  及其内层登记的条目，保存点之前登记的保留到外层事务结束
+"""
+
+import logging
+from typing import Any, Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
+
+logger = logging.getLogger(__name__)
+
+# key -> 处理函数（签名: handler(items)，items 为该事务登记的全部条目）
+_handlers: dict[str, Callable[[list], None]] = {}
+
+_PENDING_KEY = "after_commit"
+
+
+def register(key: str, handler: Callable[[list], None]) -> None:
+    """注册 key 对应的提交后处理函数（同步调用，不应阻塞）"""
+    _handlers[key] = handler
+
+
+def defer(db: AsyncSession | Session, key: str, item: Any = None) -> None:
+    """登记一项，在 db 所在最外层事务提交后交给 key 的处理函数；回滚则丢弃"""
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    session.info.setdefault(_PENDING_KEY, []).append((transaction, key, item))
+
+
+def _within(transaction: SessionTransaction | None, boundary: SessionTransaction) -> bool:
+    while transaction is not None:
+        if transaction is boundary:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@event.listens_for(Session, "after_commit")
+def _run_on_commit(session: Session) -> None:
+    if session.get_nested_transaction() is not None:
+        return  # 保存点释放，等外层事务提交
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    grouped: dict[str, list] = {}
+    for _, key, item in pending:
+        grouped.setdefault(key, []).append(item)
+    for key, items in grouped.items():
+        try:
+            _handlers[key](items)
+        except Exception:
+            logger.exception("提交后回调 %s 执行失败", key)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_on_rollback(session: Session, previous_transaction: SessionTransaction) -> None:
+    pending = session.info.get(_PENDING_KEY)
+    if not pending:
+        return
+    # 实际回滚到的边界：最近的保存点或最外层事务（flush 失败时回滚的是其内部子事务）
+    boundary = previous_transaction
+    while boundary.parent is not None and not boundary.nested:
+        boundary = boundary.parent
+    if boundary.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+        return
+    session.info[_PENDING_KEY] = [
+        entry for entry in pending if not _within(entry[0], boundary)
+    ]
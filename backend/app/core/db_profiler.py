@@ -0,0 +1,198 @@
+"""SQL 查询分析 — 按请求统计查询条数与数据库耗时，记录慢查询与疑似 N+1
+
+- 在 Engine 类上监听 before / after_cursor_execute，覆盖应用与后台任务的所有 engine
+- 统计归属当前上下文的 QueryProfile（ContextVar）：HTTP 请求由 QueryProfileMiddleware
+  建立，WebSocket 每轮回复单独建立；嵌套的 profile 同时计入外层（测试用于断言查询预算）
+- 语句按指纹归类：去掉空白差异并把 IN 列表、多行 VALUES 的绑定参数折叠后取哈希，
+  同一语句不论参数取值都得到同一指纹；日志只记录参数类型，不记录取值
+- 超过 SLOW_QUERY_MS 的语句立即记 WARNING；同一指纹在一次请求中执行达到
+  SQL_REPEAT_WARN 次时在请求结束日志中标记为疑似 N+1
+- 响应带 Server-Timing 头（db 耗时与条数、app 总耗时），浏览器开发者工具可直接查看
+"""
+
+import hashlib
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterator
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+
+from app.core.config import get_settings
+from app.core.logging_config import kv
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_START_ATTR = "_sql_profile_start"
+STATEMENT_LOG_CHARS = 300
+
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*(?:\?|\$\d+|%\(\w+\)s|%s|:\w+)\s*,?)+\)", re.IGNORECASE)
+_VALUES_ROWS = re.compile(r"(\bVALUES\s*\([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+_POSTCOMPILE = re.compile(r"\(?__\[POSTCOMPILE_\w+\]\)?")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize_statement(statement: str) -> str:
+    """归一化语句：折叠空白、IN 列表与多行 VALUES"""
+    text = _WHITESPACE.sub(" ", statement).strip()
+    text = _POSTCOMPILE.sub("(?)", text)
+    text = _IN_LIST.sub("IN (?)", text)
+    return _VALUES_ROWS.sub(r"\1", text)
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement: str) -> str:
+    """语句指纹（与绑定参数取值无关）"""
+    return hashlib.sha1(normalize_statement(statement).encode()).hexdigest()[:12]
+
+
+def _param_shape(parameters, executemany: bool) -> str:
+    """绑定参数的类型签名，如 (UUID,str,int)；executemany 记为 行数×签名"""
+    if executemany and isinstance(parameters, (list, tuple)) and parameters:
+        return f"{len(parameters)}×{_param_shape(parameters[0], False)}"
+    if isinstance(parameters, dict):
+        values = parameters.values()
+    elif isinstance(parameters, (list, tuple)):
+        values = parameters
+    else:
+        return ""
+    return "(" + ",".join(type(v).__name__ for v in values) + ")"
+
+
+@dataclass
+class SlowQuery:
+    fingerprint: str
+    duration_ms: float
+    statement: str
+    params: str
+
+
+@dataclass
+class QueryProfile:
+    """一次请求（或一轮 WebSocket 回复、一个测试块）内的 SQL 统计"""
+
+    parent: "QueryProfile | None" = None
+    count: int = 0
+    total_ms: float = 0.0
+    slow: list[SlowQuery] = field(default_factory=list)
+    # 指纹 -> 执行次数 / 归一化语句
+    fingerprints: dict[str, int] = field(default_factory=dict)
+    statements: dict[str, str] = field(default_factory=dict)
+
+    def add(self, fp: str, statement: str, elapsed_ms: float, slow: SlowQuery | None) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.fingerprints[fp] = self.fingerprints.get(fp, 0) + 1
+        self.statements.setdefault(fp, statement)
+        if slow is not None:
+            self.slow.append(slow)
+
+    def repeated(self, threshold: int | None = None) -> list[tuple[str, int]]:
+        """执行次数达到阈值的指纹，按次数降序"""
+        threshold = threshold or settings.SQL_REPEAT_WARN
+        hits = [(fp, n) for fp, n in self.fingerprints.items() if n >= threshold]
+        return sorted(hits, key=lambda item: -item[1])
+
+
+_current: ContextVar[QueryProfile | None] = ContextVar("sql_query_profile", default=None)
+
+
+def current_profile() -> QueryProfile | None:
+    return _current.get()
+
+
+@contextmanager
+def profile_queries() -> Iterator[QueryProfile]:
+    """在当前上下文中统计 SQL；嵌套时同时计入外层"""
+    profile = QueryProfile(parent=_current.get())
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is not None:
+        setattr(context, _START_ATTR, time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    start = getattr(context, _START_ATTR, None)
+    if start is None:
+        return
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    profile = _current.get()
+    is_slow = elapsed_ms >= settings.SLOW_QUERY_MS
+    if profile is None and not is_slow:
+        return
+
+    fp = fingerprint(statement)
+    text = normalize_statement(statement)[:STATEMENT_LOG_CHARS]
+    slow = None
+    if is_slow:
+        slow = SlowQuery(fp, elapsed_ms, text, _param_shape(parameters, executemany))
+        logger.warning("慢查询 %s", kv(
+            fingerprint=fp, duration_ms=elapsed_ms, params=slow.params, statement=text,
+        ))
+    while profile is not None:
+        profile.add(fp, text, elapsed_ms, slow)
+        profile = profile.parent
+
+
+if settings.SQL_PROFILE_ENABLED:
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# ---- 输出 ----
+
+
+def server_timing(profile: QueryProfile, total_ms: float) -> str:
+    return (
+        f'db;dur={profile.total_ms:.1f};desc="{profile.count} queries", '
+        f"app;dur={total_ms:.1f}"
+    )
+
+
+def log_profile(profile: QueryProfile, total_ms: float, **fields) -> None:
+    """输出一行结构化统计；有慢查询或疑似 N+1 时记 WARNING，否则 DEBUG"""
+    repeated = profile.repeated()
+    level = logging.WARNING if profile.slow or repeated else logging.DEBUG
+    if not logger.isEnabledFor(level):
+        return
+    top = repeated[0][0] if repeated else None
+    logger.log(level, "SQL 分析 %s", kv(
+        **fields,
+        queries=profile.count,
+        db_ms=profile.total_ms,
+        total_ms=total_ms,
+        slow=len(profile.slow) or None,
+        n_plus_one=",".join(f"{fp}×{n}" for fp, n in repeated) or None,
+        statement=profile.statements[top] if top else None,
+    ))
+
+
+class QueryProfileMiddleware(BaseHTTPMiddleware):
+    """按请求统计 SQL，写入 Server-Timing 头与结构化日志"""
+
+    async def dispatch(self, request: Request, call_next):
+        start = time.perf_counter()
+        with profile_queries() as profile:
+            response = await call_next(request)
+        total_ms = (time.perf_counter() - start) * 1000
+        response.headers["Server-Timing"] = server_timing(profile, total_ms)
+        log_profile(
+            profile, total_ms,
+            method=request.method, path=request.url.path, status=response.status_code,
+        )
+        return response
@@ -0,0 +1,279 @@
+"""对话事件总线 — 经 Redis pub/sub 跨 worker 分发对话事件
+
+WebSocket 连接固定在接受它的 worker 上。为了让 REST 与 WS、多台设备看到同一对话的
+事件，并允许在非粘性负载均衡后横向扩展 worker，对话事件统一发布到频道
+conv:{conversation_id}:events：
+- 每个 worker 只用一个 pub/sub 连接，按本地 WebSocket 连接按需订阅 / 退订频道
+- 收到事件后投递给本 worker 订阅该对话的连接；发起本轮的连接已在本地直接收到，
+  按 origin 跳过，不重复推送
+- 流式 token 按 WS_TOKEN_FLUSH_MS 合并后再发布，不逐 token 往返 Redis
+- 发布经有界队列由后台任务按序发出（单次受 EVENT_BUS_PUBLISH_TIMEOUT 限制），
+  回复流程不等待 Redis；队列满时本事件只投递本 worker
+- 订阅失败的频道由监听任务定时重试
+- Redis 不可用时退回只投递本 worker 的连接
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import after_commit
+from app.core.config import get_settings
+from app.core.ws_manager import WSConnection, dumps_frame, ws_manager
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_AFTER_COMMIT_KEY = "pending_conversation_events"
+
+
+def channel_for(conversation_id: uuid.UUID | str) -> str:
+    return f"conv:{conversation_id}:events"
+
+
+def _conversation_of(channel: str) -> str:
+    return channel.split(":", 2)[1]
+
+
+class ConversationEventBus:
+    """对话事件的发布与本 worker 订阅管理"""
+
+    def __init__(self):
+        # 频道 -> 本 worker 订阅该对话的连接数
+        self._channels: dict[str, int] = {}
+        # 已成功订阅的频道（未在其中的由监听任务重试）
+        self._subscribed: set[str] = set()
+        self._pubsub = None
+        self._listener: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._publisher: asyncio.Task | None = None
+        self.stats = {
+            "published": 0, "received": 0, "delivered": 0,
+            "publish_errors": 0, "dropped": 0, "subscribe_errors": 0,
+        }
+
+    # ---- 订阅 ----
+
+    async def join(self, conn: WSConnection) -> None:
+        """连接开始观察对话；频道尚未订阅成功时（本 worker 第一个观察者或上次失败）订阅"""
+        channel = channel_for(conn.key)
+        self._channels[channel] = self._channels.get(channel, 0) + 1
+        if channel not in self._subscribed:
+            try:
+                await self._subscribe([channel])
+            except Exception as e:
+                self.stats["subscribe_errors"] += 1
+                logger.warning("订阅对话事件频道失败，稍后重试，暂时仅接收本 worker 事件: %s", e)
+        self._ensure_listener()
+        self._wakeup.set()
+
+    async def leave(self, conn: WSConnection) -> None:
+        channel = channel_for(conn.key)
+        count = self._channels.get(channel, 0) - 1
+        if count > 0:
+            self._channels[channel] = count
+            return
+        self._channels.pop(channel, None)
+        if channel in self._subscribed:
+            self._subscribed.discard(channel)
+            try:
+                await self._pubsub.unsubscribe(channel)
+            except Exception as e:
+                logger.debug("退订对话事件频道失败: %s", e)
+
+    async def _subscribe(self, channels: list[str]) -> None:
+        from app.core.redis import redis_client
+
+        if self._pubsub is None:
+            self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(*channels)
+        self._subscribed.update(channels)
+
+    def _ensure_listener(self) -> None:
+        if self._listener is None or self._listener.done():
+            self._wakeup = asyncio.Event()
+            self._listener = asyncio.get_running_loop().create_task(
+                self._listen(), name="conversation-event-listener"
+            )
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                missing = [c for c in self._channels if c not in self._subscribed]
+                if missing:
+                    await self._subscribe(missing)
+                    logger.info("对话事件频道重新订阅成功: %d 个", len(missing))
+                if not self._subscribed:
+                    # 无订阅时等待下一个观察者
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message and message.get("type") == "message":
+                    self.stats["received"] += 1
+                    self._dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 已订阅的频道由 redis-py 重连时自动重新订阅；订阅失败的下一轮重试
+                logger.debug("对话事件监听中断，稍后重试: %s", e)
+                await asyncio.sleep(1)
+
+    def _dispatch(self, channel: str, raw: str) -> None:
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return
+        self._deliver(_conversation_of(channel), data.get("event") or {}, data.get("origin"))
+
+    def _deliver(self, key: str, event_data: dict, origin: str | None) -> None:
+        """投递给本 worker 观察该对话的连接（跳过发起方连接）"""
+        frame = None
+        for conn in list(ws_manager.get(key)):
+            if conn.id == origin or conn.closed:
+                continue
+            if event_data.get("type") == "stream_token":
+                conn.send_token(event_data.get("content") or "")
+            else:
+                frame = frame or dumps_frame(event_data)
+                conn.send_nowait(frame)
+            self.stats["delivered"] += 1
+
+    # ---- 发布 ----
+
+    async def publish(
+        self, conversation_id: uuid.UUID | str, event_data: dict, origin: str | None = None
+    ) -> None:
+        """立即发布对话事件；origin 为发起方连接 id（该连接不再收到此事件）"""
+        from app.core.redis import redis_client
+
+        payload = dumps_frame({"origin": origin, "event": event_data})
+        try:
+            await asyncio.wait_for(
+                redis_client.publish(channel_for(conversation_id), payload),
+                settings.EVENT_BUS_PUBLISH_TIMEOUT,
+            )
+            self.stats["published"] += 1
+        except Exception as e:
+            self.stats["publish_errors"] += 1
+            logger.debug("发布对话事件失败，仅投递本 worker: %s", e)
+            self._deliver(str(conversation_id), event_data, origin)
+
+    def publish_soon(
+        self, conversation_id: uuid.UUID | str, event_data: dict, origin: str | None = None
+    ) -> None:
+        """同步接口：放入有界队列由后台按序发布（可在事务提交回调、token 循环中调用）"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._loop is not loop or self._publisher is None or self._publisher.done():
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=settings.EVENT_BUS_QUEUE_SIZE)
+            self._publisher = loop.create_task(self._drain(), name="conversation-event-publisher")
+        try:
+            self._queue.put_nowait((conversation_id, event_data, origin))
+        except asyncio.QueueFull:
+            # Redis 发布跟不上：本事件只投递本 worker，不阻塞回复流程
+            self.stats["dropped"] += 1
+            self._deliver(str(conversation_id), event_data, origin)
+
+    async def _drain(self) -> None:
+        while True:
+            conversation_id, event_data, origin = await self._queue.get()
+            try:
+                await self.publish(conversation_id, event_data, origin)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self._publisher is not None:
+            # 尽量发完队列中剩余的事件
+            if not self._publisher.done():
+                try:
+                    await asyncio.wait_for(self._queue.join(), settings.EVENT_BUS_PUBLISH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning("对话事件发布队列未能在关闭前发完，丢弃 %d 条", self._queue.qsize())
+            self._publisher.cancel()
+            await asyncio.gather(self._publisher, return_exceptions=True)
+            self._publisher = None
+        self._queue = None
+        self._loop = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+        self._channels.clear()
+        self._subscribed.clear()
+
+
+class TurnPublisher:
+    """一轮回复的事件发布：token 按合并间隔批量发布，其他事件先冲刷已缓冲的 token
+
+    只放入总线的发布队列，不等待 Redis。
+    """
+
+    def __init__(
+        self,
+        bus: ConversationEventBus,
+        conversation_id: uuid.UUID | str,
+        origin: str | None = None,
+        flush_interval: float | None = None,
+    ):
+        self.bus = bus
+        self.conversation_id = conversation_id
+        self.origin = origin
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else settings.WS_TOKEN_FLUSH_MS / 1000
+        )
+        self._tokens: list[str] = []
+        self._last_flush = time.monotonic()
+        self.started = False
+
+    def token(self, text: str) -> None:
+        self._tokens.append(text)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def event(self, event_data: dict) -> None:
+        self.started = True
+        self.flush()
+        self.bus.publish_soon(self.conversation_id, event_data, self.origin)
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if self._tokens:
+            content, self._tokens = "".join(self._tokens), []
+            self.bus.publish_soon(
+                self.conversation_id, {"type": "stream_token", "content": content}, self.origin
+            )
+
+
+event_bus = ConversationEventBus()
+
+
+def publish_after_commit(
+    db: AsyncSession, conversation_id: uuid.UUID | str, event_data: dict
+) -> None:
+    """登记对话事件，在 db 所在事务提交后发布；回滚则丢弃"""
+    after_commit.defer(db, _AFTER_COMMIT_KEY, (str(conversation_id), event_data))
+
+
+def _publish_pending_events(events: list[tuple[str, dict]]) -> None:
+    for conversation_id, event_data in events:
+        event_bus.publish_soon(conversation_id, event_data)
+
+
+after_commit.register(_AFTER_COMMIT_KEY, _publish_pending_events)
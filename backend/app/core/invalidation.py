@@ -0,0 +1,88 @@
+"""跨 worker 缓存失效广播 — 进程内缓存本地失效后经 Redis pub/sub 通知其他 worker
+
+AI 模型缓存、用户 / 记忆上下文缓存共用：
+- publish(messages)：在后台任务中发布，调用方不等待 Redis（可在事务提交回调中调用）；
+  失败只记录警告，其他 worker 在 TTL 后刷新
+- 监听任务轮询读取消息（空闲时不受 socket_timeout 影响），中断后 5 秒重连；
+  订阅建立前的广播可能已丢失，每次（重新）订阅后以 on_message(None) 全部失效一次
+"""
+
+import asyncio
+import logging
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 5.0
+
+
+class InvalidationChannel:
+    """一个失效广播频道：后台发布 + 常驻监听"""
+
+    def __init__(self, channel: str, label: str, on_message: Callable[[str | None], None]):
+        self.channel = channel
+        self.label = label
+        # 收到其他 worker 的失效消息时调用；None 表示需要全部失效
+        self.on_message = on_message
+        self._listener: asyncio.Task | None = None
+        self._publishes: set[asyncio.Task] = set()
+
+    def publish(self, messages: Iterable[str]) -> None:
+        """后台发布失效消息（同步接口）；无运行中的事件循环时只做本地失效"""
+        messages = list(messages)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        t = loop.create_task(self._publish(messages))
+        self._publishes.add(t)
+        t.add_done_callback(self._publishes.discard)
+
+    async def _publish(self, messages: list[str]) -> None:
+        from app.core.redis import redis_client
+
+        try:
+            for message in messages:
+                await redis_client.publish(self.channel, message)
+        except Exception as e:
+            logger.warning("%s失效广播失败，其他 worker 将在 TTL 后刷新: %s", self.label, e)
+
+    async def wait_published(self) -> None:
+        """等待已发起的广播完成（短生命周期的脚本退出前调用）"""
+        await asyncio.gather(*self._publishes)
+
+    def start(self) -> None:
+        """启动 pub/sub 监听（应用启动时调用）"""
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(
+                self._listen(), name=f"invalidation-listener:{self.channel}"
+            )
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+    async def _listen(self) -> None:
+        from app.core.redis import redis_client
+
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self.on_message(None)
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message.get("type") == "message":
+                        self.on_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("%s失效监听中断，稍后重连: %s", self.label, e)
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
@@ -48,6 +48,22 @@ def desensitize(text: str) -> str:
     return text
 
 
+def kv(**fields) -> str:
+    """结构化日志字段：key=value 以空格分隔，值含空白、引号或等号时加引号，None 省略"""
+    parts = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            text = f"{value:.1f}"
+        else:
+            text = str(value)
+        if not text or any(c in text for c in ' \t\n"='):
+            text = '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") + '"'
+        parts.append(f"{key}={text}")
+    return " ".join(parts)
+
+
 def setup_logging(debug: bool = False) -> None:
     """配置应用日志"""
     level = logging.DEBUG if debug else logging.INFO
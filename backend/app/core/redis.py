@@ -10,6 +10,8 @@ settings = get_settings()
 redis_client = aioredis.from_url(
     settings.REDIS_URL,
     decode_responses=True,
+    socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
 )
 
 PERMISSION_CACHE_TTL = 300  # 5 minutes
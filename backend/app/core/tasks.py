@@ -0,0 +1,442 @@
+"""后台任务队列 — 对话回复后的副作用（摘要、提醒、记忆、embedding）异步执行
+
+- 业务代码通过 enqueue_after_commit(db, name, **payload) 把任务挂到当前会话，
+  事务提交后才投递，回滚则丢弃，保证 worker 读得到刚写入的数据
+- 默认进程内 asyncio 队列 + 固定数量 worker；TASK_QUEUE_BACKEND=redis 时经
+  Redis 列表分发，多 worker 进程共同消费，处理完才确认，中断的任务会被重新投递
+- 每个任务使用独立 DB 会话，失败按指数退避重试
+- PeriodicJob 按固定间隔投递维护任务（对账、汇总等）
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.core import after_commit
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+TaskHandler = Callable[..., Awaitable[Any]]
+
+
+def _spawn_worker(loop: asyncio.AbstractEventLoop, coro, name: str) -> asyncio.Task:
+    """在空白上下文中启动常驻 worker，不继承首次投递所在请求的上下文变量（如 SQL 分析）"""
+    return contextvars.Context().run(loop.create_task, coro, name=name)
+
+# 任务名 -> 处理函数（签名: handler(db, **payload)）
+_handlers: dict[str, TaskHandler] = {}
+
+_AFTER_COMMIT_KEY = "pending_tasks"
+REDIS_QUEUE_KEY = "tasks:queue"
+
+
+def task(name: str) -> Callable[[TaskHandler], TaskHandler]:
+    """注册后台任务处理函数"""
+
+    def decorator(func: TaskHandler) -> TaskHandler:
+        _handlers[name] = func
+        return func
+
+    return decorator
+
+
+@dataclass
+class Job:
+    name: str
+    payload: dict = field(default_factory=dict)
+    attempt: int = 0
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"id": self.id, "name": self.name, "payload": self.payload, "attempt": self.attempt},
+            ensure_ascii=False,
+        )
+
+    @classmethod
+    def loads(cls, raw: str) -> "Job":
+        data = json.loads(raw)
+        return cls(
+            name=data["name"],
+            payload=data.get("payload") or {},
+            attempt=data.get("attempt", 0),
+            id=data.get("id") or uuid.uuid4().hex,
+        )
+
+
+def _jsonable(value: Any) -> Any:
+    """任务参数需可 JSON 序列化（Redis 后端），UUID 转为字符串"""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+class InProcessTaskQueue:
+    """进程内任务队列：有界 asyncio.Queue + 固定数量 worker"""
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_size: int = 1000,
+        max_retries: int = 3,
+        retry_base_delay: float = 0.5,
+        session_factory: async_sessionmaker | None = None,
+    ):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self._session_factory = session_factory
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._retries: set[asyncio.Task] = set()
+        self.stats = {"completed": 0, "failed": 0, "retried": 0, "dropped": 0}
+
+    @property
+    def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            from app.core.database import AsyncSessionLocal
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory
+
+    @session_factory.setter
+    def session_factory(self, factory: async_sessionmaker) -> None:
+        self._session_factory = factory
+
+    # ---- 生命周期 ----
+
+    def start(self) -> None:
+        """在当前事件循环启动 worker（首次投递时自动调用）"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._retries = set()
+        self._workers = [
+            _spawn_worker(loop, self._worker(), f"task-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def join(self, timeout: float | None = None) -> None:
+        """等待已投递任务（含待重试任务）全部处理完"""
+        if self._queue is None:
+            return
+
+        async def _drain():
+            while True:
+                await self._queue.join()
+                if not self._retries:
+                    return
+                await asyncio.gather(*list(self._retries), return_exceptions=True)
+
+        await asyncio.wait_for(_drain(), timeout)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """停止 worker；先在超时内尽量处理完积压任务"""
+        if not self._workers:
+            return
+        try:
+            await self.join(timeout)
+        except asyncio.TimeoutError:
+            logger.warning("后台任务未在 %.0fs 内处理完，剩余 %d 个将被丢弃",
+                           timeout, self._queue.qsize())
+        for t in [*self._workers, *self._retries]:
+            t.cancel()
+        await asyncio.gather(*self._workers, *self._retries, return_exceptions=True)
+        self._workers = []
+        self._retries = set()
+
+    # ---- 投递 ----
+
+    def submit(self, job: Job) -> None:
+        """投递任务（同步接口，可在事务提交回调中调用）"""
+        self.start()
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning("后台任务队列已满，丢弃任务 %s", job.name)
+
+    def _schedule_retry(self, job: Job) -> None:
+        job.attempt += 1
+        self.stats["retried"] += 1
+        delay = self.retry_base_delay * (2 ** (job.attempt - 1))
+
+        async def _later():
+            await asyncio.sleep(delay)
+            self.submit(job)
+
+        t = asyncio.get_running_loop().create_task(_later())
+        self._retries.add(t)
+        t.add_done_callback(self._retries.discard)
+
+    # ---- 执行 ----
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self.run_job(job)
+            finally:
+                self._queue.task_done()
+
+    async def run_job(self, job: Job) -> bool:
+        """在独立会话中执行任务，成功提交，失败回滚并按需重试"""
+        handler = _handlers.get(job.name)
+        if handler is None:
+            self.stats["failed"] += 1
+            logger.error("未注册的后台任务: %s", job.name)
+            return False
+
+        async with self.session_factory() as db:
+            try:
+                await handler(db, **job.payload)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                if job.attempt < self.max_retries:
+                    logger.warning("后台任务 %s 失败（第 %d 次），稍后重试: %s",
+                                   job.name, job.attempt + 1, e)
+                    self._schedule_retry(job)
+                else:
+                    self.stats["failed"] += 1
+                    logger.error("后台任务 %s 重试 %d 次后仍失败: %s",
+                                 job.name, job.attempt, e)
+                return False
+
+        self.stats["completed"] += 1
+        return True
+
+
+class RedisTaskQueue(InProcessTaskQueue):
+    """Redis 列表分发的任务队列：任一进程投递，所有进程的 worker 竞争消费
+
+    - worker 以 BLMOVE 把任务原子地移入自己的处理中列表，处理完（含失败后已安排重试）
+      才从中删除；进程崩溃或部署中断时任务留在处理中列表
+    - 每个进程定时在 {queue}:workers 上报心跳，心跳超时的 worker 的处理中列表
+      由任一存活进程移回队列头部重新消费（启动时及此后每次心跳都会检查）
+    - 正常停止时把未处理完的任务立即移回队列
+    - Redis 不可用时退回进程内执行，任务不丢失
+    """
+
+    HEARTBEAT_INTERVAL = 10
+    WORKER_TIMEOUT = 60
+
+    def __init__(self, *args, queue_key: str = REDIS_QUEUE_KEY, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue_key = queue_key
+        self.workers_key = f"{queue_key}:workers"
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._pushes: set[asyncio.Task] = set()
+        self.stats["recovered"] = 0
+
+    def processing_key(self, worker_id: str) -> str:
+        return f"{self.queue_key}:processing:{worker_id}"
+
+    @property
+    def worker_ids(self) -> list[str]:
+        return [f"{self.instance_id}:{i}" for i in range(self.workers)]
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        super().start()
+        self._workers.extend(
+            _spawn_worker(loop, self._redis_worker(worker_id), f"task-redis-worker-{i}")
+            for i, worker_id in enumerate(self.worker_ids)
+        )
+        self._workers.append(_spawn_worker(loop, self._heartbeat(), "task-redis-heartbeat"))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        await super().stop(timeout)
+        from app.core.redis import redis_client
+
+        try:
+            for worker_id in self.worker_ids:
+                await self._requeue(redis_client, worker_id)
+            await redis_client.zrem(self.workers_key, *self.worker_ids)
+        except Exception as e:
+            logger.warning("停止时归还处理中的任务失败，将由其他进程在心跳超时后恢复: %s", e)
+
+    def submit(self, job: Job) -> None:
+        self.start()
+        t = asyncio.get_running_loop().create_task(self._push(job))
+        self._pushes.add(t)
+        t.add_done_callback(self._pushes.discard)
+
+    async def _push(self, job: Job) -> None:
+        from app.core.redis import redis_client
+
+        try:
+            await redis_client.lpush(self.queue_key, job.dumps())
+        except Exception as e:
+            logger.warning("Redis 任务投递失败，改为进程内执行 %s: %s", job.name, e)
+            super().submit(job)
+
+    async def join(self, timeout: float | None = None) -> None:
+        if self._pushes:
+            await asyncio.wait_for(
+                asyncio.gather(*list(self._pushes), return_exceptions=True), timeout
+            )
+        await super().join(timeout)
+
+    # ---- 心跳与恢复 ----
+
+    async def _heartbeat(self) -> None:
+        from app.core.redis import redis_client
+
+        while True:
+            try:
+                now = time.time()
+                await redis_client.zadd(self.workers_key, {w: now for w in self.worker_ids})
+                await self.recover_orphans(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("任务队列心跳失败: %s", e)
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+
+    async def recover_orphans(self, now: float | None = None) -> int:
+        """把心跳超时的 worker 处理中的任务移回队列，返回恢复的任务数"""
+        from app.core.redis import redis_client
+
+        cutoff = (now or time.time()) - self.WORKER_TIMEOUT
+        recovered = 0
+        for worker_id in await redis_client.zrangebyscore(self.workers_key, "-inf", cutoff):
+            recovered += await self._requeue(redis_client, worker_id)
+            await redis_client.zrem(self.workers_key, worker_id)
+        if recovered:
+            self.stats["recovered"] += recovered
+            logger.warning("已恢复 %d 个中断的后台任务", recovered)
+        return recovered
+
+    async def _requeue(self, redis_client, worker_id: str) -> int:
+        """处理中列表逐条原子移回队列的出队端，优先重新处理"""
+        moved = 0
+        while await redis_client.lmove(
+            self.processing_key(worker_id), self.queue_key, "RIGHT", "RIGHT"
+        ) is not None:
+            moved += 1
+        return moved
+
+    # ---- 消费 ----
+
+    async def _redis_worker(self, worker_id: str) -> None:
+        from app.core.redis import redis_client
+
+        processing = self.processing_key(worker_id)
+        while True:
+            try:
+                raw = await redis_client.blmove(
+                    self.queue_key, processing, timeout=5, src="RIGHT", dest="LEFT"
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("Redis 任务拉取失败: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not raw:
+                continue
+            try:
+                job = Job.loads(raw)
+            except (ValueError, KeyError) as e:
+                logger.error("无法解析后台任务: %s", e)
+            else:
+                await self.run_job(job)
+            # 确认：处理完成（失败时 run_job 已按需重新投递）后才移出处理中列表
+            try:
+                await redis_client.lrem(processing, 1, raw)
+            except Exception as e:
+                logger.warning("后台任务确认失败，可能被重复执行: %s", e)
+
+
+def create_task_queue() -> InProcessTaskQueue:
+    kwargs = {
+        "workers": settings.TASK_QUEUE_WORKERS,
+        "max_size": settings.TASK_QUEUE_MAX_SIZE,
+        "max_retries": settings.TASK_QUEUE_MAX_RETRIES,
+    }
+    if settings.TASK_QUEUE_BACKEND == "redis":
+        return RedisTaskQueue(**kwargs)
+    return InProcessTaskQueue(**kwargs)
+
+
+task_queue = create_task_queue()
+
+
+class PeriodicJob:
+    """按固定间隔投递任务；多 worker 进程通过 Redis 锁保证每个周期只投递一次
+
+    run_without_lock=True 时 Redis 不可用也照常投递（适用于幂等任务）。
+    """
+
+    def __init__(self, name: str, interval: float, run_without_lock: bool = False):
+        self.name = name
+        self.interval = interval
+        self.run_without_lock = run_without_lock
+        self._task: asyncio.Task | None = None
+
+    @property
+    def lock_key(self) -> str:
+        return f"tasks:periodic:{self.name}"
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(
+                self._run(), name=f"periodic-{self.name}"
+            )
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _acquire(self) -> bool:
+        from app.core.redis import redis_client
+
+        try:
+            return bool(await redis_client.set(
+                self.lock_key, "1", nx=True, ex=max(int(self.interval) - 1, 1)
+            ))
+        except Exception as e:
+            logger.debug("定时任务 %s 加锁失败（Redis 不可用）: %s", self.name, e)
+            return self.run_without_lock
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if await self._acquire():
+                task_queue.submit(Job(name=self.name))
+
+
+def enqueue_after_commit(db: AsyncSession, name: str, **payload: Any) -> None:
+    """登记后台任务，在 db 所在事务提交后投递；事务回滚则丢弃"""
+    job = Job(name=name, payload={k: _jsonable(v) for k, v in payload.items()})
+    after_commit.defer(db, _AFTER_COMMIT_KEY, job)
+
+
+def _dispatch_pending_tasks(jobs: list[Job]) -> None:
+    for job in jobs:
+        try:
+            task_queue.submit(job)
+        except RuntimeError as e:  # 无运行中的事件循环
+            logger.warning("后台任务 %s 投递失败: %s", job.name, e)
+
+
+after_commit.register(_AFTER_COMMIT_KEY, _dispatch_pending_tasks)
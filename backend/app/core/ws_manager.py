@@ -0,0 +1,254 @@
+"""WebSocket 连接管理 — 每个连接一个有界发送队列与写任务
+
+LLM 流式输出不再逐 token 等待 websocket 发送完成，弱网客户端不会反压上游生成：
+- token 先进入合并缓冲，每 WS_TOKEN_FLUSH_MS 毫秒合并为一帧发送；
+  写任务落后时缓冲自然累积，发送帧数随之减少
+- token 帧按固定模板直接拼接 JSON，不逐 token 构建 Pydantic 模型
+- 其他事件进入有界队列（WS_SEND_QUEUE_SIZE），发送前先把已缓冲的 token 入队，保证顺序；
+  队列满且 WS_SEND_TIMEOUT 内仍无空位时判定客户端过慢，关闭连接
+- 连接断开（发送失败或读到断开）时取消该连接正在进行的对话轮次，
+  取消沿 aclosing 传到适配器，中止上游 LLM 请求
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable
+
+from fastapi import WebSocket
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_TOKEN_FRAME_PREFIX = '{"type":"stream_token","content":'
+
+
+def token_frame(text: str) -> str:
+    """预序列化的 stream_token 帧"""
+    return _TOKEN_FRAME_PREFIX + json.dumps(text, ensure_ascii=False) + "}"
+
+
+def dumps_frame(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class ConnectionClosed(Exception):
+    """连接已关闭（客户端断开或发送过慢被关闭）"""
+
+
+class WSConnection:
+    """单个 WebSocket 连接：合并 token、有界队列、独立写任务"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        key: str,
+        max_queue: int | None = None,
+        flush_interval: float | None = None,
+        send_timeout: float | None = None,
+    ):
+        self.websocket = websocket
+        self.key = key
+        self.id = uuid.uuid4().hex
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else settings.WS_TOKEN_FLUSH_MS / 1000
+        )
+        self.send_timeout = send_timeout if send_timeout is not None else settings.WS_SEND_TIMEOUT
+        self._queue: asyncio.Queue[str] = asyncio.Queue(
+            maxsize=max_queue if max_queue is not None else settings.WS_SEND_QUEUE_SIZE
+        )
+        self._tokens: list[str] = []
+        self._token_deadline = 0.0
+        self._wakeup = asyncio.Event()
+        self._writer: asyncio.Task | None = None
+        self._turn: asyncio.Task | None = None
+        self._closer: asyncio.Task | None = None
+        self.closed = False
+        self.stats = {"frames": 0, "tokens": 0, "token_frames": 0, "dropped_slow": 0}
+
+    # ---- 生命周期 ----
+
+    def start(self) -> None:
+        self._writer = asyncio.get_running_loop().create_task(
+            self._write_loop(), name=f"ws-writer:{self.key}"
+        )
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        """停止写任务、取消进行中的轮次并关闭底层连接"""
+        if self.closed:
+            return
+        self._mark_closed()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def drain(self, timeout: float | None = None) -> None:
+        """等待已入队的帧与缓冲的 token 全部发出"""
+        deadline = time.monotonic() + (timeout if timeout is not None else self.send_timeout)
+        while (self._queue.qsize() or self._tokens) and not self.closed:
+            if time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.01)
+
+    def _mark_closed(self) -> None:
+        self.closed = True
+        self._wakeup.set()
+        # 轮次自身因发送过慢关闭连接时不取消自己，由其收到 ConnectionClosed 后退出
+        if self.busy and self._turn is not asyncio.current_task():
+            self._turn.cancel()
+
+    # ---- 对话轮次 ----
+
+    @property
+    def busy(self) -> bool:
+        return self._turn is not None and not self._turn.done()
+
+    def run_turn(self, coro: Awaitable[Any]) -> asyncio.Task:
+        """在独立任务中执行一轮对话，连接断开时取消"""
+        self._turn = asyncio.get_running_loop().create_task(coro, name=f"ws-turn:{self.key}")
+        return self._turn
+
+    async def cancel_turn(self) -> None:
+        if self.busy:
+            self._turn.cancel()
+            await asyncio.gather(self._turn, return_exceptions=True)
+
+    # ---- 发送 ----
+
+    def send_token(self, text: str) -> None:
+        """缓冲一个 token，由写任务按合并间隔成帧发送（不等待）"""
+        if self.closed:
+            raise ConnectionClosed(self.key)
+        if not text:
+            return
+        if not self._tokens:
+            self._token_deadline = time.monotonic() + self.flush_interval
+            self._wakeup.set()
+        self._tokens.append(text)
+        self.stats["tokens"] += 1
+
+    async def send_json(self, data: dict) -> None:
+        await self.send_frame(dumps_frame(data))
+
+    async def send_frame(self, frame: str) -> None:
+        """发送预序列化的帧；队列满时最多等待 send_timeout，超时判定客户端过慢"""
+        if self.closed:
+            raise ConnectionClosed(self.key)
+        # 已缓冲的 token 先于本帧入队，保证顺序
+        if self._tokens:
+            await self._put(self._take_tokens())
+        await self._put(frame)
+
+    def send_nowait(self, frame: str) -> None:
+        """不等待的发送（事件总线投递用）：队列已满说明客户端过慢，关闭连接"""
+        if self.closed:
+            return
+        try:
+            if self._tokens:
+                self._queue.put_nowait(self._take_tokens())
+            self._queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.stats["dropped_slow"] += 1
+            logger.warning("WebSocket 客户端接收过慢，关闭连接: %s", self.key)
+            if self._closer is None:
+                self._closer = asyncio.get_running_loop().create_task(
+                    self.close(code=1013, reason="客户端接收过慢")
+                )
+            return
+        self._wakeup.set()
+
+    def _take_tokens(self) -> str:
+        frame = token_frame("".join(self._tokens))
+        self._tokens = []
+        self.stats["token_frames"] += 1
+        return frame
+
+    async def _put(self, frame: str) -> None:
+        try:
+            self._queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(frame), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.stats["dropped_slow"] += 1
+                logger.warning("WebSocket 客户端接收过慢，关闭连接: %s", self.key)
+                await self.close(code=1013, reason="客户端接收过慢")
+                raise ConnectionClosed(self.key) from None
+        self._wakeup.set()
+
+    async def _write_loop(self) -> None:
+        # 缓冲中的 token 总是晚于队列中的帧：先发完队列，再按合并间隔发送 token
+        try:
+            while not self.closed:
+                self._wakeup.clear()
+                if not self._queue.empty():
+                    frame = self._queue.get_nowait()
+                elif self._tokens and time.monotonic() >= self._token_deadline:
+                    frame = self._take_tokens()
+                else:
+                    timeout = (
+                        max(self._token_deadline - time.monotonic(), 0) if self._tokens else None
+                    )
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.websocket.send_text(frame)
+                self.stats["frames"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 发送失败即视为断开
+            logger.info("WebSocket 发送失败，连接关闭: %s (%s)", self.key, e)
+            self._mark_closed()
+
+
+class ConnectionManager:
+    """进程内 WebSocket 连接注册表（按对话分组）"""
+
+    def __init__(self):
+        self._connections: dict[str, set[WSConnection]] = {}
+
+    def connect(self, websocket: WebSocket, key: str) -> WSConnection:
+        conn = WSConnection(websocket, key)
+        conn.start()
+        self._connections.setdefault(key, set()).add(conn)
+        return conn
+
+    async def disconnect(self, conn: WSConnection, code: int = 1000) -> None:
+        await conn.cancel_turn()
+        await conn.close(code=code)
+        group = self._connections.get(conn.key)
+        if group is not None:
+            group.discard(conn)
+            if not group:
+                self._connections.pop(conn.key, None)
+
+    def get(self, key: str) -> set[WSConnection]:
+        return self._connections.get(key, set())
+
+    async def close_all(self) -> None:
+        """应用关闭时断开全部连接"""
+        for group in list(self._connections.values()):
+            for conn in list(group):
+                await self.disconnect(conn, code=1001)
+
+    def stats(self) -> dict:
+        conns = [c for group in self._connections.values() for c in group]
+        return {
+            "connections": len(conns),
+            "queued_frames": sum(c._queue.qsize() for c in conns),
+            "busy_turns": sum(1 for c in conns if c.busy),
+        }
+
+
+ws_manager = ConnectionManager()
@@ -10,7 +10,7 @@ from app.models.record_version import RecordVersion
 from app.models.record_permission import RecordPermission
 from app.models.audit_log import AuditLog
 from app.models.soul import MemoryEntry, SoulConfig
-from app.models.ai_model import AIModel, AIUsageLog
+from app.models.ai_model import AIModel, AIUsageLog, AIUsageRollup, AIUsageRollupWatermark
 from app.models.conversation import Conversation, ConversationMessage
 from app.models.search_config import SearchConfig
 from app.models.reminder import Reminder
@@ -34,6 +34,8 @@ __all__ = [
     "MemoryEntry",
     "AIModel",
     "AIUsageLog",
+    "AIUsageRollup",
+    "AIUsageRollupWatermark",
     "Conversation",
     "ConversationMessage",
     "SearchConfig",
@@ -2,7 +2,21 @@
 
 import uuid
 
-from sqlalchemy import JSON, Boolean, ForeignKey, Index, Integer, Numeric, String, Text
+from datetime import datetime
+
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Boolean,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    Numeric,
+    String,
+    Text,
+    UniqueConstraint,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -51,13 +65,52 @@ class AIUsageLog(UUIDMixin, CreatedAtMixin, Base):
     request_tokens: Mapped[int] = mapped_column(Integer, default=0)
     response_tokens: Mapped[int] = mapped_column(Integer, default=0)
     total_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0, server_default="0")  # 命中厂商 prompt 缓存的输入 token
     cost: Mapped[float] = mapped_column(Numeric(10, 4), default=0)
     latency_ms: Mapped[int] = mapped_column(Integer, default=0)
     status: Mapped[str] = mapped_column(String(20), default="success")
     error_message: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # 本轮 prompt 各部分 token 数，如 {"system": 1800, "history": 900, "total": 3100, ...}
+    prompt_tokens_detail: Mapped[dict | None] = mapped_column(JSON, nullable=True)
 
     __table_args__ = (
         Index("idx_usage_logs_model", "model_id"),
         Index("idx_usage_logs_user", "user_id"),
         Index("idx_usage_logs_created", "created_at"),
     )
+
+
+class AIUsageRollup(UUIDMixin, Base):
+    """AI 使用量汇总表（按小时 / 天预聚合 ai_usage_logs）"""
+
+    __tablename__ = "ai_usage_rollups"
+
+    period: Mapped[str] = mapped_column(String(10), nullable=False)  # hour | day
+    bucket_start: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    model_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), nullable=False)
+    user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    requests: Mapped[int] = mapped_column(Integer, default=0)
+    request_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    response_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    total_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    cached_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    cost: Mapped[float] = mapped_column(Numeric(14, 4), default=0)
+    latency_ms_sum: Mapped[int] = mapped_column(BigInteger, default=0)  # 平均延迟 = 总和 / requests
+
+    __table_args__ = (
+        UniqueConstraint(
+            "period", "bucket_start", "model_id", "user_id", "status",
+            name="uq_usage_rollups_bucket",
+        ),
+        Index("idx_usage_rollups_period_bucket", "period", "bucket_start"),
+    )
+
+
+class AIUsageRollupWatermark(Base):
+    """汇总进度：各粒度已汇总到的时间点（不含）"""
+
+    __tablename__ = "ai_usage_rollup_watermarks"
+
+    period: Mapped[str] = mapped_column(String(10), primary_key=True)
+    rolled_until: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
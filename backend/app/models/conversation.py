@@ -1,8 +1,9 @@
 """AI 对话会话和消息表"""
 
 import uuid
+from datetime import datetime
 
-from sqlalchemy import ForeignKey, Index, Integer, String, Text
+from sqlalchemy import DateTime, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -34,6 +35,15 @@ class Conversation(UUIDMixin, TimestampMixin, Base):
     confidence_scores: Mapped[dict] = mapped_column(JSONB, nullable=False, default=dict)
     tags: Mapped[list] = mapped_column(JSONB, nullable=False, default=list)
     summary: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # 消息计数（新增消息时维护，摘要触发判断无需 COUNT）
+    message_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # 摘要水位：摘要覆盖到的消息数与最后一条被覆盖消息的时间
+    summary_message_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    summarized_until: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    # 乐观锁版本号：每次 UPDATE 自增，并发修改时后提交者收到 StaleDataError
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
 
     # Relationships
     user = relationship("User", foreign_keys=[user_id])
@@ -51,6 +61,7 @@ class Conversation(UUIDMixin, TimestampMixin, Base):
         Index("idx_conversations_status", "status"),
         Index("idx_conversations_created", "created_at"),
     )
+    __mapper_args__ = {"version_id_col": version}
 
 
 class ConversationMessage(UUIDMixin, CreatedAtMixin, Base):
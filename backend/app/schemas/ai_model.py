@@ -25,6 +25,8 @@ class ModelConfig(BaseModel):
     max_tokens: int = Field(2048, ge=1, le=128000)
     top_p: float = Field(1.0, ge=0, le=1)
     timeout: int = Field(60, ge=5, le=300)
+    # 优先承担的任务（chat: 对话与信息提取；summary: 对话摘要），为空则按默认 / 备用模型参与路由
+    tasks: list[str] | None = None
 
 
 class UsageLimit(BaseModel):
@@ -108,7 +110,52 @@ class UsageStatsResponse(BaseModel):
     model_name: str | None = None
     total_requests: int = 0
     total_tokens: int = 0
+    cached_tokens: int = 0
+    cache_hit_rate: float = 0.0  # 命中缓存的输入 token 占比
     total_cost: float = 0.0
     success_count: int = 0
     error_count: int = 0
     avg_latency_ms: float = 0.0
+
+
+class ProviderGuardStatsResponse(BaseModel):
+    """LLM 上游并发限制与熔断状态（当前进程）"""
+
+    key: str
+    state: str  # closed / open / half_open
+    limit: int
+    in_flight: int
+    waiting: int
+    calls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    slow_calls: int = 0
+    rejected_open: int = 0
+    rejected_overload: int = 0
+    queued: int = 0
+    queue_ms_total: float = 0.0
+    queue_ms_max: float = 0.0
+    queue_ms_avg: float = 0.0
+
+
+class StreamThreadStatsResponse(BaseModel):
+    """同步 SDK 流式调用线程池占用（当前进程）"""
+
+    max_threads: int
+    active: int  # 进行中的流
+    waiting: int  # 等待空闲线程的流
+    peak: int
+    waited: int  # 累计因线程用尽而排队的流
+
+
+class ExtractionStatsResponse(BaseModel):
+    """对话信息提取的解析统计（当前进程）"""
+
+    model_id: uuid.UUID
+    model_name: str
+    mode: str  # tools（函数调用）/ json（JSON 信封）
+    turns: int
+    tool_calls: int  # 由函数调用参数取得
+    fallbacks: int  # 函数调用模式下退回文本解析
+    failures: int  # 无法解析，原文作为回复
+    failure_rate: float
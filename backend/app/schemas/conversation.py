@@ -137,7 +137,7 @@ class WSIncomingMessage(BaseModel):
 
 
 class WSOutgoingMessage(BaseModel):
-    type: str  # assistant_message | pong | error | info_update | stream_token | stream_end
+    type: str  # assistant_message | user_message | completed | pong | error | info_update | info_delta | stream_token | stream_end
     content: str | None = None
     collected_info: dict | None = None
     confidence_scores: dict | None = None
@@ -0,0 +1,131 @@
+"""AI 模型配置进程内缓存
+
+对话、摘要、限额检查每次都要读取默认模型配置。这里把启用中的模型一次性
+加载为脱离会话的快照，稳态下每轮对话不再查询 ai_models 表：
+- 版本号：每次失效递增；加载期间版本变化则丢弃本次结果，避免旧数据回填
+- 跨 worker 失效：模型增删改在事务提交后经 Redis pub/sub 广播，
+  各进程的监听任务收到后清空本地缓存
+- MODEL_CACHE_TTL 兜底：Redis 不可用、广播丢失时最多延迟一个 TTL 生效
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import after_commit
+from app.core.config import get_settings
+from app.core.invalidation import InvalidationChannel
+from app.models.ai_model import AIModel
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+INVALIDATE_CHANNEL = "ai_models:invalidate"
+_AFTER_COMMIT_KEY = "invalidate_ai_model_cache"
+
+
+def _snapshot(model: AIModel) -> AIModel:
+    """复制为不属于任何会话的瞬态对象，跨请求读取不会触发懒加载"""
+    return AIModel(**{c.key: getattr(model, c.key) for c in AIModel.__table__.columns})
+
+
+class AIModelCache:
+    """启用中 AI 模型的进程内缓存（只读快照，不可 add 回会话）"""
+
+    def __init__(self, ttl: float | None = None):
+        self.ttl = ttl if ttl is not None else settings.MODEL_CACHE_TTL
+        self.version = 0
+        self._models: dict[uuid.UUID, AIModel] = {}
+        self._default_id: uuid.UUID | None = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.channel = InvalidationChannel(INVALIDATE_CHANNEL, "AI 模型缓存", self._on_message)
+        self.stats = {"hits": 0, "loads": 0, "invalidations": 0}
+
+    @property
+    def _fresh(self) -> bool:
+        return self._expires_at > time.monotonic()
+
+    async def _load(self, db: AsyncSession) -> None:
+        version = self.version
+        result = await db.execute(select(AIModel).where(AIModel.is_active == True))
+        models = {m.id: _snapshot(m) for m in result.scalars().all()}
+        self.stats["loads"] += 1
+        if version != self.version:
+            return  # 加载期间已失效，不回填旧数据
+        self._models = models
+        self._default_id = next((m.id for m in models.values() if m.is_default), None)
+        self._expires_at = time.monotonic() + self.ttl
+
+    async def _ensure_loaded(self, db: AsyncSession) -> None:
+        if self._fresh:
+            self.stats["hits"] += 1
+            return
+        async with self._lock:
+            if not self._fresh:
+                await self._load(db)
+
+    async def get_default(self, db: AsyncSession) -> AIModel | None:
+        """当前默认模型；未配置时返回 None（未配置不缓存，配置后立即生效）"""
+        await self._ensure_loaded(db)
+        if self._default_id is None:
+            self._expires_at = 0.0
+            return None
+        return self._models.get(self._default_id)
+
+    async def get_active(self, db: AsyncSession) -> list[AIModel]:
+        """全部启用中的模型（默认模型在前），供多模型路由使用"""
+        await self._ensure_loaded(db)
+        if not self._models:
+            self._expires_at = 0.0
+        return sorted(self._models.values(), key=lambda m: not m.is_default)
+
+    async def get(self, db: AsyncSession, model_id: uuid.UUID) -> AIModel | None:
+        """按 id 获取模型；已停用的模型不在缓存中，直接查库"""
+        await self._ensure_loaded(db)
+        model = self._models.get(model_id)
+        if model is not None:
+            return model
+        result = await db.execute(select(AIModel).where(AIModel.id == model_id))
+        model = result.scalar_one_or_none()
+        return _snapshot(model) if model else None
+
+    def invalidate(self) -> None:
+        """清空本进程缓存"""
+        self.version += 1
+        self._models = {}
+        self._default_id = None
+        self._expires_at = 0.0
+        self.stats["invalidations"] += 1
+
+    # ---- 跨 worker 失效 ----
+
+    def publish_invalidation(self) -> None:
+        """本地失效并广播给其他 worker（同步接口，可在事务提交回调中调用）"""
+        self.invalidate()
+        self.channel.publish([str(self.version)])
+
+    def _on_message(self, data: str | None) -> None:
+        self.invalidate()
+
+    def start_listener(self) -> None:
+        """启动 pub/sub 监听（应用启动时调用）"""
+        self.channel.start()
+
+    async def stop_listener(self) -> None:
+        await self.channel.stop()
+
+
+ai_model_cache = AIModelCache()
+
+
+def invalidate_after_commit(db: AsyncSession) -> None:
+    """登记缓存失效，在 db 所在事务提交后执行并广播；回滚则不失效"""
+    after_commit.defer(db, _AFTER_COMMIT_KEY)
+
+
+after_commit.register(_AFTER_COMMIT_KEY, lambda items: ai_model_cache.publish_invalidation())
@@ -1,15 +1,19 @@
 """AI 模型管理服务"""
 
 import uuid
-from datetime import date, datetime, timezone
+from datetime import date, datetime, time, timedelta, timezone
 
 from fastapi import HTTPException, status
-from sqlalchemy import and_, case, func, select
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.adapters.base import ChatMessage
 from app.adapters.factory import LLMAdapterFactory
+from app.core.tasks import Job, enqueue_after_commit, task_queue
 from app.models.ai_model import AIModel, AIUsageLog
+from app.services import usage_counter_service, usage_rollup_service
+from app.services.ai_model_cache import ai_model_cache, invalidate_after_commit
+from app.services.usage_log_writer import usage_log_writer
 from app.schemas.ai_model import (
     AIModelCreate,
     AIModelResponse,
@@ -17,7 +21,7 @@ from app.schemas.ai_model import (
     AIModelUpdate,
     UsageStatsResponse,
 )
-from app.utils.encryption import decrypt_api_key, encrypt_api_key
+from app.utils.encryption import encrypt_api_key, invalidate_decrypted_key
 
 
 def _model_to_response(model: AIModel) -> AIModelResponse:
@@ -60,6 +64,7 @@ async def create_model(
     db.add(model)
     await db.flush()
     await db.refresh(model)
+    invalidate_after_commit(db)
     return _model_to_response(model)
 
 
@@ -72,6 +77,8 @@ async def update_model(
     if data.display_name is not None:
         model.display_name = data.display_name
     if data.api_key is not None:
+        if model.api_key_encrypted:
+            invalidate_decrypted_key(model.api_key_encrypted)
         model.api_key_encrypted = encrypt_api_key(data.api_key)
     if data.api_endpoint is not None:
         model.api_endpoint = data.api_endpoint
@@ -84,16 +91,22 @@ async def update_model(
 
     await db.flush()
     await db.refresh(model)
+    LLMAdapterFactory.invalidate(model.id)
+    invalidate_after_commit(db)
     return _model_to_response(model)
 
 
 async def delete_model(db: AsyncSession, model_id: uuid.UUID) -> AIModelResponse:
     """软删除（停用）AI 模型"""
     model = await _get_model_or_404(db, model_id)
+    if model.api_key_encrypted:
+        invalidate_decrypted_key(model.api_key_encrypted)
     model.is_active = False
     model.is_default = False
     await db.flush()
     await db.refresh(model)
+    LLMAdapterFactory.invalidate(model.id)
+    invalidate_after_commit(db)
     return _model_to_response(model)
 
 
@@ -124,6 +137,8 @@ async def set_default(db: AsyncSession, model_id: uuid.UUID) -> AIModelResponse:
     model.is_default = True
     await db.flush()
     await db.refresh(model)
+    LLMAdapterFactory.invalidate(model.id)
+    invalidate_after_commit(db)
     return _model_to_response(model)
 
 
@@ -136,14 +151,7 @@ async def test_model(
         return AIModelTestResponse(success=False, error="未设置 API Key")
 
     try:
-        api_key = decrypt_api_key(model.api_key_encrypted)
-        adapter = LLMAdapterFactory.create_adapter(
-            provider=model.provider,
-            api_key=api_key,
-            model_name=model.model_name,
-            api_endpoint=model.api_endpoint,
-            config=model.config,
-        )
+        adapter = LLMAdapterFactory.get_adapter(model)
         messages = [ChatMessage(role="user", content=test_message)]
         result = await adapter.chat_completion(messages)
 
@@ -167,25 +175,48 @@ async def log_usage(
     total_tokens: int = 0,
     cost: float = 0.0,
     latency_ms: int = 0,
+    cached_tokens: int = 0,
     status_val: str = "success",
     error_message: str | None = None,
     conversation_id: uuid.UUID | None = None,
+    prompt_tokens_detail: dict | None = None,
 ) -> AIUsageLog:
-    """记录使用日志"""
+    """记录使用日志并累加当日用量计数器
+
+    日志交给批量写入器异步落库，不占用请求事务；写入器不可用时退回
+    在 db 事务内直接写入，提交后再累加计数器。
+    prompt_tokens_detail 为本轮 prompt 各部分的 token 报告
+    """
+    now = datetime.now(timezone.utc)
     log = AIUsageLog(
+        id=uuid.uuid4(),
+        created_at=now,
         model_id=model_id,
         user_id=user_id,
         conversation_id=conversation_id,
         request_tokens=request_tokens,
         response_tokens=response_tokens,
         total_tokens=total_tokens,
+        cached_tokens=cached_tokens,
         cost=cost,
         latency_ms=latency_ms,
         status=status_val,
         error_message=error_message,
+        prompt_tokens_detail=prompt_tokens_detail,
     )
+    counter_payload = {
+        "model_id": str(model_id), "user_id": str(user_id),
+        "tokens": total_tokens, "cost": cost, "created_at": now.isoformat(),
+    }
+
+    row = {c.key: getattr(log, c.key) for c in AIUsageLog.__table__.columns}
+    if usage_log_writer.submit(row):
+        task_queue.submit(Job(name="usage.increment_counters", payload=counter_payload))
+        return log
+
     db.add(log)
     await db.flush()
+    enqueue_after_commit(db, "usage.increment_counters", **counter_payload)
     return log
 
 
@@ -196,84 +227,68 @@ async def get_usage_stats(
     model_id: uuid.UUID | None = None,
     user_id: uuid.UUID | None = None,
 ) -> list[UsageStatsResponse]:
-    """获取使用统计"""
-    query = (
-        select(
-            AIUsageLog.model_id,
-            AIModel.model_name,
-            func.count().label("total_requests"),
-            func.sum(AIUsageLog.total_tokens).label("total_tokens"),
-            func.sum(AIUsageLog.cost).label("total_cost"),
-            func.sum(case((AIUsageLog.status == "success", 1), else_=0)).label("success_count"),
-            func.sum(case((AIUsageLog.status != "success", 1), else_=0)).label("error_count"),
-            func.avg(AIUsageLog.latency_ms).label("avg_latency_ms"),
-        )
-        .join(AIModel, AIUsageLog.model_id == AIModel.id)
-        .group_by(AIUsageLog.model_id, AIModel.model_name)
+    """获取使用统计（按日期闭区间；已汇总的时段读小时 / 天汇总表）"""
+    start = datetime.combine(start_date, time.min, tzinfo=timezone.utc) if start_date else None
+    end = (
+        datetime.combine(end_date + timedelta(days=1), time.min, tzinfo=timezone.utc)
+        if end_date else None
     )
+    totals = await usage_rollup_service.query_usage_by_model(db, start, end, model_id, user_id)
+    if not totals:
+        return []
 
-    if start_date:
-        query = query.where(AIUsageLog.created_at >= datetime(start_date.year, start_date.month, start_date.day, tzinfo=timezone.utc))
-    if end_date:
-        query = query.where(AIUsageLog.created_at < datetime(end_date.year, end_date.month, end_date.day + 1, tzinfo=timezone.utc) if end_date.day < 28 else AIUsageLog.created_at <= datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59, tzinfo=timezone.utc))
-    if model_id:
-        query = query.where(AIUsageLog.model_id == model_id)
-    if user_id:
-        query = query.where(AIUsageLog.user_id == user_id)
-
-    result = await db.execute(query)
-    rows = result.all()
-
-    return [
-        UsageStatsResponse(
-            model_id=row.model_id,
-            model_name=row.model_name,
-            total_requests=row.total_requests or 0,
-            total_tokens=int(row.total_tokens or 0),
-            total_cost=float(row.total_cost or 0),
-            success_count=int(row.success_count or 0),
-            error_count=int(row.error_count or 0),
-            avg_latency_ms=float(row.avg_latency_ms or 0),
-        )
-        for row in rows
-    ]
+    result = await db.execute(
+        select(AIModel.id, AIModel.model_name).where(AIModel.id.in_(list(totals)))
+    )
+    names = dict(result.all())
+
+    stats = []
+    for mid, t in totals.items():
+        requests = int(t["requests"])
+        request_tokens = int(t["request_tokens"])
+        cached_tokens = int(t["cached_tokens"])
+        stats.append(UsageStatsResponse(
+            model_id=mid,
+            model_name=names.get(mid, ""),
+            total_requests=requests,
+            total_tokens=int(t["total_tokens"]),
+            cached_tokens=cached_tokens,
+            cache_hit_rate=round(cached_tokens / request_tokens, 4) if request_tokens else 0.0,
+            total_cost=float(t["cost"]),
+            success_count=int(t["success_count"]),
+            error_count=int(t["error_count"]),
+            avg_latency_ms=float(t["latency_ms_sum"]) / requests if requests else 0.0,
+        ))
+    return stats
 
 
 async def check_usage_limit(
     db: AsyncSession, model_id: uuid.UUID, user_id: uuid.UUID
 ) -> bool:
-    """检查是否超出使用限额，返回 True 表示允许"""
-    model = await _get_model_or_404(db, model_id)
+    """检查是否超出使用限额，返回 True 表示允许（模型配置读自进程内缓存）"""
+    model = await ai_model_cache.get(db, model_id)
+    if not model:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="AI 模型不存在",
+        )
     limits = model.usage_limit
     if not limits:
         return True
 
-    # 查询今日使用量
-    today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    query = select(
-        func.count().label("count"),
-        func.sum(AIUsageLog.total_tokens).label("tokens"),
-        func.sum(AIUsageLog.cost).label("cost"),
-    ).where(
-        and_(
-            AIUsageLog.model_id == model_id,
-            AIUsageLog.user_id == user_id,
-            AIUsageLog.created_at >= today_start,
-        )
-    )
-    result = await db.execute(query)
-    row = result.one()
+    # 今日使用量（Redis 计数器，缺失时从使用日志聚合一次）
+    usage = await usage_counter_service.get_daily_usage(db, model_id, user_id)
 
     daily_requests = limits.get("daily_requests")
-    if daily_requests and (row.count or 0) >= daily_requests:
+    if daily_requests and usage["requests"] >= daily_requests:
         return False
 
     daily_tokens = limits.get("daily_tokens")
-    if daily_tokens and (row.tokens or 0) >= daily_tokens:
+    if daily_tokens and usage["tokens"] >= daily_tokens:
         return False
 
     daily_cost = limits.get("daily_cost")
-    if daily_cost and (row.cost or 0) >= daily_cost:
+    if daily_cost and usage["cost"] >= daily_cost:
         return False
 
     return True
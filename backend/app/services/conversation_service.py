@@ -1,172 +1,62 @@
 """AI 对话式病历录入服务"""
 
+import hashlib
 import json
 import logging
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import aclosing
 from datetime import date, datetime, timezone
+from functools import lru_cache
 
 from fastapi import HTTPException, status
-from sqlalchemy import func, select
+from sqlalchemy import delete, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
 
 from app.adapters.base import ChatMessage, ChatResponse
 from app.adapters.factory import LLMAdapterFactory
-from app.models.ai_model import AIModel
+from app.adapters.router import TASK_CHAT, LLMRouter, RouteExhausted
+from app.core.config import get_settings
+from app.core.tasks import enqueue_after_commit
 from app.models.conversation import Conversation, ConversationMessage
 from app.models.user import User
 from app.schemas.record import RecordCreate
 from app.services import ai_model_service, record_service
-from app.services import memory_service, reminder_service
-from app.utils.encryption import decrypt_api_key
+from app.services.ai_model_cache import ai_model_cache
+from app.services.prompt_templates import render_system_prompt
+# reminder_service / summary_service 同时注册了本模块投递的后台任务
+from app.services import memory_service, reminder_service, summary_service
+from app.utils.prompt_assembler import PromptAssembler
+from app.utils.stream_json import StreamingReplyParser
+from app.utils.token_utils import count_tokens
 
 logger = logging.getLogger(__name__)
-
-# 最大历史消息轮数（system + 最近 N 条）
-MAX_HISTORY_MESSAGES = 20
-
-# ---- System Prompt ----
-
-SYSTEM_PROMPT = """你是一位专业的禽类兽医病历助手。你的任务是通过自然对话帮助兽医创建完整的禽病病历。
-
-## 你需要收集的信息
-
-### 必填字段
-- **poultry_type**: 禽类类型（如：鸡、鸭、鹅、鸽、鹌鹑等）
-- **visit_date**: 就诊日期
-- **symptoms**: 症状描述（包括主要症状、持续时间、严重程度）
-
-### 重要字段（尽量收集）
-- **breed**: 品种
-- **age_days**: 日龄
-- **affected_count**: 发病数量
-- **total_flock**: 总群体数量
-- **onset_date**: 发病日期
-- **primary_diagnosis**: 初步诊断
-- **severity**: 严重程度（mild/moderate/severe/critical）
-- **treatment**: 治疗方案（药物、剂量、疗程）
-
-### 可选字段
-- **farm_info**: 养殖场信息
-- **feed_info**: 饲料信息
-- **environment**: 环境条件（温度、湿度、通风）
-- **vaccination_history**: 免疫史
-- **mortality**: 死亡情况
-- **lab_tests**: 实验室检查
-- **notes**: 备注
-
-## 对话规则
-
-1. 用友好专业的中文与兽医交流
-2. 每次回复后，评估已收集信息的完整度
-3. 根据已收集的信息，智能引导下一步收集
-4. 当信息不清晰时，礼貌地请求澄清
-5. 当收集到足够信息（至少必填字段）时，提示用户可以确认保存
-6. 对于专业术语，给出适当解释
-
-## 输出格式
-
-你必须以 JSON 格式返回，包含以下字段：
-
-```json
-{
-  "reply": "你对用户的自然语言回复",
-  "extracted_info": {
-    "新提取的字段名": "值"
-  },
-  "confidence_scores": {
-    "字段名": 0.0-1.0的置信度
-  },
-  "needs_confirmation": ["需要用户确认的字段列表"],
-  "completeness": {
-    "poultry_type": true/false,
-    "visit_date": true/false,
-    "symptoms": true/false,
-    "breed": true/false,
-    "age_days": true/false,
-    "affected_count": true/false,
-    "total_flock": true/false,
-    "onset_date": true/false,
-    "primary_diagnosis": true/false,
-    "severity": true/false,
-    "treatment": true/false
-  },
-  "suggested_state": "collecting_basic|collecting_symptoms|collecting_diagnosis|collecting_treatment|confirming"
-}
-```
-
-重要：只输出 JSON，不要输出其他内容。
-
-## 示例对话
-
-### 示例 1：基本信息提取
-用户: "我这边有一批蛋鸡，大概45日龄，500只里面有30只出现了打喷嚏的情况"
-```json
-{
-  "reply": "了解，45日龄的蛋鸡出现呼吸道症状。30/500只发病，发病率6%。请问这个情况是什么时候开始的？除了打喷嚏还有没有其他症状，比如流鼻涕、甩头、眼睛肿胀等？",
-  "extracted_info": {
-    "poultry_type": "鸡",
-    "breed": "蛋鸡",
-    "age_days": 45,
-    "affected_count": 30,
-    "total_flock": 500,
-    "symptoms": ["打喷嚏"]
-  },
-  "confidence_scores": {"poultry_type": 1.0, "breed": 0.9, "age_days": 1.0, "affected_count": 1.0, "total_flock": 1.0, "symptoms": 0.8},
-  "needs_confirmation": [],
-  "completeness": {"poultry_type": true, "visit_date": false, "symptoms": true, "breed": true, "age_days": true, "affected_count": true, "total_flock": true, "onset_date": false, "primary_diagnosis": false, "severity": false, "treatment": false},
-  "suggested_state": "collecting_symptoms"
-}
-```
-
-### 示例 2：模糊信息 → needs_confirmation
-用户: "鸭子好像拉肚子了，可能有一周了吧"
-```json
-{
-  "reply": "好的，鸭子出现腹泻大约一周了。请问是什么品种的鸭？大概多大了？养了多少只，发病的有几只？",
-  "extracted_info": {
-    "poultry_type": "鸭",
-    "symptoms": ["腹泻"],
-    "onset_date": "约1周前"
-  },
-  "confidence_scores": {"poultry_type": 1.0, "symptoms": 0.7, "onset_date": 0.5},
-  "needs_confirmation": ["onset_date"],
-  "completeness": {"poultry_type": true, "visit_date": false, "symptoms": true, "breed": false, "age_days": false, "affected_count": false, "total_flock": false, "onset_date": false, "primary_diagnosis": false, "severity": false, "treatment": false},
-  "suggested_state": "collecting_basic"
-}
-```
-
-### 示例 3：多症状提取 + 初步诊断推测
-用户: "鸡群精神萎靡，采食量下降了一半，有绿色稀便，产蛋率从90%掉到60%了，个别鸡冠发紫"
-```json
-{
-  "reply": "症状比较典型，出现精神萎靡、采食下降、绿色稀便、产蛋率骤降和鸡冠发绀，需要高度警惕新城疫或禽流感等烈性传染病。建议立即采样送检。请问有没有做过相关疫苗免疫？最近是否有引种或周边有疫情报告？",
-  "extracted_info": {
-    "symptoms": ["精神萎靡", "采食量下降50%", "绿色稀便", "产蛋率下降(90%→60%)", "鸡冠发紫/发绀"],
-    "primary_diagnosis": "疑似新城疫/禽流感",
-    "severity": "severe"
-  },
-  "confidence_scores": {"symptoms": 0.95, "primary_diagnosis": 0.6, "severity": 0.8},
-  "needs_confirmation": ["primary_diagnosis"],
-  "completeness": {"poultry_type": false, "visit_date": false, "symptoms": true, "breed": false, "age_days": false, "affected_count": false, "total_flock": false, "onset_date": false, "primary_diagnosis": true, "severity": true, "treatment": false},
-  "suggested_state": "collecting_diagnosis"
+settings = get_settings()
+
+# 历史消息条数：已有滚动摘要时只带最近 N 条原文；
+# 摘要水位之后尚未被摘要覆盖的消息全部带上，但不超过上限
+MAX_HISTORY_MESSAGES = 8
+HISTORY_MESSAGES_CAP = 20
+
+# prompt 各部分的 token 上限（总量另受 PROMPT_TOKEN_BUDGET 约束）
+PROMPT_SECTION_BUDGETS = {
+    "memory": 400,
+    "similar_cases": 600,
+    "summary": 300,
+    "state": 800,
+    "history": 3000,
 }
-```
-
-### 示例 4：信息完整后建议确认
-用户: "用的恩诺沙星饮水，0.1%浓度，连用5天"
-```json
-{
-  "reply": "好的，治疗方案已记录。目前病历信息已基本完整：\n- 禽类：蛋鸡，120日龄\n- 发病：20/1000只，2天前开始\n- 症状：呼吸困难、甩头\n- 诊断：疑似慢性呼吸道病(CRD)\n- 治疗：恩诺沙星饮水 0.1% 连用5天\n\n请确认以上信息是否准确？如需修改请告诉我，确认无误后我将保存病历。",
-  "extracted_info": {
-    "treatment": {"drug": "恩诺沙星", "method": "饮水", "concentration": "0.1%", "duration": "5天"}
-  },
-  "confidence_scores": {"treatment": 0.95},
-  "needs_confirmation": [],
-  "completeness": {"poultry_type": true, "visit_date": true, "symptoms": true, "breed": true, "age_days": true, "affected_count": true, "total_flock": true, "onset_date": true, "primary_diagnosis": true, "severity": true, "treatment": true},
-  "suggested_state": "confirming"
-}
-```"""
+
+# 写回阶段乐观锁冲突时最多尝试的次数
+SAVE_REPLY_ATTEMPTS = 3
+
+# 相似病例检索：每轮最多检索一次，collected_info 未变化时复用上一轮结果
+SIMILAR_CASES_TOP_K = 3
+SIMILAR_CASES_CACHE_TTL = 300  # 秒，过期后重新检索以纳入新病历
+SIMILAR_CASES_CACHE_SIZE = 1024  # 最多缓存的对话数
 
 # ---- Function Calling 工具定义（OpenAI-compatible format） ----
 
@@ -180,6 +70,7 @@ FUNCTION_TOOLS = [
                 "type": "object",
                 "properties": {
                     "poultry_type": {"type": "string", "description": "禽类类型（鸡/鸭/鹅/鸽/鹌鹑等）"},
+                    "visit_date": {"type": "string", "description": "就诊日期（YYYY-MM-DD）"},
                     "breed": {"type": "string", "description": "品种（蛋鸡/肉鸡/三黄鸡等）"},
                     "age_days": {"type": "integer", "description": "日龄"},
                     "affected_count": {"type": "integer", "description": "发病数量"},
@@ -209,6 +100,23 @@ FUNCTION_TOOLS = [
                     "vaccination_history": {"type": "string", "description": "免疫史"},
                     "environment": {"type": "string", "description": "环境条件"},
                     "mortality": {"type": "string", "description": "死亡情况"},
+                    "confidence_scores": {
+                        "type": "object",
+                        "description": "本轮提取字段的置信度，字段名 -> 0.0-1.0",
+                    },
+                    "needs_confirmation": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "需要兽医确认的字段",
+                    },
+                    "suggested_state": {
+                        "type": "string",
+                        "enum": [
+                            "collecting_basic", "collecting_symptoms", "collecting_diagnosis",
+                            "collecting_treatment", "confirming",
+                        ],
+                        "description": "建议的下一对话阶段",
+                    },
                 },
             },
         },
@@ -265,6 +173,20 @@ FUNCTION_TOOLS = [
     },
 ]
 
+EXTRACT_TOOL = "extract_medical_info"
+# 函数调用模式只下发提取工具，其余工具定义不占用输入 token
+EXTRACTION_TOOLS = [t for t in FUNCTION_TOOLS if t["function"]["name"] == EXTRACT_TOOL]
+# extract_medical_info 参数中描述本轮结果、不属于病历字段的部分
+_TOOL_META_FIELDS = ("confidence_scores", "needs_confirmation", "suggested_state")
+
+# 完整度评估的字段（函数调用模式下由本地计算）
+COMPLETENESS_FIELDS = (
+    "poultry_type", "visit_date", "symptoms", "breed", "age_days", "affected_count",
+    "total_flock", "onset_date", "primary_diagnosis", "severity", "treatment",
+)
+# 模型只调用函数、没有给出文本回复时使用
+TOOL_ONLY_REPLY = "好的，已记录。请继续补充其他情况。"
+
 
 INITIAL_MESSAGE = (
     "您好！我是禽病病历录入助手。我将帮助您通过对话方式创建一份完整的禽病病历。\n\n"
@@ -331,12 +253,11 @@ async def create_conversation(
         )
 
     # 发送初始引导消息
-    greeting = ConversationMessage(
-        conversation_id=conversation.id,
+    greeting = _add_message(
+        db, conversation,
         role="assistant",
         content=greeting_text,
     )
-    db.add(greeting)
     await db.flush()
 
     conversation.state = "collecting_basic"
@@ -354,7 +275,15 @@ async def send_message(
     content: str,
     audio_url: str | None = None,
 ) -> dict:
-    """接收用户消息，调用 LLM，返回 AI 回复及更新后的收集信息"""
+    """接收用户消息，调用 LLM，返回 AI 回复及更新后的收集信息
+
+    分三段执行，LLM 调用期间不占用数据库连接：
+    1. 短事务：保存用户消息、组装 prompt，提交后连接归还连接池
+    2. 调用 LLM（不访问数据库）
+    3. 新事务：先记录使用日志（调用已计费），再按 Conversation.version 乐观锁写回解析结果与 AI 回复
+
+    调用失败或回复未能写回时撤回第一段提交的用户消息，不留下没有回复的孤立消息。
+    """
     conversation = await _get_conversation_or_404(db, conversation_id, user.id)
 
     if conversation.status != "active":
@@ -364,104 +293,70 @@ async def send_message(
         )
 
     # 保存用户消息
-    user_msg = ConversationMessage(
-        conversation_id=conversation.id,
+    user_msg = _add_message(
+        db, conversation,
         role="user",
         content=content,
         audio_url=audio_url,
     )
-    db.add(user_msg)
     await db.flush()
 
-    # 获取 LLM 适配器和模型信息
-    adapter, ai_model = await _get_adapter_and_model(db)
+    # 多模型路由（超出使用限额的模型跳过）；候选模型都支持函数调用时
+    # 以 extract_medical_info 返回提取结果，否则沿用 JSON 信封
+    router = await _get_router(db, user)
+    structured = settings.LLM_STRUCTURED_OUTPUT and router.supports_tools
 
-    # 检查使用限额
-    allowed = await ai_model_service.check_usage_limit(db, ai_model.id, user.id)
-    if not allowed:
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="今日 AI 使用额度已耗尽",
-        )
-
-    # 构建消息历史
-    messages = await _build_messages(db, conversation, user)
+    # 构建消息历史（相似病例本轮只检索一次，prompt 与返回结果共用）
+    similar_cases = await _get_similar_cases(db, conversation, user)
+    messages, prompt_report = await _build_messages(
+        db, conversation, user, similar_cases=similar_cases, structured=structured
+    )
+    await db.commit()
 
-    # 调用 LLM
+    # 调用 LLM：主模型失败则降级，响应慢则对冲
     try:
-        response = await adapter.chat_completion(messages)
-    except Exception as e:
-        logger.error("LLM 调用失败: %s", e)
-        # 记录失败日志
-        await ai_model_service.log_usage(
-            db, model_id=ai_model.id, user_id=user.id,
-            status_val="error", error_message=str(e),
-            conversation_id=conversation.id,
+        result = await router.chat_completion(
+            messages, tools=EXTRACTION_TOOLS if structured else None
         )
+    except RouteExhausted as e:
+        await _log_route_failures(db, user, conversation, prompt_report, e.failures)
+        await _discard_user_message(db, conversation, user_msg)
         raise HTTPException(
             status_code=status.HTTP_502_BAD_GATEWAY,
             detail="AI 服务调用失败，请稍后重试",
-        )
+        ) from e
+    response = result.response
 
-    # 记录使用日志
+    # 记录使用日志：调用已计费，先于写回记录，写回失败也不漏记
+    await _log_route_failures(
+        db, user, conversation, prompt_report, result.failures, result.cancelled
+    )
     await ai_model_service.log_usage(
-        db, model_id=ai_model.id, user_id=user.id,
+        db, model_id=result.model.id, user_id=user.id,
         request_tokens=response.input_tokens,
         response_tokens=response.output_tokens,
         total_tokens=response.total_tokens,
+        cached_tokens=response.cached_tokens,
         cost=response.cost,
         latency_ms=response.latency_ms,
         conversation_id=conversation.id,
+        prompt_tokens_detail=prompt_report,
     )
 
-    # 解析 LLM 返回的 JSON
-    parsed = _parse_llm_response(response.content)
-
-    # 更新已收集信息
-    if parsed.get("extracted_info"):
-        collected = dict(conversation.collected_info)
-        collected.update(parsed["extracted_info"])
-        conversation.collected_info = collected
-
-    if parsed.get("confidence_scores"):
-        scores = dict(conversation.confidence_scores)
-        scores.update(parsed["confidence_scores"])
-        conversation.confidence_scores = scores
-
-    # 更新对话状态
-    suggested_state = parsed.get("suggested_state")
-    if suggested_state and suggested_state in (
-        "collecting_basic", "collecting_symptoms", "collecting_diagnosis",
-        "collecting_treatment", "confirming",
-    ):
-        conversation.state = suggested_state
-
-    # 保存 AI 回复消息
-    reply_text = parsed.get("reply", response.content)
-    assistant_msg = ConversationMessage(
-        conversation_id=conversation.id,
-        role="assistant",
-        content=reply_text,
-        extracted_info=parsed.get("extracted_info"),
-        confidence_scores=parsed.get("confidence_scores"),
-    )
-    db.add(assistant_msg)
-    await db.flush()
+    # 解析函数调用参数（或 JSON 信封），写回对话
+    parsed = _parse_reply(result.model, response, conversation.collected_info, structured)
+    try:
+        conversation, assistant_msg = await _save_reply(db, conversation, parsed, parsed["reply"])
+    except HTTPException:
+        await _discard_user_message(db, conversation, user_msg)
+        raise
     await db.refresh(assistant_msg)
-    await db.refresh(conversation)
 
-    # 检索相似病例（异步，失败不影响主流程）
-    similar_cases = await _search_similar_cases(
-        db, conversation.collected_info, user,
-        exclude_record_id=conversation.record_id,
-    )
+    # 收集信息有变化时重新检索相似病例（结果缓存，下一轮 prompt 直接复用）
+    similar_cases = await _get_similar_cases(db, conversation, user)
 
-    # 异步更新摘要（失败不影响主流程）
-    try:
-        from app.services import summary_service
-        await summary_service.update_summary_if_needed(db, conversation.id)
-    except Exception as e:
-        logger.warning("摘要更新失败: %s", e)
+    # 摘要可能需要再调一次 LLM，提交后在后台更新
+    enqueue_after_commit(db, "conversation.update_summary", conversation_id=conversation.id)
 
     return {
         "message": assistant_msg,
@@ -469,7 +364,7 @@ async def send_message(
         "confidence_scores": conversation.confidence_scores,
         "needs_confirmation": parsed.get("needs_confirmation", []),
         "completeness": parsed.get("completeness", {}),
-        "similar_cases": similar_cases,
+        "similar_cases": _to_similar_case_items(similar_cases),
     }
 
 
@@ -554,35 +449,24 @@ async def complete_conversation(
     conversation.collected_info = collected
 
     # 添加完成系统消息
-    sys_msg = ConversationMessage(
-        conversation_id=conversation.id,
+    _add_message(
+        db, conversation,
         role="system",
         content=f"病历已保存，编号: {record.record_no}",
     )
-    db.add(sys_msg)
     await db.flush()
+    # 一并加载 record 关系，供响应序列化使用
     await db.refresh(conversation)
+    await db.refresh(conversation, attribute_names=["record"])
 
-    # 触发提醒生成
-    try:
-        await reminder_service.generate_reminders(db, record.id, user.id)
-    except Exception as e:
-        logger.warning("提醒生成失败: %s", e)
-
-    # 触发记忆更新
-    try:
-        msg_result = await db.execute(
-            select(ConversationMessage)
-            .where(ConversationMessage.conversation_id == conversation.id)
-            .order_by(ConversationMessage.created_at.asc())
-        )
-        msg_dicts = [
-            {"role": m.role, "content": m.content}
-            for m in msg_result.scalars().all()
-        ]
-        await memory_service.extract_memory_updates(db, user.id, msg_dicts)
-    except Exception as e:
-        logger.warning("记忆更新失败: %s", e)
+    # 提醒生成与记忆更新在事务提交后后台执行
+    enqueue_after_commit(
+        db, "record.generate_reminders", record_id=record.id, user_id=user.id
+    )
+    enqueue_after_commit(
+        db, "memory.extract_from_conversation",
+        user_id=user.id, conversation_id=conversation.id,
+    )
 
     return {
         "conversation": conversation,
@@ -705,7 +589,6 @@ async def pause_conversation(
 
     # 暂停时强制生成 / 更新摘要
     try:
-        from app.services import summary_service
         await summary_service.update_summary_if_needed(db, conversation.id, force=True)
     except Exception as e:
         logger.warning("暂停时摘要生成失败: %s", e)
@@ -729,12 +612,11 @@ async def resume_conversation(
 
     # 添加续聊系统消息
     if conversation.summary:
-        resume_msg = ConversationMessage(
-            conversation_id=conversation.id,
+        _add_message(
+            db, conversation,
             role="system",
             content=f"对话已恢复。上次摘要：{conversation.summary}",
         )
-        db.add(resume_msg)
 
     await db.flush()
     await db.refresh(conversation)
@@ -751,7 +633,11 @@ async def send_message_stream(
     content: str,
     audio_url: str | None = None,
 ):
-    """流式发送消息，yield 逐 token 片段，最后 yield 完整解析结果"""
+    """流式发送消息，yield 逐 token 片段，最后 yield 完整解析结果
+
+    与 send_message 相同分段执行：流式输出期间不占用数据库连接。
+    流式输出始终使用 JSON 信封，由 StreamingReplyParser 增量取出回复文本。
+    """
     conversation = await _get_conversation_or_404(db, conversation_id, user.id)
 
     if conversation.status != "active":
@@ -761,92 +647,81 @@ async def send_message_stream(
         )
 
     # 保存用户消息
-    user_msg = ConversationMessage(
-        conversation_id=conversation.id,
+    user_msg = _add_message(
+        db, conversation,
         role="user",
         content=content,
         audio_url=audio_url,
     )
-    db.add(user_msg)
     await db.flush()
 
-    adapter, ai_model = await _get_adapter_and_model(db)
+    router = await _get_router(db, user)
 
-    allowed = await ai_model_service.check_usage_limit(db, ai_model.id, user.id)
-    if not allowed:
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail="今日 AI 使用额度已耗尽",
-        )
+    similar_cases = await _get_similar_cases(db, conversation, user)
+    messages, prompt_report = await _build_messages(
+        db, conversation, user, similar_cases=similar_cases
+    )
+    await db.commit()
 
-    messages = await _build_messages(db, conversation, user)
+    # 首个 token 到达前失败或超时则降级到下一个模型
+    try:
+        ai_model, token_stream, failures = await router.open_stream(messages)
+    except RouteExhausted as e:
+        await _log_route_failures(db, user, conversation, prompt_report, e.failures)
+        await _discard_user_message(db, conversation, user_msg)
+        yield {"type": "error", "error": "AI 服务调用失败，请稍后重试"}
+        return
 
-    # 流式调用
+    # 流式调用：增量解析 JSON 信封，只推送 reply 文本和已闭合的 extracted_info 字段
     full_content = ""
+    parser = StreamingReplyParser()
     try:
-        async for token in adapter.chat_completion_stream(messages):
-            full_content += token
-            yield {"type": "stream_token", "content": token}
+        # aclosing：客户端断开时立即关闭上游流，停止 SDK 读取线程
+        async with aclosing(token_stream) as stream:
+            async for token in stream:
+                full_content += token
+                for kind, payload in parser.feed(token):
+                    if kind == "reply":
+                        yield {"type": "stream_token", "content": payload}
+                    else:
+                        key, value = payload
+                        yield {"type": "info_delta", "collected_info": {key: value}}
     except Exception as e:
-        logger.error("LLM 流式调用失败: %s", e)
-        await ai_model_service.log_usage(
-            db, model_id=ai_model.id, user_id=user.id,
-            status_val="error", error_message=str(e),
-            conversation_id=conversation.id,
-        )
+        failures.append((ai_model, e))
+        await _log_route_failures(db, user, conversation, prompt_report, failures)
+        await _discard_user_message(db, conversation, user_msg)
         yield {"type": "error", "error": "AI 服务调用失败，请稍后重试"}
         return
 
-    # 记录使用（流式模式无法精确统计 token，仅记录调用）
+    # 解析完整响应，写回对话
+    parsed = _parse_reply(
+        ai_model, ChatResponse(content=full_content), conversation.collected_info, structured=False
+    )
+    reply_text = parsed["reply"]
+    if not parser.reply_started:
+        # 模型未按 JSON 信封输出（纯文本等），结束时一次性推送回复
+        yield {"type": "stream_token", "content": reply_text}
+
+    # 记录使用（流式模式无厂商 token 统计，输入按本地 prompt 报告计）；先于写回，写回失败也不漏记
+    await _log_route_failures(db, user, conversation, prompt_report, failures)
     await ai_model_service.log_usage(
         db, model_id=ai_model.id, user_id=user.id,
+        request_tokens=prompt_report["total"],
         conversation_id=conversation.id,
+        prompt_tokens_detail=prompt_report,
     )
 
-    # 解析完整响应
-    parsed = _parse_llm_response(full_content)
-
-    if parsed.get("extracted_info"):
-        collected = dict(conversation.collected_info)
-        collected.update(parsed["extracted_info"])
-        conversation.collected_info = collected
-
-    if parsed.get("confidence_scores"):
-        scores = dict(conversation.confidence_scores)
-        scores.update(parsed["confidence_scores"])
-        conversation.confidence_scores = scores
-
-    suggested_state = parsed.get("suggested_state")
-    if suggested_state and suggested_state in (
-        "collecting_basic", "collecting_symptoms", "collecting_diagnosis",
-        "collecting_treatment", "confirming",
-    ):
-        conversation.state = suggested_state
+    try:
+        conversation, _ = await _save_reply(db, conversation, parsed, reply_text)
+    except HTTPException:
+        await _discard_user_message(db, conversation, user_msg)
+        raise
 
-    reply_text = parsed.get("reply", full_content)
-    assistant_msg = ConversationMessage(
-        conversation_id=conversation.id,
-        role="assistant",
-        content=reply_text,
-        extracted_info=parsed.get("extracted_info"),
-        confidence_scores=parsed.get("confidence_scores"),
-    )
-    db.add(assistant_msg)
-    await db.flush()
-    await db.refresh(conversation)
+    # 收集信息有变化时重新检索相似病例
+    similar_cases = await _get_similar_cases(db, conversation, user)
 
-    # 检索相似病例
-    similar_cases = await _search_similar_cases(
-        db, conversation.collected_info, user,
-        exclude_record_id=conversation.record_id,
-    )
-
-    # 异步更新摘要
-    try:
-        from app.services import summary_service
-        await summary_service.update_summary_if_needed(db, conversation.id)
-    except Exception as e:
-        logger.warning("流式摘要更新失败: %s", e)
+    # 摘要可能需要再调一次 LLM，提交后在后台更新
+    enqueue_after_commit(db, "conversation.update_summary", conversation_id=conversation.id)
 
     yield {
         "type": "stream_end",
@@ -855,13 +730,24 @@ async def send_message_stream(
         "confidence_scores": conversation.confidence_scores,
         "needs_confirmation": parsed.get("needs_confirmation", []),
         "completeness": parsed.get("completeness", {}),
-        "similar_cases": similar_cases,
+        "similar_cases": _to_similar_case_items(similar_cases),
     }
 
 
 # ---- 内部辅助函数 ----
 
 
+def _add_message(
+    db: AsyncSession, conversation: Conversation, **fields
+) -> ConversationMessage:
+    """新增对话消息并维护会话消息计数"""
+    msg = ConversationMessage(conversation_id=conversation.id, **fields)
+    db.add(msg)
+    conversation.message_count = (conversation.message_count or 0) + 1
+    return msg
+
+
+
 async def _get_conversation_or_404(
     db: AsyncSession, conversation_id: uuid.UUID, user_id: uuid.UUID
 ) -> Conversation:
@@ -883,69 +769,219 @@ async def _get_conversation_or_404(
     return conversation
 
 
-async def _get_adapter_and_model(db: AsyncSession):
-    """获取默认 LLM 适配器及其模型 ORM 对象"""
-    result = await db.execute(
-        select(AIModel).where(AIModel.is_default == True, AIModel.is_active == True)
-    )
-    ai_model = result.scalar_one_or_none()
-    if not ai_model:
+async def _get_router(db: AsyncSession, user: User, task: str = TASK_CHAT) -> LLMRouter:
+    """按启用中的模型构建路由（模型配置快照走进程内缓存，稳态下不查库）
+
+    限额检查在释放连接前完成，LLM 调用阶段不再访问数据库；
+    该用户今日已超出限额的模型不参与路由。
+    """
+    models = await ai_model_cache.get_active(db)
+    if not models:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="未配置默认 AI 模型",
+            detail="未配置可用的 AI 模型",
+        )
+    allowed = [
+        m for m in models
+        if await ai_model_service.check_usage_limit(db, m.id, user.id)
+    ]
+    if not allowed:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="今日 AI 使用额度已耗尽",
         )
+    return LLMRouter(allowed, task)
 
-    api_key = decrypt_api_key(ai_model.api_key_encrypted)
-    adapter = LLMAdapterFactory.create_adapter(
-        provider=ai_model.provider,
-        api_key=api_key,
-        model_name=ai_model.model_name,
-        api_endpoint=ai_model.api_endpoint,
-        config=ai_model.config,
+
+async def _log_route_failures(
+    db: AsyncSession,
+    user: User,
+    conversation: Conversation,
+    prompt_report: dict,
+    failures: list,
+    cancelled: list | None = None,
+) -> None:
+    """为路由中失败的每次模型调用记录错误日志，对冲落败被取消的调用按 prompt 估算记录用量"""
+    for model, error in failures:
+        logger.error("LLM 调用失败 (%s): %s", model.model_name, error)
+        await ai_model_service.log_usage(
+            db, model_id=model.id, user_id=user.id,
+            status_val="error", error_message=str(error),
+            conversation_id=conversation.id,
+            prompt_tokens_detail=prompt_report,
+        )
+    for model in cancelled or []:
+        prompt_tokens = prompt_report["total"]
+        await ai_model_service.log_usage(
+            db, model_id=model.id, user_id=user.id,
+            request_tokens=prompt_tokens,
+            total_tokens=prompt_tokens,
+            cost=LLMAdapterFactory.get_adapter(model).calculate_cost(prompt_tokens, 0),
+            status_val="cancelled",
+            conversation_id=conversation.id,
+            prompt_tokens_detail=prompt_report,
+        )
+
+
+def _apply_parsed(conversation: Conversation, parsed: dict) -> None:
+    """把 LLM 解析结果合并到对话的收集信息、置信度与状态"""
+    if parsed.get("extracted_info"):
+        collected = dict(conversation.collected_info)
+        collected.update(parsed["extracted_info"])
+        conversation.collected_info = collected
+
+    if parsed.get("confidence_scores"):
+        scores = dict(conversation.confidence_scores)
+        scores.update(parsed["confidence_scores"])
+        conversation.confidence_scores = scores
+
+    suggested_state = parsed.get("suggested_state")
+    if suggested_state and suggested_state in (
+        "collecting_basic", "collecting_symptoms", "collecting_diagnosis",
+        "collecting_treatment", "confirming",
+    ):
+        conversation.state = suggested_state
+
+
+async def _save_reply(
+    db: AsyncSession, conversation: Conversation, parsed: dict, reply_text: str
+) -> tuple[Conversation, ConversationMessage]:
+    """写回本轮结果与 AI 回复
+
+    先按第一段提交后的内存状态直接更新（无需重新查询）；LLM 调用期间对话被
+    其他请求修改时 version 不匹配，回滚保存点后重新读取对话并重放本轮变更。
+    """
+    conversation_id = conversation.id
+    for attempt in range(SAVE_REPLY_ATTEMPTS):
+        if attempt:
+            result = await db.execute(
+                select(Conversation)
+                .where(Conversation.id == conversation_id)
+                .execution_options(populate_existing=True)
+            )
+            conversation = result.scalar_one()
+        if conversation.status != "active":
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="对话已结束或暂停，本轮回复未保存",
+            )
+
+        try:
+            # 保存点：冲突时只撤销本次写回，会话中的其他对象（如当前用户）不受影响
+            async with db.begin_nested():
+                _apply_parsed(conversation, parsed)
+                assistant_msg = _add_message(
+                    db, conversation,
+                    role="assistant",
+                    content=reply_text,
+                    extracted_info=parsed.get("extracted_info"),
+                    confidence_scores=parsed.get("confidence_scores"),
+                )
+        except StaleDataError:
+            logger.info("对话 %s 写回冲突，重新读取后重试", conversation_id)
+            continue
+        await db.refresh(conversation)
+        return conversation, assistant_msg
+
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="对话已被其他请求更新，请重试",
     )
-    return adapter, ai_model
+
+
+async def _discard_user_message(
+    db: AsyncSession, conversation: Conversation, user_msg: ConversationMessage
+) -> None:
+    """撤回第一段已提交、但本轮没有回复的用户消息，并提交
+
+    与 _save_reply 相同按版本号乐观锁写回消息计数，冲突时重新读取后重试；
+    随后抛出的异常会回滚请求事务，已记录的使用日志在这里一并提交。
+    """
+    conversation_id = conversation.id
+    for attempt in range(SAVE_REPLY_ATTEMPTS):
+        if attempt:
+            result = await db.execute(
+                select(Conversation)
+                .where(Conversation.id == conversation_id)
+                .execution_options(populate_existing=True)
+            )
+            conversation = result.scalar_one()
+        try:
+            async with db.begin_nested():
+                await db.execute(
+                    delete(ConversationMessage).where(ConversationMessage.id == user_msg.id)
+                )
+                conversation.message_count = max((conversation.message_count or 0) - 1, 0)
+        except StaleDataError:
+            continue
+        await db.commit()
+        return
+    logger.warning("对话 %s 撤回未回复的用户消息失败（并发修改）", conversation_id)
+    await db.commit()
 
 
 async def _build_messages(
-    db: AsyncSession, conversation: Conversation, user: User | None = None
-) -> list[ChatMessage]:
-    """构建发送给 LLM 的消息列表：system prompt + 记忆 + 相似病例 + 收集状态 + 最近 N 条历史"""
-    # 注入用户记忆到 system prompt
-    memory_context = await memory_service.build_memory_context(db, conversation.user_id)
-    system_content = SYSTEM_PROMPT
-    if memory_context:
-        system_content += f"\n\n{memory_context}"
+    db: AsyncSession,
+    conversation: Conversation,
+    user: User | None = None,
+    similar_cases: list[dict] | None = None,
+    structured: bool = False,
+) -> tuple[list[ChatMessage], dict]:
+    """构建发送给 LLM 的消息列表：system prompt + 记忆 + 相似病例 + 摘要 + 收集状态 + 最近 N 条历史
+
+    各部分按 PROMPT_SECTION_BUDGETS 限额，总量超出 PROMPT_TOKEN_BUDGET 时按优先级裁剪。
+    返回 (消息列表, 各部分 token 报告)。
+    similar_cases 为本轮已检索的相似病例；未传入时在此检索（走同一缓存）。
+    structured 为 True 时使用函数调用模式的 system prompt。
+    system prompt 取自模板注册表，同一阶段跨轮次不变，仍作为可缓存前缀。
+    """
+    assembler = PromptAssembler(settings.PROMPT_TOKEN_BUDGET)
+
+    # 静态 system prompt，token 数进程内只计算一次
+    # 标记为可缓存前缀：各厂商 prompt 缓存跨轮次复用
+    # 按对话阶段选择模板（只带当前阶段相关的示例）
+    system_prompt = render_system_prompt(conversation.state, structured)
+    assembler.add(
+        "system", system_prompt, priority=0,
+        tokens=_static_tokens(system_prompt), cacheable=True,
+    )
 
-    messages = [ChatMessage(role="system", content=system_content)]
+    # 用户记忆单独成条，不拼进静态 system prompt，避免破坏缓存前缀
+    memory_context = await memory_service.build_memory_context(db, conversation.user_id)
+    assembler.add(
+        "memory", memory_context, priority=4,
+        budget=PROMPT_SECTION_BUDGETS["memory"],
+    )
 
     # 注入相似病例参考（如果有收集到信息）
     if conversation.collected_info:
-        is_master = user.role == "master" if user else False
-        similar_context = await _build_similar_cases_context(
-            db, conversation.collected_info, conversation.user_id,
-            is_master=is_master,
-            exclude_record_id=conversation.record_id,
+        if similar_cases is None:
+            similar_cases = await _get_similar_cases(db, conversation, user)
+        assembler.add(
+            "similar_cases", _build_similar_cases_context(similar_cases), priority=5,
+            budget=PROMPT_SECTION_BUDGETS["similar_cases"],
         )
-        if similar_context:
-            messages.append(ChatMessage(role="system", content=similar_context))
 
     # 注入摘要（续聊上下文，帮助 LLM 快速理解之前的对话）
     if conversation.summary:
-        messages.append(ChatMessage(
-            role="system",
-            content=f"对话摘要：{conversation.summary}",
-        ))
+        assembler.add(
+            "summary", f"对话摘要：{conversation.summary}", priority=2,
+            budget=PROMPT_SECTION_BUDGETS["summary"],
+        )
 
-    # 注入当前收集状态到 system 消息
+    # 注入当前收集状态（紧凑 JSON）
     if conversation.collected_info:
         state_summary = (
-            f"\n\n当前已收集的信息：\n```json\n"
-            f"{json.dumps(conversation.collected_info, ensure_ascii=False, indent=2)}\n"
-            f"```\n当前对话阶段: {conversation.state}"
+            f"当前已收集的信息：{_compact_json(conversation.collected_info)}\n"
+            f"当前对话阶段: {conversation.state}"
+        )
+        assembler.add(
+            "state", state_summary, priority=1,
+            budget=PROMPT_SECTION_BUDGETS["state"],
         )
-        messages.append(ChatMessage(role="system", content=state_summary))
 
-    # 获取最近的消息历史
+    # 获取最近的消息历史（更早的内容由摘要覆盖）
+    history_limit = _history_limit(conversation)
     result = await db.execute(
         select(ConversationMessage)
         .where(
@@ -953,132 +989,249 @@ async def _build_messages(
             ConversationMessage.role.in_(["user", "assistant"]),
         )
         .order_by(ConversationMessage.created_at.desc())
-        .limit(MAX_HISTORY_MESSAGES)
+        .limit(history_limit)
     )
     history = list(reversed(result.scalars().all()))
+    assembler.add_history(
+        "history",
+        [ChatMessage(role=msg.role, content=msg.content) for msg in history],
+        priority=3,
+        budget=PROMPT_SECTION_BUDGETS["history"],
+    )
 
-    for msg in history:
-        messages.append(ChatMessage(role=msg.role, content=msg.content))
+    messages, report = assembler.build()
+    logger.debug("prompt token 分布 (conversation=%s): %s", conversation.id, report)
+    return messages, report
 
-    return messages
 
+@lru_cache(maxsize=32)
+def _static_tokens(text: str) -> int:
+    """静态 prompt 片段的 token 数（进程内缓存）"""
+    return count_tokens(text)
 
-async def _search_similar_cases(
-    db: AsyncSession,
-    collected_info: dict,
-    user: User,
-    exclude_record_id: uuid.UUID | None = None,
+
+def _compact_json(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _history_limit(conversation: Conversation) -> int:
+    """本轮 prompt 携带的历史消息条数"""
+    if not conversation.summary:
+        return HISTORY_MESSAGES_CAP
+    unsummarized = (conversation.message_count or 0) - (conversation.summary_message_count or 0)
+    return min(HISTORY_MESSAGES_CAP, max(MAX_HISTORY_MESSAGES, unsummarized))
+
+
+# conversation_id -> (检索指纹, 检索时间, 检索结果)
+_similar_cases_cache: OrderedDict[uuid.UUID, tuple[str, float, list[dict]]] = OrderedDict()
+
+
+def _similar_cases_fingerprint(
+    collected_info: dict, is_master: bool, exclude_record_id: uuid.UUID | None
+) -> str | None:
+    """相似病例检索的输入指纹（embedding 文本 + 权限范围），无可检索文本时返回 None"""
+    from app.services.embedding_service import build_embedding_text_from_info
+
+    query_text = build_embedding_text_from_info(collected_info or {})
+    if not query_text.strip():
+        return None
+    raw = f"{query_text}|{int(is_master)}|{exclude_record_id or ''}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def _get_similar_cases(
+    db: AsyncSession, conversation: Conversation, user: User | None = None
 ) -> list[dict]:
-    """检索相似病例，异常时返回空列表"""
-    if not collected_info:
-        return []
-    try:
-        from app.services.embedding_service import search_similar_by_collected_info
-        results = await search_similar_by_collected_info(
-            db, collected_info,
-            user_id=user.id,
-            is_master=(user.role == "master"),
-            top_k=3,
-            exclude_record_id=exclude_record_id,
-        )
-        # 返回前端友好的精简格式
-        return [
-            {
-                "id": r["id"],
-                "record_no": r["record_no"],
-                "poultry_type": r["poultry_type"],
-                "primary_diagnosis": r.get("primary_diagnosis"),
-                "severity": r.get("severity"),
-                "similarity": r["similarity"],
-            }
-            for r in results
-        ]
-    except Exception as e:
-        logger.warning("相似病例检索失败: %s", e)
+    """检索当前 collected_info 的相似病例，异常时返回空列表
+
+    结果按对话缓存：collected_info 与上次检索时一致则直接复用，
+    不再重复 embedding 与向量查询。
+    """
+    is_master = user.role == "master" if user else False
+    fingerprint = _similar_cases_fingerprint(
+        conversation.collected_info, is_master, conversation.record_id
+    )
+    if fingerprint is None:
         return []
 
+    cached = _similar_cases_cache.get(conversation.id)
+    if (
+        cached
+        and cached[0] == fingerprint
+        and time.monotonic() - cached[1] < SIMILAR_CASES_CACHE_TTL
+    ):
+        _similar_cases_cache.move_to_end(conversation.id)
+        return cached[2]
 
-async def _build_similar_cases_context(
-    db: AsyncSession,
-    collected_info: dict,
-    user_id: uuid.UUID,
-    is_master: bool = False,
-    exclude_record_id: uuid.UUID | None = None,
-) -> str:
-    """构建注入给 LLM 的相似病例参考上下文"""
     try:
         from app.services.embedding_service import search_similar_by_collected_info
-
         cases = await search_similar_by_collected_info(
-            db, collected_info,
-            user_id=user_id,
+            db, conversation.collected_info,
+            user_id=conversation.user_id,
             is_master=is_master,
-            top_k=3,
-            exclude_record_id=exclude_record_id,
+            top_k=SIMILAR_CASES_TOP_K,
+            exclude_record_id=conversation.record_id,
         )
-        if not cases:
-            return ""
-
-        lines = ["## 相似历史病例参考（仅供辅助诊断参考）\n"]
-        for i, c in enumerate(cases, 1):
-            lines.append(f"### 病例 {i}（相似度 {c['similarity']:.0%}）")
-            lines.append(f"- 编号: {c['record_no']}")
-            lines.append(f"- 禽类: {c['poultry_type']}")
-            if c.get("primary_diagnosis"):
-                lines.append(f"- 诊断: {c['primary_diagnosis']}")
-            if c.get("severity"):
-                lines.append(f"- 严重程度: {c['severity']}")
-            # 提取症状和治疗
-            rj = c.get("record_json", {})
-            if rj.get("symptoms"):
-                symptoms = rj["symptoms"]
-                if isinstance(symptoms, list):
-                    lines.append(f"- 症状: {', '.join(str(s) for s in symptoms)}")
-                else:
-                    lines.append(f"- 症状: {symptoms}")
-            if rj.get("treatment"):
-                t = rj["treatment"]
-                if isinstance(t, dict):
-                    t_str = " ".join(str(v) for v in t.values() if v)
-                    lines.append(f"- 治疗: {t_str}")
-                else:
-                    lines.append(f"- 治疗: {t}")
-            lines.append("")
-
-        return "\n".join(lines)
     except Exception as e:
-        logger.warning("构建相似病例上下文失败: %s", e)
-        return ""
-
+        logger.warning("相似病例检索失败: %s", e)
+        return []
 
-def _parse_llm_response(content: str) -> dict:
-    """解析 LLM 返回的 JSON，容错处理"""
-    # 尝试直接解析
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        pass
+    _similar_cases_cache[conversation.id] = (fingerprint, time.monotonic(), cases)
+    _similar_cases_cache.move_to_end(conversation.id)
+    while len(_similar_cases_cache) > SIMILAR_CASES_CACHE_SIZE:
+        _similar_cases_cache.popitem(last=False)
+    return cases
+
+
+def _to_similar_case_items(cases: list[dict]) -> list[dict]:
+    """相似病例转换为返回前端的精简格式"""
+    return [
+        {
+            "id": r["id"],
+            "record_no": r["record_no"],
+            "poultry_type": r["poultry_type"],
+            "primary_diagnosis": r.get("primary_diagnosis"),
+            "severity": r.get("severity"),
+            "similarity": r["similarity"],
+        }
+        for r in cases
+    ]
+
+
+def _build_similar_cases_context(cases: list[dict]) -> str:
+    """构建注入给 LLM 的相似病例参考上下文"""
+    if not cases:
+        return ""
 
-    # 尝试提取 JSON 块（```json ... ```）
+    lines = ["## 相似历史病例参考（仅供辅助诊断参考）\n"]
+    for i, c in enumerate(cases, 1):
+        lines.append(f"### 病例 {i}（相似度 {c['similarity']:.0%}）")
+        lines.append(f"- 编号: {c['record_no']}")
+        lines.append(f"- 禽类: {c['poultry_type']}")
+        if c.get("primary_diagnosis"):
+            lines.append(f"- 诊断: {c['primary_diagnosis']}")
+        if c.get("severity"):
+            lines.append(f"- 严重程度: {c['severity']}")
+        # 提取症状和治疗
+        rj = c.get("record_json") or {}
+        if rj.get("symptoms"):
+            symptoms = rj["symptoms"]
+            if isinstance(symptoms, list):
+                lines.append(f"- 症状: {', '.join(str(s) for s in symptoms)}")
+            else:
+                lines.append(f"- 症状: {symptoms}")
+        if rj.get("treatment"):
+            t = rj["treatment"]
+            if isinstance(t, dict):
+                t_str = " ".join(str(v) for v in t.values() if v)
+                lines.append(f"- 治疗: {t_str}")
+            else:
+                lines.append(f"- 治疗: {t}")
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def _parse_json_envelope(content: str) -> dict | None:
+    """从文本中取出 JSON 信封，无法解析时返回 None"""
     import re
+
+    candidates = [content]
+    # ```json ... ``` 代码块
     json_match = re.search(r"```(?:json)?\s*\n?(.*?)\n?```", content, re.DOTALL)
     if json_match:
-        try:
-            return json.loads(json_match.group(1))
-        except json.JSONDecodeError:
-            pass
-
-    # 尝试找 { ... } 块
+        candidates.append(json_match.group(1))
+    # 第一个 { 到最后一个 } 的片段
     brace_match = re.search(r"\{.*\}", content, re.DOTALL)
     if brace_match:
+        candidates.append(brace_match.group(0))
+
+    for text in candidates:
         try:
-            return json.loads(brace_match.group(0))
+            parsed = json.loads(text)
         except json.JSONDecodeError:
-            pass
-
-    # 无法解析，返回原始内容作为回复
-    logger.warning("无法解析 LLM JSON 响应，使用原始内容")
-    return {"reply": content}
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    return None
+
+
+# (model_id, 模式) -> 解析统计（进程内）；模式为 tools（函数调用）或 json（JSON 信封）
+_extraction_stats: dict[tuple[uuid.UUID, str], dict] = {}
+
+
+def _record_extraction(model, mode: str, outcome: str) -> None:
+    stats = _extraction_stats.get((model.id, mode))
+    if stats is None:
+        stats = _extraction_stats[(model.id, mode)] = {
+            "model_id": model.id, "model_name": model.model_name, "mode": mode,
+            "turns": 0, "tool_calls": 0, "fallbacks": 0, "failures": 0,
+        }
+    stats["turns"] += 1
+    if outcome != "ok":
+        stats[outcome] += 1
+
+
+def get_extraction_stats() -> list[dict]:
+    """各模型按模式的提取结果统计：函数调用命中、退回文本解析与解析失败次数"""
+    return [
+        {**s, "failure_rate": s["failures"] / s["turns"] if s["turns"] else 0.0}
+        for s in _extraction_stats.values()
+    ]
+
+
+def reset_extraction_stats() -> None:
+    _extraction_stats.clear()
+
+
+def _parse_reply(model, response: ChatResponse, collected_info: dict, structured: bool) -> dict:
+    """把模型输出解析为本轮结果（reply / extracted_info / confidence_scores / ...）
+
+    函数调用模式优先取 extract_medical_info 的参数；参数不是合法 JSON 或模型仍输出了
+    JSON 信封时退回文本解析。解析结果按模型与模式计入统计。
+    """
+    mode = "tools" if structured else "json"
+    content = response.content or ""
+    if structured:
+        call = next((c for c in response.tool_calls if c.name == EXTRACT_TOOL), None)
+        text = content.strip()
+        if call is not None and call.arguments is not None:
+            _record_extraction(model, mode, "tool_calls")
+            return _parsed_from_tool(call.arguments, text, collected_info)
+        if call is None and text and not text.startswith(("{", "```")):
+            # 本轮没有新信息，只有文本回复
+            _record_extraction(model, mode, "ok")
+            return _parsed_from_tool({}, text, collected_info)
+
+    parsed = _parse_json_envelope(content)
+    if parsed is None:
+        _record_extraction(model, mode, "failures")
+        logger.warning("无法解析 LLM 响应 (%s, %s)，使用原始内容", model.model_name, mode)
+        return {"reply": content or TOOL_ONLY_REPLY}
+    _record_extraction(model, mode, "fallbacks" if structured else "ok")
+    parsed.setdefault("reply", content)
+    return parsed
+
+
+def _parsed_from_tool(arguments: dict, reply: str, collected_info: dict) -> dict:
+    """extract_medical_info 参数 -> 与 JSON 信封相同结构的本轮结果，完整度按合并后的字段计算"""
+    fields = dict(arguments)
+    meta = {k: fields.pop(k, None) for k in _TOOL_META_FIELDS}
+    extracted = {k: v for k, v in fields.items() if v not in (None, "", [], {})}
+    merged = {**(collected_info or {}), **extracted}
+    scores = meta["confidence_scores"] if isinstance(meta["confidence_scores"], dict) else {}
+    return {
+        "reply": reply or TOOL_ONLY_REPLY,
+        "extracted_info": extracted,
+        "confidence_scores": {
+            k: v for k, v in scores.items() if isinstance(v, (int, float)) and not isinstance(v, bool)
+        },
+        "needs_confirmation": list(meta["needs_confirmation"] or []),
+        "completeness": {
+            f: merged.get(f) not in (None, "", [], {}) for f in COMPLETENESS_FIELDS
+        },
+        "suggested_state": meta["suggested_state"],
+    }
 
 
 def _build_record_json(collected: dict) -> dict:
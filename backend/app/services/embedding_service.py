@@ -1,15 +1,25 @@
 """Embedding 服务 — 生成 / 查询 / 批量处理 医疗记录向量"""
 
+import base64
+import hashlib
 import logging
+import struct
 import uuid
+from collections import OrderedDict
 
 from sqlalchemy import select, text, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from app.adapters.embedding_base import BaseEmbeddingAdapter
 from app.adapters.embedding_factory import EmbeddingAdapterFactory
+from app.core.config import get_settings
+from app.core.redis import redis_client
+from app.core.tasks import task
 from app.models.medical_record import MedicalRecord
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_CACHE_PREFIX = "emb:q:"
+
 
 def build_embedding_text(record: MedicalRecord) -> str:
     """将病历记录构建为适合 embedding 的纯文本"""
@@ -100,6 +110,113 @@ def _get_adapter() -> BaseEmbeddingAdapter:
     return EmbeddingAdapterFactory.get_default_adapter()
 
 
+# ---- 查询向量缓存 ----
+
+
+def _pack_vector(vector: list[float]) -> bytes:
+    """向量压缩为 float32 小端字节（1536 维约 6KB）"""
+    return struct.pack(f"<{len(vector)}f", *vector)
+
+
+def _unpack_vector(data: bytes) -> list[float]:
+    return list(struct.unpack(f"<{len(data) // 4}f", data))
+
+
+class QueryEmbeddingCache:
+    """查询向量两级缓存：进程内 LRU + Redis，按归一化文本的内容哈希寻址。
+
+    Redis 共用 app.core.redis.redis_client（decode_responses=True），
+    因此 float32 字节以 base64 形式存储。Redis 不可用时仅使用进程内缓存。
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local: OrderedDict[str, bytes] = OrderedDict()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(adapter: BaseEmbeddingAdapter, query_text: str) -> str:
+        """缓存键：模型标识 + 归一化文本（合并空白）的 SHA-256"""
+        normalized = " ".join(query_text.split())
+        raw = f"{adapter.model_name}:{adapter.dimensions}:{normalized}"
+        return EMBEDDING_CACHE_PREFIX + hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, key: str) -> list[float] | None:
+        data = self._local.get(key)
+        if data is not None:
+            self._local.move_to_end(key)
+            self.local_hits += 1
+            return _unpack_vector(data)
+
+        try:
+            cached = await redis_client.get(key)
+        except Exception as e:
+            logger.debug("查询向量缓存读取 Redis 失败: %s", e)
+            cached = None
+        if cached:
+            data = base64.b64decode(cached)
+            self._put_local(key, data)
+            self.redis_hits += 1
+            return _unpack_vector(data)
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, vector: list[float]) -> None:
+        data = _pack_vector(vector)
+        self._put_local(key, data)
+        try:
+            await redis_client.set(key, base64.b64encode(data).decode(), ex=self.ttl)
+        except Exception as e:
+            logger.debug("查询向量缓存写入 Redis 失败: %s", e)
+
+    def clear(self) -> None:
+        self._local.clear()
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+            "local_size": len(self._local),
+            "max_entries": self.max_entries,
+        }
+
+    def _put_local(self, key: str, data: bytes) -> None:
+        self._local[key] = data
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+
+settings = get_settings()
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+    ttl=settings.EMBEDDING_CACHE_TTL,
+)
+
+
+async def embed_query(query_text: str) -> list[float]:
+    """生成检索用查询向量，优先命中缓存"""
+    adapter = _get_adapter()
+    key = query_embedding_cache.make_key(adapter, query_text)
+    vector = await query_embedding_cache.get(key)
+    if vector is None:
+        vector = await adapter.embed_text(query_text)
+        await query_embedding_cache.set(key, vector)
+    return vector
+
+
+def get_query_cache_stats() -> dict:
+    """查询向量缓存命中统计"""
+    return query_embedding_cache.stats()
+
+
 async def generate_record_embedding(
     db: AsyncSession, record_id: uuid.UUID
 ) -> bool:
@@ -116,6 +233,7 @@ async def generate_record_embedding(
         logger.warning("病历 %s 无可用文本，跳过 embedding 生成", record_id)
         record.embedding_status = "skipped"
         await db.flush()
+        await db.refresh(record)
         return False
 
     try:
@@ -138,9 +256,16 @@ async def generate_record_embedding(
         logger.error("病历 %s embedding 生成失败: %s", record_id, e)
         record.embedding_status = "failed"
         await db.flush()
+        await db.refresh(record)
         return False
 
 
+@task("record.generate_embedding")
+async def generate_record_embedding_task(db: AsyncSession, record_id: str) -> None:
+    """后台任务：病历创建 / 更新后生成 embedding"""
+    await generate_record_embedding(db, uuid.UUID(record_id))
+
+
 async def batch_generate_embeddings(
     db: AsyncSession,
     batch_size: int = 20,
@@ -215,8 +340,7 @@ async def search_similar_records(
     语义搜索：找到与 query_text 最相似的病历记录。
     返回 [{record, similarity}, ...]
     """
-    adapter = _get_adapter()
-    query_vector = await adapter.embed_text(query_text)
+    query_vector = await embed_query(query_text)
     vector_str = "[" + ",".join(str(v) for v in query_vector) + "]"
 
     # 构建权限条件
@@ -8,6 +8,9 @@ from datetime import datetime, timezone
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.core.tasks import task
+from app.services.principal_cache import principal_cache
+from app.models.conversation import ConversationMessage
 from app.models.user_memory import UserMemory
 
 logger = logging.getLogger(__name__)
@@ -52,10 +55,15 @@ async def update_memory(
 async def build_memory_context(
     db: AsyncSession, user_id: uuid.UUID
 ) -> str:
-    """构建用于注入到 system prompt 的记忆上下文"""
-    memory = await get_or_create_memory(db, user_id)
-    content = memory.content
+    """构建用于注入到 system prompt 的记忆上下文
+
+    走进程内缓存（按 user_memories.updated_at 复用渲染结果）；只读，不为无记忆的用户建记录。
+    """
+    return await principal_cache.get_memory_context(db, user_id, render_memory_context)
+
 
+def render_memory_context(content: dict | None) -> str:
+    """把记忆内容渲染为 markdown 文本；空记忆返回空串"""
     if not content or content == {"preferences": {}, "farm_context": {}, "common_issues": [], "notes": []}:
         return ""
 
@@ -126,3 +134,20 @@ async def extract_memory_updates(
     await db.flush()
     await db.refresh(memory)
     return memory
+
+
+@task("memory.extract_from_conversation")
+async def extract_memory_task(
+    db: AsyncSession, user_id: str, conversation_id: str
+) -> None:
+    """后台任务：对话完成后从全部消息中提取记忆"""
+    result = await db.execute(
+        select(ConversationMessage)
+        .where(ConversationMessage.conversation_id == uuid.UUID(conversation_id))
+        .order_by(ConversationMessage.created_at.asc())
+    )
+    msg_dicts = [
+        {"role": m.role, "content": m.content}
+        for m in result.scalars().all()
+    ]
+    await extract_memory_updates(db, uuid.UUID(user_id), msg_dicts)
@@ -0,0 +1,181 @@
+"""当前用户与记忆上下文进程内缓存
+
+每个认证请求都要按 token 查询 users 表，每轮对话都要读取 user_memories 并重新拼装
+记忆上下文文本。这里缓存两者，稳态下请求热路径不再查询：
+- 用户：缓存脱离会话的快照，命中时以 merge(load=False) 挂到本次请求的会话，
+  不发 SQL，端点照常修改、提交；USER_CACHE_TTL 较短，禁用等变更最坏延迟一个 TTL
+- 记忆上下文：缓存渲染后的文本及对应的 user_memories.updated_at；
+  TTL 到期重新查询时 updated_at 未变则直接复用文本，不重新拼装
+- 失效：会话 flush 了 User / UserMemory 的变更时登记，事务提交后清除本地条目并经
+  Redis pub/sub 广播给其他 worker（含后台任务进程）；回滚不失效
+- 版本号：每次失效递增，加载期间发生失效则丢弃本次结果，避免旧数据回填
+"""
+
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from app.core import after_commit
+from app.core.config import get_settings
+from app.core.invalidation import InvalidationChannel
+from app.models.user import User
+from app.models.user_memory import UserMemory
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+INVALIDATE_CHANNEL = "principals:invalidate"
+_AFTER_COMMIT_KEY = "invalidate_principals"
+
+USER = "user"
+MEMORY = "memory"
+
+
+def _snapshot(user: User) -> User:
+    """复制为脱离会话的已持久化对象，可 merge(load=False) 到任意会话"""
+    snapshot = User(**{c.key: getattr(user, c.key) for c in User.__table__.columns})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+class PrincipalCache:
+    """用户快照与记忆上下文文本的进程内缓存"""
+
+    def __init__(
+        self,
+        user_ttl: float | None = None,
+        memory_ttl: float | None = None,
+        max_entries: int | None = None,
+    ):
+        self.user_ttl = user_ttl if user_ttl is not None else settings.USER_CACHE_TTL
+        self.memory_ttl = memory_ttl if memory_ttl is not None else settings.MEMORY_CONTEXT_CACHE_TTL
+        self.max_entries = max_entries if max_entries is not None else settings.PRINCIPAL_CACHE_SIZE
+        self.version = 0
+        # user_id -> (过期时间, 快照)
+        self._users: dict[uuid.UUID, tuple[float, User]] = {}
+        # user_id -> (过期时间, updated_at, 文本)；过期条目保留以便按 updated_at 复用文本
+        self._memories: dict[uuid.UUID, tuple[float, datetime | None, str]] = {}
+        self.channel = InvalidationChannel(INVALIDATE_CHANNEL, "用户缓存", self._on_message)
+        self.stats = {
+            "user_hits": 0, "user_loads": 0,
+            "memory_hits": 0, "memory_loads": 0, "memory_renders": 0,
+            "invalidations": 0,
+        }
+
+    def _put(self, entries: dict, key: uuid.UUID, value: tuple) -> None:
+        entries.pop(key, None)
+        if len(entries) >= self.max_entries:
+            entries.pop(next(iter(entries)))
+        entries[key] = value
+
+    # ---- 用户 ----
+
+    async def get_user(self, db: AsyncSession, user_id: uuid.UUID) -> User | None:
+        """按 id 获取属于 db 会话的用户；命中缓存时不查询"""
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.stats["user_hits"] += 1
+            return await db.merge(entry[1], load=False)
+
+        version = self.version
+        result = await db.execute(select(User).where(User.id == user_id))
+        user = result.scalar_one_or_none()
+        self.stats["user_loads"] += 1
+        if user is not None and version == self.version:
+            self._put(self._users, user_id, (time.monotonic() + self.user_ttl, _snapshot(user)))
+        return user
+
+    # ---- 记忆上下文 ----
+
+    async def get_memory_context(
+        self,
+        db: AsyncSession,
+        user_id: uuid.UUID,
+        render: Callable[[dict | None], str],
+    ) -> str:
+        """渲染后的记忆上下文；未过期直接返回，过期后 updated_at 未变则复用文本"""
+        entry = self._memories.get(user_id)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self.stats["memory_hits"] += 1
+            return entry[2]
+
+        version = self.version
+        row = (
+            await db.execute(
+                select(UserMemory.content, UserMemory.updated_at)
+                .where(UserMemory.user_id == user_id)
+            )
+        ).first()
+        self.stats["memory_loads"] += 1
+        content, updated_at = row if row is not None else (None, None)
+        if entry is not None and updated_at is not None and entry[1] == updated_at:
+            text = entry[2]
+        else:
+            text = render(content)
+            self.stats["memory_renders"] += 1
+        if version == self.version:
+            self._put(self._memories, user_id, (now + self.memory_ttl, updated_at, text))
+        return text
+
+    # ---- 失效 ----
+
+    def invalidate(self, kind: str | None = None, user_id: uuid.UUID | None = None) -> None:
+        """清除本进程条目；不指定用户时全部清空"""
+        self.version += 1
+        self.stats["invalidations"] += 1
+        if user_id is None:
+            self._users.clear()
+            self._memories.clear()
+            return
+        if kind in (None, USER):
+            self._users.pop(user_id, None)
+        if kind in (None, MEMORY):
+            self._memories.pop(user_id, None)
+
+    def publish_invalidation(self, keys: set[tuple[str, uuid.UUID]]) -> None:
+        """本地失效并广播给其他 worker（同步接口，可在事务提交回调中调用）"""
+        for kind, user_id in keys:
+            self.invalidate(kind, user_id)
+        self.channel.publish(f"{kind}:{user_id}" for kind, user_id in keys)
+
+    def _on_message(self, data: str | None) -> None:
+        if data is None:
+            self.invalidate()
+            return
+        kind, _, user_id = data.partition(":")
+        try:
+            self.invalidate(kind, uuid.UUID(user_id))
+        except ValueError:
+            self.invalidate()
+
+    def start_listener(self) -> None:
+        """启动 pub/sub 监听（应用启动时调用）"""
+        self.channel.start()
+
+    async def stop_listener(self) -> None:
+        await self.channel.stop()
+
+
+principal_cache = PrincipalCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session: Session, flush_context) -> None:
+    """登记本次 flush 涉及的用户 / 记忆，提交后失效"""
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, User) and obj not in session.new:
+            after_commit.defer(session, _AFTER_COMMIT_KEY, (USER, obj.id))
+        elif isinstance(obj, UserMemory):
+            after_commit.defer(session, _AFTER_COMMIT_KEY, (MEMORY, obj.user_id))
+
+
+after_commit.register(
+    _AFTER_COMMIT_KEY, lambda keys: principal_cache.publish_invalidation(set(keys))
+)
@@ -8,11 +8,13 @@ from sqlalchemy import and_, or_, select, func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app.core.tasks import enqueue_after_commit
 from app.models.medical_record import MedicalRecord
 from app.models.record_permission import RecordPermission
 from app.models.record_version import RecordVersion
 from app.models.user import User
 from app.schemas.record import RecordCreate, RecordUpdate
+from app.services import embedding_service  # noqa: F401 — 注册 embedding 后台任务
 from app.services.audit_service import log_action
 
 logger = logging.getLogger(__name__)
@@ -128,13 +130,10 @@ async def create_record(
     )
     db.add(version)
     await db.flush()
+    await db.refresh(record)
 
-    # 异步触发 embedding 生成（失败不阻塞）
-    try:
-        from app.services.embedding_service import generate_record_embedding
-        await generate_record_embedding(db, record.id)
-    except Exception as e:
-        logger.warning("自动 embedding 生成失败 (record=%s): %s", record.id, e)
+    # 事务提交后在后台生成 embedding
+    enqueue_after_commit(db, "record.generate_embedding", record_id=record.id)
 
     return record
 
@@ -194,14 +193,11 @@ async def update_record(
     await db.flush()
     await db.refresh(record)
 
-    # 重新生成 embedding（内容变更后需要刷新）
-    try:
-        record.embedding_status = "pending"
-        await db.flush()
-        from app.services.embedding_service import generate_record_embedding
-        await generate_record_embedding(db, record.id)
-    except Exception as e:
-        logger.warning("更新后 embedding 重新生成失败 (record=%s): %s", record.id, e)
+    # 内容变更后需要刷新 embedding，事务提交后在后台重新生成
+    record.embedding_status = "pending"
+    await db.flush()
+    await db.refresh(record)
+    enqueue_after_commit(db, "record.generate_embedding", record_id=record.id)
 
     return record
 
@@ -9,6 +9,7 @@ from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app.core.tasks import task
 from app.models.clinical import Treatment
 from app.models.medical_record import MedicalRecord
 from app.models.reminder import Reminder
@@ -90,6 +91,14 @@ async def generate_reminders(
     return created_reminders
 
 
+@task("record.generate_reminders")
+async def generate_reminders_task(
+    db: AsyncSession, record_id: str, user_id: str
+) -> None:
+    """后台任务：病历保存后生成跟进提醒"""
+    await generate_reminders(db, uuid.UUID(record_id), uuid.UUID(user_id))
+
+
 async def list_reminders(
     db: AsyncSession,
     user_id: uuid.UUID,
@@ -8,18 +8,25 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.adapters.base import ChatMessage
-from app.adapters.factory import LLMAdapterFactory
-from app.models.ai_model import AIModel
+from app.adapters.router import TASK_SUMMARY, LLMRouter
+from app.core.config import get_settings
+from app.core.tasks import task
 from app.models.conversation import Conversation, ConversationMessage
-from app.utils.encryption import decrypt_api_key
+from app.services.ai_model_cache import ai_model_cache
+from app.utils.token_utils import count_tokens, truncate_tokens
 
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
-SUMMARY_PROMPT = """请为以下禽类兽医对话生成一段简洁的中文摘要（50-100字）。
+SUMMARY_PROMPT = """请为以下禽类兽医对话生成一段简洁的中文摘要（不超过 {max_chars} 字）。
 摘要应包含：禽类类型、主要症状、当前诊断进展、治疗方案（如有）。
+如有已有摘要，请在其基础上结合新增对话更新，而不是只概括新增部分。
 不要使用 JSON 格式，直接输出纯文本摘要。
 
-对话内容：
+已有摘要：
+{previous_summary}
+
+新增对话内容：
 {messages}
 
 已收集信息：
@@ -27,6 +34,11 @@ SUMMARY_PROMPT = """请为以下禽类兽医对话生成一段简洁的中文摘
 
 请直接输出摘要文本："""
 
+# 距上次摘要新增 N 条消息后更新摘要
+SUMMARY_INTERVAL = 4
+# 单次增量摘要最多读取的新消息数（另受 SUMMARY_INPUT_TOKEN_BUDGET 限制）
+SUMMARY_MAX_NEW_MESSAGES = 20
+
 
 async def generate_summary(
     db: AsyncSession,
@@ -39,67 +51,101 @@ async def generate_summary(
     conversation = result.scalar_one_or_none()
     if not conversation:
         return None
+    return await _summarize(db, conversation)
+
 
-    # 获取最近消息
+async def _summarize(db: AsyncSession, conversation: Conversation) -> str | None:
+    """滚动摘要：已有摘要 + 水位之后的新消息，输入与输出均受 token 预算约束
+
+    每次更新从水位起按时间正序读取新增消息，长对话暂停 / 恢复后的摘要成本不随历史长度增长；
+    积压超出预算时只摘要放得下的部分，水位停在最后一条纳入的消息，下次从那里继续。
+    """
+    query = select(ConversationMessage).where(
+        ConversationMessage.conversation_id == conversation.id,
+        ConversationMessage.role.in_(["user", "assistant"]),
+    )
+    if conversation.summarized_until:
+        query = query.where(ConversationMessage.created_at > conversation.summarized_until)
     msg_result = await db.execute(
-        select(ConversationMessage)
-        .where(
-            ConversationMessage.conversation_id == conversation_id,
-            ConversationMessage.role.in_(["user", "assistant"]),
-        )
-        .order_by(ConversationMessage.created_at.desc())
-        .limit(10)
+        query.order_by(ConversationMessage.created_at.asc())
+        .limit(SUMMARY_MAX_NEW_MESSAGES)
     )
-    messages = list(reversed(msg_result.scalars().all()))
+    messages = list(msg_result.scalars().all())
 
     if not messages:
-        return None
+        return conversation.summary
 
-    # 构建消息文本
-    msg_text = "\n".join(
-        f"{'用户' if m.role == 'user' else 'AI'}: {m.content[:200]}"
-        for m in messages
-    )
+    msg_text, included = _build_messages_text(messages, settings.SUMMARY_INPUT_TOKEN_BUDGET)
     collected_text = json.dumps(
-        conversation.collected_info, ensure_ascii=False, indent=2
+        conversation.collected_info, ensure_ascii=False, separators=(",", ":")
     ) if conversation.collected_info else "{}"
 
     prompt = SUMMARY_PROMPT.format(
+        max_chars=max(settings.SUMMARY_TOKEN_BUDGET // 2, 50),
+        previous_summary=conversation.summary or "（无）",
         messages=msg_text,
         collected_info=collected_text,
     )
 
-    try:
-        # 获取 LLM 适配器
-        model_result = await db.execute(
-            select(AIModel).where(AIModel.is_default == True, AIModel.is_active == True)
-        )
-        ai_model = model_result.scalar_one_or_none()
-        if not ai_model:
-            return _fallback_summary(conversation)
-
-        api_key = decrypt_api_key(ai_model.api_key_encrypted)
-        adapter = LLMAdapterFactory.create_adapter(
-            provider=ai_model.provider,
-            api_key=api_key,
-            model_name=ai_model.model_name,
-            api_endpoint=ai_model.api_endpoint,
-            config=ai_model.config,
-        )
+    summary = None
+    # 优先路由到声明承担摘要任务的模型（后台任务不对冲，失败降级即可）
+    models = await ai_model_cache.get_active(db)
+    if models:
+        try:
+            router = LLMRouter(models, TASK_SUMMARY, hedge=False)
+            result = await router.chat_completion([
+                ChatMessage(role="user", content=prompt)
+            ])
+            summary = truncate_tokens(
+                result.response.content.strip(), settings.SUMMARY_TOKEN_BUDGET
+            )
+        except Exception as e:
+            logger.warning("生成摘要失败，保留水位待下次重试: %s", e)
+
+    if summary is None:
+        # 降级摘要只在尚无摘要时填充；水位不动，这批消息下次重新摘要
+        if not conversation.summary:
+            conversation.summary = _fallback_summary(conversation)
+            await db.flush()
+        return conversation.summary
 
-        response = await adapter.chat_completion([
-            ChatMessage(role="user", content=prompt)
-        ])
-        summary = response.content.strip()
+    # 摘要成功后才推进水位，且只推进到最后一条纳入的消息
+    conversation.summary = summary
+    conversation.summarized_until = included[-1].created_at
+    if len(included) == len(messages) < SUMMARY_MAX_NEW_MESSAGES:
+        conversation.summary_message_count = conversation.message_count
+    else:
+        # 仍有积压：计数只加上已纳入的条数，保持待摘要计数以便下次继续
+        conversation.summary_message_count = min(
+            conversation.message_count,
+            (conversation.summary_message_count or 0) + len(included),
+        )
+    await db.flush()
+    return summary
 
-        # 更新到数据库
-        conversation.summary = summary
-        await db.flush()
 
-        return summary
-    except Exception as e:
-        logger.warning("生成摘要失败，使用降级摘要: %s", e)
-        return _fallback_summary(conversation)
+def _build_messages_text(
+    messages: list[ConversationMessage], budget: int
+) -> tuple[str, list[ConversationMessage]]:
+    """从最早的消息往后取，直到用完 token 预算；返回文本与实际纳入的消息
+
+    至少纳入一条（单条超长时截断），保证水位总能前进。
+    """
+    lines: list[str] = []
+    included: list[ConversationMessage] = []
+    used = 0
+    for m in messages:
+        line = f"{'用户' if m.role == 'user' else 'AI'}: {m.content}"
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            if not lines:
+                lines.append(truncate_tokens(line, budget))
+                included.append(m)
+            break
+        lines.append(line)
+        included.append(m)
+        used += tokens
+    return "\n".join(lines), included
 
 
 def _fallback_summary(conversation: Conversation) -> str:
@@ -125,9 +171,7 @@ def _fallback_summary(conversation: Conversation) -> str:
     if not parts:
         return f"对话中，阶段: {conversation.state}"
 
-    summary = "；".join(parts)
-    conversation.summary = summary
-    return summary
+    return "；".join(parts)
 
 
 async def update_summary_if_needed(
@@ -143,14 +187,17 @@ async def update_summary_if_needed(
     if not conversation:
         return None
 
-    # 消息数检查：每隔 4 条消息或强制时更新
-    msg_count_result = await db.execute(
-        select(ConversationMessage)
-        .where(ConversationMessage.conversation_id == conversation_id)
-    )
-    msg_count = len(list(msg_count_result.scalars().all()))
-
-    if not force and conversation.summary and msg_count % 4 != 0:
+    # 消息数检查：距上次摘要新增 SUMMARY_INTERVAL 条消息或强制时更新
+    pending = conversation.message_count - conversation.summary_message_count
+    if not force and pending < SUMMARY_INTERVAL:
         return conversation.summary
 
-    return await generate_summary(db, conversation_id)
+    return await _summarize(db, conversation)
+
+
+@task("conversation.update_summary")
+async def update_summary_task(
+    db: AsyncSession, conversation_id: str, force: bool = False
+) -> None:
+    """后台任务：回复后按需更新摘要"""
+    await update_summary_if_needed(db, uuid.UUID(conversation_id), force=force)
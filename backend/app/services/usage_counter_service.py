@@ -0,0 +1,234 @@
+"""AI 使用量日计数器 — 限额检查 O(1)，不随 ai_usage_logs 增长变慢
+
+按 (日期, 模型, 用户) 在 Redis 哈希中累计 requests / tokens / cost：
+- 记录使用日志时经后台任务原子累加总量，并按日志时间记入分钟槽位增量（r:/t:/c:<槽位>）
+- 总量不存在时由下一次限额检查初始化（之后即为纯 Redis 读取）
+- 计数器在次日结束后过期
+- 定时对账：截止点（当前减 USAGE_COUNTER_RECONCILE_LAG，大于使用日志批量写入窗口）
+  之前的用量以数据库聚合为准，之后的用量取槽位增量，在 Lua 中一次写入；
+  尚在写入器缓冲区或在查询与写入之间产生的用量都不会被覆盖掉
+- Redis 不可用时退回数据库聚合
+"""
+
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.core.tasks import PeriodicJob, task
+from app.models.ai_model import AIUsageLog
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+COUNTER_TTL = 2 * 86400  # 覆盖当天及次日
+SLOT_SECONDS = 60  # 实时增量槽位宽度
+
+# 增量总是记入槽位；总量已初始化时同时累加总量
+_INCR_SCRIPT = """
+local slot = ARGV[3]
+redis.call('HINCRBY', KEYS[1], 'r:' .. slot, 1)
+redis.call('HINCRBY', KEYS[1], 't:' .. slot, ARGV[1])
+redis.call('HINCRBYFLOAT', KEYS[1], 'c:' .. slot, ARGV[2])
+if redis.call('HEXISTS', KEYS[1], 'requests') == 1 then
+    redis.call('HINCRBY', KEYS[1], 'requests', 1)
+    redis.call('HINCRBY', KEYS[1], 'tokens', ARGV[1])
+    redis.call('HINCRBYFLOAT', KEYS[1], 'cost', ARGV[2])
+end
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+return 1
+"""
+
+# 总量 = 截止点之前的数据库聚合（ARGV[2..4]）+ 截止槽位（ARGV[1]）起的槽位增量；
+# 更早的槽位已计入数据库聚合，一并删除。ARGV[6] 为 1 时仅在总量不存在时写入（初始化）
+_RECONCILE_SCRIPT = """
+if ARGV[6] == '1' and redis.call('HEXISTS', KEYS[1], 'requests') == 1 then
+    return redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'cost')
+end
+local cutoff = tonumber(ARGV[1])
+local totals = {r = tonumber(ARGV[2]), t = tonumber(ARGV[3]), c = tonumber(ARGV[4])}
+local stale = {}
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+    local kind, slot = string.match(fields[i], '^(%a):(%d+)$')
+    if slot then
+        if tonumber(slot) >= cutoff then
+            totals[kind] = totals[kind] + tonumber(fields[i + 1])
+        else
+            table.insert(stale, fields[i])
+        end
+    end
+end
+if #stale > 0 then
+    redis.call('HDEL', KEYS[1], unpack(stale))
+end
+local values = {string.format('%d', totals.r), string.format('%d', totals.t), tostring(totals.c)}
+redis.call('HSET', KEYS[1], 'requests', values[1], 'tokens', values[2], 'cost', values[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return values
+"""
+
+
+async def _run_script(source: str, keys: list, args: list):
+    from app.core.redis import redis_client
+
+    return await redis_client.register_script(source)(keys=keys, args=args)
+
+
+def _day_start(now: datetime | None = None) -> datetime:
+    now = now or datetime.now(timezone.utc)
+    return now.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def counter_key(model_id: uuid.UUID | str, user_id: uuid.UUID | str, day: datetime) -> str:
+    return f"usage:{day:%Y%m%d}:{model_id}:{user_id}"
+
+
+def _slot(moment: datetime) -> int:
+    return int(moment.timestamp()) // SLOT_SECONDS
+
+
+def _reconcile_cutoff(now: datetime | None = None) -> tuple[int, datetime]:
+    """对账截止槽位及其起始时间：早于它的使用日志已写入数据库"""
+    now = now or datetime.now(timezone.utc)
+    slot = _slot(now - timedelta(seconds=settings.USAGE_COUNTER_RECONCILE_LAG))
+    return slot, datetime.fromtimestamp(slot * SLOT_SECONDS, timezone.utc)
+
+
+def _parse(values) -> dict:
+    return {
+        "requests": int(values[0] or 0),
+        "tokens": int(values[1] or 0),
+        "cost": float(values[2] or 0),
+    }
+
+
+async def _aggregate(
+    db: AsyncSession,
+    model_id: uuid.UUID,
+    user_id: uuid.UUID,
+    day: datetime,
+    until: datetime | None = None,
+) -> dict:
+    """从使用日志聚合当日用量（指定 until 时只统计其之前的日志）"""
+    end = day + timedelta(days=1)
+    if until is not None:
+        end = min(end, until)
+    result = await db.execute(
+        select(
+            func.count().label("requests"),
+            func.sum(AIUsageLog.total_tokens).label("tokens"),
+            func.sum(AIUsageLog.cost).label("cost"),
+        ).where(
+            AIUsageLog.model_id == model_id,
+            AIUsageLog.user_id == user_id,
+            AIUsageLog.created_at >= day,
+            AIUsageLog.created_at < end,
+        )
+    )
+    row = result.one()
+    return _parse((row.requests, row.tokens, row.cost))
+
+
+async def get_daily_usage(
+    db: AsyncSession, model_id: uuid.UUID, user_id: uuid.UUID
+) -> dict:
+    """当日用量 {"requests", "tokens", "cost"}；优先读 Redis 计数器"""
+    from app.core.redis import redis_client
+
+    day = _day_start()
+    key = counter_key(model_id, user_id, day)
+    try:
+        values = await redis_client.hmget(key, "requests", "tokens", "cost")
+    except Exception as e:
+        logger.warning("读取用量计数器失败，改为数据库聚合: %s", e)
+        return await _aggregate(db, model_id, user_id, day)
+
+    if values[0] is not None:
+        return _parse(values)
+
+    # 初始化：截止点之前取数据库聚合，之后取槽位增量（未写入数据库的日志也已计入）
+    cutoff_slot, cutoff = _reconcile_cutoff()
+    base = await _aggregate(db, model_id, user_id, day, until=cutoff)
+    try:
+        values = await _run_script(
+            _RECONCILE_SCRIPT,
+            keys=[key],
+            args=[cutoff_slot, base["requests"], base["tokens"], repr(base["cost"]), COUNTER_TTL, 1],
+        )
+    except Exception as e:
+        logger.warning("初始化用量计数器失败，改为数据库聚合: %s", e)
+        return await _aggregate(db, model_id, user_id, day)
+    return _parse(values)
+
+
+@task("usage.increment_counters")
+async def increment_counters_task(
+    db: AsyncSession,
+    model_id: str,
+    user_id: str,
+    tokens: int,
+    cost: float,
+    created_at: str,
+) -> None:
+    """记录使用日志时累加计数器（失败不重试，由定时对账修正）"""
+    moment = datetime.fromisoformat(created_at)
+    day = _day_start(moment)
+    try:
+        await _run_script(
+            _INCR_SCRIPT,
+            keys=[counter_key(model_id, user_id, day)],
+            args=[tokens, repr(cost), _slot(moment), COUNTER_TTL],
+        )
+    except Exception as e:
+        logger.warning("累加用量计数器失败: %s", e)
+
+
+@task("usage.reconcile_counters")
+async def reconcile_counters_task(db: AsyncSession) -> None:
+    """截止点之前以使用日志聚合为准、之后以槽位增量为准，重写当日计数器"""
+    day = _day_start()
+    cutoff_slot, cutoff = _reconcile_cutoff()
+    if cutoff <= day:
+        return
+    result = await db.execute(
+        select(
+            AIUsageLog.model_id,
+            AIUsageLog.user_id,
+            func.count().label("requests"),
+            func.sum(AIUsageLog.total_tokens).label("tokens"),
+            func.sum(AIUsageLog.cost).label("cost"),
+        )
+        .where(AIUsageLog.created_at >= day, AIUsageLog.created_at < cutoff)
+        .group_by(AIUsageLog.model_id, AIUsageLog.user_id)
+    )
+    rows = result.all()
+    if not rows:
+        return
+
+    from app.core.redis import redis_client
+
+    script = redis_client.register_script(_RECONCILE_SCRIPT)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for row in rows:
+            await script(
+                keys=[counter_key(row.model_id, row.user_id, day)],
+                args=[
+                    cutoff_slot, int(row.requests or 0), int(row.tokens or 0),
+                    repr(float(row.cost or 0)), COUNTER_TTL, 0,
+                ],
+                client=pipe,
+            )
+        await pipe.execute()
+    logger.info("用量计数器对账完成: %d 项", len(rows))
+
+
+# 计数器仅存在于 Redis，Redis 不可用时无需对账
+usage_reconciler = PeriodicJob(
+    "usage.reconcile_counters", settings.USAGE_COUNTER_RECONCILE_INTERVAL
+)
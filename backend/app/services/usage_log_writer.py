@@ -0,0 +1,129 @@
+"""AI 使用日志批量写入
+
+每次 LLM 调用都要写一条 ai_usage_logs。这里把日志行缓冲在内存中，
+按条数阈值或定时批量插入（多行 INSERT），请求事务中不再有这次写入和往返：
+- 缓冲区满或写入器不可用时，由调用方退回在请求事务内直接写入
+- 批量写入失败时日志行放回缓冲区，下次重试
+- 应用关闭时（main.py lifespan）把剩余日志写完
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core.config import get_settings
+from app.models.ai_model import AIUsageLog
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+class UsageLogWriter:
+    """使用日志缓冲写入器"""
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        max_buffer: int = 10000,
+        session_factory: async_sessionmaker | None = None,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._session_factory = session_factory
+        self._buffer: list[dict] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock: asyncio.Lock | None = None
+        self._flusher: asyncio.Task | None = None
+        self._pending_flush: asyncio.Task | None = None
+        self.stats = {"buffered": 0, "written": 0, "batches": 0, "failed_batches": 0}
+
+    @property
+    def session_factory(self) -> async_sessionmaker:
+        if self._session_factory is None:
+            from app.core.database import AsyncSessionLocal
+            self._session_factory = AsyncSessionLocal
+        return self._session_factory
+
+    @session_factory.setter
+    def session_factory(self, factory: async_sessionmaker) -> None:
+        self._session_factory = factory
+
+    # ---- 生命周期 ----
+
+    def start(self) -> None:
+        """在当前事件循环启动定时写入任务（首次提交时自动调用）"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._flusher and not self._flusher.done():
+            return
+        self._loop = loop
+        self._lock = asyncio.Lock()
+        self._flusher = loop.create_task(self._run(), name="usage-log-flusher")
+
+    async def stop(self) -> None:
+        """停止定时任务并写完剩余日志"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if self._pending_flush is not None:
+            await asyncio.gather(self._pending_flush, return_exceptions=True)
+        if self._buffer and not await self.flush():
+            logger.error("关闭时使用日志写入失败，丢弃 %d 条", len(self._buffer))
+            self._buffer = []
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # ---- 写入 ----
+
+    def submit(self, row: dict) -> bool:
+        """缓冲一条日志（列名 -> 值，须含 id 与 created_at），返回 False 表示调用方需直接写入"""
+        try:
+            self.start()
+        except RuntimeError:  # 无运行中的事件循环
+            return False
+        if len(self._buffer) >= self.max_buffer:
+            return False
+        self._buffer.append(row)
+        self.stats["buffered"] += 1
+        if len(self._buffer) >= self.batch_size and (
+            self._pending_flush is None or self._pending_flush.done()
+        ):
+            self._pending_flush = self._loop.create_task(self.flush())
+        return True
+
+    async def flush(self) -> bool:
+        """把缓冲区中的日志批量插入数据库，返回是否全部写入"""
+        if self._lock is None:
+            return not self._buffer
+        async with self._lock:
+            while self._buffer:
+                rows = self._buffer[: self.batch_size]
+                self._buffer = self._buffer[self.batch_size:]
+                try:
+                    async with self.session_factory() as db:
+                        # executemany 由驱动合并为多行 INSERT（asyncpg 下为 insertmanyvalues）
+                        await db.execute(insert(AIUsageLog), rows)
+                        await db.commit()
+                except Exception as e:
+                    self.stats["failed_batches"] += 1
+                    # 放回缓冲区头部等待下次写入，超出上限的最旧日志丢弃
+                    self._buffer = (rows + self._buffer)[-self.max_buffer:]
+                    logger.warning("使用日志批量写入失败（%d 条待重试）: %s", len(self._buffer), e)
+                    return False
+                self.stats["batches"] += 1
+                self.stats["written"] += len(rows)
+        return True
+
+
+usage_log_writer = UsageLogWriter(
+    batch_size=settings.USAGE_LOG_BATCH_SIZE,
+    flush_interval=settings.USAGE_LOG_FLUSH_INTERVAL,
+    max_buffer=settings.USAGE_LOG_MAX_BUFFER,
+)
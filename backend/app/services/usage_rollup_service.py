@@ -0,0 +1,267 @@
+"""AI 使用量汇总 — 统计接口按时间段读取预聚合数据
+
+ai_usage_logs 按 (模型, 用户, 状态) 逐小时汇总为 hour 行，已汇总完的整天再并为 day 行：
+- 定时任务 usage.rollup 增量推进水位；小时结束后再等 ROLLUP_GRACE，等缓冲中的使用日志落库，
+  且每次重算水位前最近 ROLLUP_RECOMPUTE_HOURS 个小时（及其所在的整天），补上迟到的日志
+- 汇总行按唯一键 upsert（ON CONFLICT DO UPDATE），多进程同时执行也得到同一结果；
+  使用日志只增不改，桶内的 (模型, 用户, 状态) 组合只会增加
+- 查询把区间拆为三段：水位前的整天读 day 行，其余已汇总的小时读 hour 行，
+  只有尚未汇总的最近一段扫描原始日志
+"""
+
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import case, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.core.tasks import PeriodicJob, task
+from app.models.ai_model import AIUsageLog, AIUsageRollup, AIUsageRollupWatermark
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+ROLLUP_GRACE = timedelta(minutes=5)
+# 单次最多汇总的小时数（首次上线回填历史日志时分多次完成）
+ROLLUP_MAX_HOURS_PER_RUN = 24 * 7
+# 每次重算的已汇总小时数（覆盖写入失败后重试落库等迟到的使用日志）
+ROLLUP_RECOMPUTE_HOURS = 6
+
+# 汇总指标列名
+_METRICS = (
+    "requests", "request_tokens", "response_tokens", "total_tokens",
+    "cached_tokens", "cost", "latency_ms_sum",
+)
+
+
+def _utc(dt: datetime) -> datetime:
+    """数据库返回的时间统一为 UTC aware（SQLite 不保存时区）"""
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def _floor_hour(dt: datetime) -> datetime:
+    return _utc(dt).replace(minute=0, second=0, microsecond=0)
+
+
+def _floor_day(dt: datetime) -> datetime:
+    return _floor_hour(dt).replace(hour=0)
+
+
+def _log_metrics() -> dict:
+    return {
+        "requests": func.count(),
+        "request_tokens": func.sum(AIUsageLog.request_tokens),
+        "response_tokens": func.sum(AIUsageLog.response_tokens),
+        "total_tokens": func.sum(AIUsageLog.total_tokens),
+        "cached_tokens": func.sum(AIUsageLog.cached_tokens),
+        "cost": func.sum(AIUsageLog.cost),
+        "latency_ms_sum": func.sum(AIUsageLog.latency_ms),
+    }
+
+
+def _rollup_metrics() -> dict:
+    return {name: func.sum(getattr(AIUsageRollup, name)) for name in _METRICS}
+
+
+# ---- 水位 ----
+
+
+async def _upsert(db: AsyncSession, table, rows: list[dict], keys: list[str], updates: list[str]):
+    """按唯一键批量插入，冲突时覆盖 updates 列（PostgreSQL / SQLite）"""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys, set_={name: stmt.excluded[name] for name in updates}
+    )
+    await db.execute(stmt, rows)
+
+
+async def _get_watermark(db: AsyncSession, period: str) -> datetime | None:
+    until = await db.scalar(
+        select(AIUsageRollupWatermark.rolled_until).where(AIUsageRollupWatermark.period == period)
+    )
+    return _utc(until) if until else None
+
+
+async def _set_watermark(db: AsyncSession, period: str, until: datetime) -> None:
+    await _upsert(
+        db, AIUsageRollupWatermark, [{"period": period, "rolled_until": until}],
+        keys=["period"], updates=["rolled_until"],
+    )
+
+
+# ---- 汇总 ----
+
+
+async def _rollup_bucket(db: AsyncSession, period: str, start: datetime) -> int:
+    """重算一个时间桶：hour 桶读原始日志，day 桶读当天的 hour 行"""
+    if period == "hour":
+        src, time_col, metrics, end = AIUsageLog, AIUsageLog.created_at, _log_metrics(), start + HOUR
+    else:
+        src, time_col, metrics, end = (
+            AIUsageRollup, AIUsageRollup.bucket_start, _rollup_metrics(), start + DAY
+        )
+    query = select(
+        src.model_id, src.user_id, src.status, *(e.label(n) for n, e in metrics.items())
+    )
+    if period == "day":
+        query = query.where(AIUsageRollup.period == "hour")
+    result = await db.execute(
+        query.where(time_col >= start, time_col < end)
+        .group_by(src.model_id, src.user_id, src.status)
+    )
+    rows = [
+        {
+            "id": uuid.uuid4(), "period": period, "bucket_start": start,
+            "model_id": row.model_id, "user_id": row.user_id, "status": row.status,
+            **{name: getattr(row, name) or 0 for name in _METRICS},
+        }
+        for row in result.all()
+    ]
+
+    if rows:
+        await _upsert(
+            db, AIUsageRollup, rows,
+            keys=["period", "bucket_start", "model_id", "user_id", "status"],
+            updates=list(_METRICS),
+        )
+    return len(rows)
+
+
+async def rollup_usage(db: AsyncSession, now: datetime | None = None) -> dict:
+    """推进 hour / day 汇总水位并重算最近已汇总的桶，返回 {"hour": 新水位, "day": 新水位}"""
+    now = now or datetime.now(timezone.utc)
+
+    # 1. 已结束（且过了宽限期）的小时；水位前最近 ROLLUP_RECOMPUTE_HOURS 个小时重算
+    hour_cutoff = _floor_hour(now - ROLLUP_GRACE)
+    hour_wm = await _get_watermark(db, "hour")
+    if hour_wm is None:
+        first = await db.scalar(select(func.min(AIUsageLog.created_at)))
+        hour_wm = _floor_hour(first) if first else hour_cutoff
+        recompute_from = hour_wm
+    else:
+        recompute_from = min(hour_wm, hour_cutoff - ROLLUP_RECOMPUTE_HOURS * HOUR)
+    bucket, hours = recompute_from, 0
+    while bucket < hour_wm:
+        await _rollup_bucket(db, "hour", bucket)
+        bucket += HOUR
+    while hour_wm < hour_cutoff and hours < ROLLUP_MAX_HOURS_PER_RUN:
+        await _rollup_bucket(db, "hour", hour_wm)
+        hour_wm += HOUR
+        hours += 1
+    await _set_watermark(db, "hour", hour_wm)
+
+    # 2. 小时已全部汇总的整天；重算过小时的已汇总整天一并重算
+    day_cutoff = _floor_day(hour_wm)
+    day_wm = await _get_watermark(db, "day")
+    if day_wm is None:
+        first = await db.scalar(
+            select(func.min(AIUsageRollup.bucket_start)).where(AIUsageRollup.period == "hour")
+        )
+        day_wm = _floor_day(first) if first else day_cutoff
+    day = min(day_wm, _floor_day(recompute_from))
+    while day < day_wm:
+        await _rollup_bucket(db, "day", day)
+        day += DAY
+    while day_wm < day_cutoff:
+        await _rollup_bucket(db, "day", day_wm)
+        day_wm += DAY
+    await _set_watermark(db, "day", day_wm)
+
+    if hours:
+        logger.info("使用量汇总完成: %d 小时，小时水位 %s，天水位 %s", hours, hour_wm, day_wm)
+    return {"hour": hour_wm, "day": day_wm}
+
+
+@task("usage.rollup")
+async def rollup_usage_task(db: AsyncSession) -> None:
+    await rollup_usage(db)
+
+
+# 汇总按唯一键 upsert，可并发、可重复，Redis 不可用时各进程照常执行
+usage_rollup_job = PeriodicJob("usage.rollup", settings.USAGE_ROLLUP_INTERVAL, run_without_lock=True)
+
+
+# ---- 查询 ----
+
+
+def _clip(
+    start: datetime | None, end: datetime | None, lo: datetime | None, hi: datetime | None
+) -> tuple[datetime | None, datetime | None] | None:
+    """区间 [start, end) 与 [lo, hi) 的交集，None 表示无界；为空时返回 None"""
+    s = max(filter(None, (start, lo)), default=None)
+    e = min(filter(None, (end, hi)), default=None)
+    if s is not None and e is not None and s >= e:
+        return None
+    return s, e
+
+
+async def query_usage_by_model(
+    db: AsyncSession,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    model_id: uuid.UUID | None = None,
+    user_id: uuid.UUID | None = None,
+) -> dict[uuid.UUID, dict]:
+    """按模型汇总 [start, end) 内的使用量（start / end 须按天对齐，None 表示无界）
+
+    返回 model_id -> {requests, request_tokens, ..., latency_ms_sum, success_count, error_count}
+    """
+    day_wm = await _get_watermark(db, "day")
+    hour_wm = await _get_watermark(db, "hour")
+    if hour_wm is None:
+        day_wm = None
+    elif day_wm is None or day_wm > hour_wm:
+        day_wm = hour_wm
+
+    # (来源, 区间)：整天 day 行 → 已汇总的 hour 行 → 未汇总的原始日志
+    segments = []
+    if day_wm is not None:
+        segments.append(("day", _clip(start, end, None, day_wm)))
+        segments.append(("hour", _clip(start, end, day_wm, hour_wm)))
+        segments.append(("raw", _clip(start, end, hour_wm, None)))
+    else:
+        segments.append(("raw", (start, end)))
+
+    totals: dict[uuid.UUID, dict] = {}
+    for source, window in segments:
+        if window is None:
+            continue
+        if source == "raw":
+            src, time_col, metrics = AIUsageLog, AIUsageLog.created_at, _log_metrics()
+            requests = 1
+        else:
+            src, time_col, metrics = AIUsageRollup, AIUsageRollup.bucket_start, _rollup_metrics()
+            requests = AIUsageRollup.requests
+        query = select(
+            src.model_id,
+            *(e.label(n) for n, e in metrics.items()),
+            func.sum(case((src.status == "success", requests), else_=0)).label("success_count"),
+            func.sum(case((src.status != "success", requests), else_=0)).label("error_count"),
+        )
+        if source != "raw":
+            query = query.where(AIUsageRollup.period == source)
+
+        lo, hi = window
+        if lo is not None:
+            query = query.where(time_col >= lo)
+        if hi is not None:
+            query = query.where(time_col < hi)
+        if model_id:
+            query = query.where(src.model_id == model_id)
+        if user_id:
+            query = query.where(src.user_id == user_id)
+
+        result = await db.execute(query.group_by(src.model_id))
+        for row in result.all():
+            acc = totals.setdefault(row.model_id, dict.fromkeys(
+                (*_METRICS, "success_count", "error_count"), 0
+            ))
+            for name in acc:
+                acc[name] += getattr(row, name) or 0
+    return totals
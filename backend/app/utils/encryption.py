@@ -1,21 +1,31 @@
-"""API Key 加密工具 - 使用 Fernet 对称加密"""
+"""API Key 加密工具 - 使用 Fernet 对称加密
+
+PBKDF2 密钥派生（10 万次迭代）按 (SECRET_KEY, salt) 在进程内只做一次；
+解密后的 API Key 按密文摘要短时缓存，密钥轮换时显式失效。
+"""
 
 import base64
 import hashlib
+import time
+from functools import lru_cache
 
 from cryptography.fernet import Fernet
 
 from app.core.config import get_settings
 
+# 解密结果缓存：密文 SHA-256 -> (过期时间, 明文)
+DECRYPTED_KEY_TTL = 300  # 秒
+DECRYPTED_KEY_MAX_ENTRIES = 256
+_decrypted_keys: dict[str, tuple[float, str]] = {}
 
-def _get_fernet() -> Fernet:
-    """从 SECRET_KEY 派生 Fernet 密钥"""
-    settings = get_settings()
-    # 使用 PBKDF2 从 SECRET_KEY + salt 派生 32 字节密钥
+
+@lru_cache(maxsize=4)
+def _derive_fernet(secret_key: str, salt: str) -> Fernet:
+    """使用 PBKDF2 从 SECRET_KEY + salt 派生 Fernet 密钥（进程内缓存）"""
     dk = hashlib.pbkdf2_hmac(
         "sha256",
-        settings.SECRET_KEY.encode(),
-        settings.AI_ENCRYPTION_SALT.encode(),
+        secret_key.encode(),
+        salt.encode(),
         iterations=100_000,
     )
     # Fernet 需要 url-safe base64 编码的 32 字节密钥
@@ -23,6 +33,16 @@ def _get_fernet() -> Fernet:
     return Fernet(key)
 
 
+def _get_fernet() -> Fernet:
+    """从 SECRET_KEY 派生 Fernet 密钥"""
+    settings = get_settings()
+    return _derive_fernet(settings.SECRET_KEY, settings.AI_ENCRYPTION_SALT)
+
+
+def _digest(ciphertext: str) -> str:
+    return hashlib.sha256(ciphertext.encode()).hexdigest()
+
+
 def encrypt_api_key(plaintext: str) -> str:
     """加密 API Key"""
     f = _get_fernet()
@@ -30,6 +50,29 @@ def encrypt_api_key(plaintext: str) -> str:
 
 
 def decrypt_api_key(ciphertext: str) -> str:
-    """解密 API Key"""
+    """解密 API Key（命中缓存时不做解密运算）"""
+    digest = _digest(ciphertext)
+    now = time.monotonic()
+    cached = _decrypted_keys.get(digest)
+    if cached and cached[0] > now:
+        return cached[1]
+
     f = _get_fernet()
-    return f.decrypt(ciphertext.encode()).decode()
+    plaintext = f.decrypt(ciphertext.encode()).decode()
+
+    if len(_decrypted_keys) >= DECRYPTED_KEY_MAX_ENTRIES:
+        # 先清理过期项，仍超限则整体清空（条目极少，无需 LRU）
+        for key in [k for k, (exp, _) in _decrypted_keys.items() if exp <= now]:
+            del _decrypted_keys[key]
+        if len(_decrypted_keys) >= DECRYPTED_KEY_MAX_ENTRIES:
+            _decrypted_keys.clear()
+    _decrypted_keys[digest] = (now + DECRYPTED_KEY_TTL, plaintext)
+    return plaintext
+
+
+def invalidate_decrypted_key(ciphertext: str | None = None) -> None:
+    """移除已缓存的明文 Key；ciphertext 为空时清空全部（如密钥轮换后）"""
+    if ciphertext is None:
+        _decrypted_keys.clear()
+    else:
+        _decrypted_keys.pop(_digest(ciphertext), None)
@@ -0,0 +1,133 @@
+"""按 token 预算组装 LLM prompt
+
+每个 section 有自己的 token 上限和优先级（数值越小越重要）：
+1. 先把各 section 裁剪到自身上限（文本截断；历史消息从最早的开始丢弃）
+2. 总量仍超出时，按优先级从低到高继续压缩，直到落入总预算
+build() 同时返回各 section 的 token 报告，便于记录到使用日志。
+"""
+
+from dataclasses import dataclass, field
+
+from app.adapters.base import ChatMessage
+from app.utils.token_utils import count_tokens, truncate_tokens
+
+# 历史消息至少保留最近 N 条（含本轮用户消息）
+MIN_HISTORY_MESSAGES = 2
+
+
+@dataclass
+class PromptSection:
+    name: str
+    content: str = ""
+    priority: int = 0
+    budget: int | None = None
+    role: str = "system"
+    # 跨轮次不变的静态内容，可命中厂商 prompt 缓存
+    cacheable: bool = False
+    # 已知 token 数（静态 section 预先计算，避免每轮重复计数）
+    tokens: int | None = None
+    history: list[ChatMessage] | None = None
+    history_tokens: list[int] = field(default_factory=list)
+
+    @property
+    def total_tokens(self) -> int:
+        if self.history is not None:
+            return sum(self.history_tokens)
+        if self.tokens is None:
+            self.tokens = count_tokens(self.content)
+        return self.tokens
+
+
+class PromptAssembler:
+    """按 section 组装消息列表，超出预算时按优先级裁剪"""
+
+    def __init__(self, total_budget: int):
+        self.total_budget = total_budget
+        self.sections: list[PromptSection] = []
+        self.trimmed: list[str] = []
+
+    def add(
+        self,
+        name: str,
+        content: str,
+        priority: int,
+        budget: int | None = None,
+        role: str = "system",
+        tokens: int | None = None,
+        cacheable: bool = False,
+    ) -> None:
+        if not content:
+            return
+        self.sections.append(PromptSection(
+            name=name, content=content, priority=priority, budget=budget,
+            role=role, tokens=tokens, cacheable=cacheable,
+        ))
+
+    def add_history(
+        self, name: str, messages: list[ChatMessage], priority: int, budget: int | None = None
+    ) -> None:
+        self.sections.append(PromptSection(
+            name=name, priority=priority, budget=budget,
+            history=list(messages),
+            history_tokens=[count_tokens(m.content) for m in messages],
+        ))
+
+    # ---- 裁剪 ----
+
+    def _shrink(self, section: PromptSection, limit: int) -> None:
+        """把 section 压缩到 limit 个 token 以内"""
+        if section.total_tokens <= limit:
+            return
+        self.trimmed.append(section.name)
+        if section.history is not None:
+            while (
+                len(section.history) > MIN_HISTORY_MESSAGES
+                and sum(section.history_tokens) > limit
+            ):
+                section.history.pop(0)
+                section.history_tokens.pop(0)
+            return
+        if limit <= 0:
+            section.content = ""
+            section.tokens = 0
+        else:
+            section.content = truncate_tokens(section.content, limit)
+            section.tokens = count_tokens(section.content)
+
+    def _fit(self) -> None:
+        for section in self.sections:
+            if section.budget is not None:
+                self._shrink(section, section.budget)
+
+        total = sum(s.total_tokens for s in self.sections)
+        for section in sorted(self.sections, key=lambda s: -s.priority):
+            if total <= self.total_budget:
+                break
+            if section.priority == 0:
+                continue  # 优先级 0 的 section 不裁剪
+            before = section.total_tokens
+            self._shrink(section, max(before - (total - self.total_budget), 0))
+            total -= before - section.total_tokens
+
+    # ---- 输出 ----
+
+    def build(self) -> tuple[list[ChatMessage], dict]:
+        """返回 (消息列表, token 报告)"""
+        self._fit()
+
+        messages: list[ChatMessage] = []
+        report: dict = {}
+        for section in self.sections:
+            report[section.name] = section.total_tokens
+            if section.history is not None:
+                messages.extend(section.history)
+            elif section.content:
+                messages.append(ChatMessage(
+                    role=section.role, content=section.content, cacheable=section.cacheable,
+                ))
+
+        report["total"] = sum(v for v in report.values())
+        report["budget"] = self.total_budget
+        if self.trimmed:
+            report["trimmed"] = sorted(set(self.trimmed))
+        return messages, report
@@ -0,0 +1,271 @@
+"""LLM JSON 信封的增量解析器
+
+对话模型按约定输出 {"reply": "...", "extracted_info": {...}, ...}。流式场景下：
+- reply 字符串边到达边解码（处理转义、\\uXXXX 及代理对），只把自然语言文本推给前端
+- extracted_info 中每个字段的值一闭合就 json 解析并产出增量
+- 其他字段（confidence_scores 等）只跳过，流结束后仍由完整解析兜底
+"""
+
+import json
+from typing import Any
+
+# 顶层状态
+_SEEK_OBJECT = 0   # 等待信封起始 "{"（跳过 ```json 等前缀）
+_KEY_SEEK = 1      # 等待下一个键
+_KEY = 2           # 读取键字符串
+_COLON = 3         # 等待 ":"
+_VALUE_START = 4   # 等待值起始
+_REPLY = 5         # 解码 reply 字符串
+_FIELD_KEY_SEEK = 6
+_FIELD_KEY = 7
+_FIELD_COLON = 8
+_FIELD_VALUE = 9   # 捕获 extracted_info 中某字段的原始值
+_SKIP_VALUE = 10   # 跳过其他顶层字段的值
+_DONE = 11
+
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _RawValue:
+    """按字符捕获一个完整 JSON 值的原始文本（字符串/对象/数组/标量）"""
+
+    def __init__(self) -> None:
+        self.chars: list[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._scalar = False
+
+    def push(self, ch: str) -> tuple[bool, bool]:
+        """返回 (值是否结束, 当前字符是否被本值消费)"""
+        if not self.chars:
+            if ch.isspace():
+                return False, True
+            self.chars.append(ch)
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth = 1
+            else:
+                self._scalar = True
+            return False, True
+
+        if self._scalar:
+            # 数字/true/false/null 以分隔符结束，分隔符交还上层处理
+            if ch in ",}]" or ch.isspace():
+                return True, False
+            self.chars.append(ch)
+            return False, True
+
+        self.chars.append(ch)
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                return self._depth == 0, True
+            return False, True
+
+        if ch == '"':
+            self._in_string = True
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]":
+            self._depth -= 1
+            return self._depth == 0, True
+        return False, True
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chars)
+
+
+class StreamingReplyParser:
+    """增量解析 LLM JSON 信封
+
+    feed() 返回本次新产生的事件列表：
+    - ("reply", str)：reply 新解码的文本片段
+    - ("field", (key, value))：extracted_info 中刚闭合的字段
+    """
+
+    def __init__(self, reply_key: str = "reply", fields_key: str = "extracted_info") -> None:
+        self.reply_key = reply_key
+        self.fields_key = fields_key
+        self._state = _SEEK_OBJECT
+        self._key_chars: list[str] = []
+        self._key_escape = False
+        self._key = ""
+        self._field_key = ""
+        self._value: _RawValue | None = None
+        # reply 转义解码状态
+        self._escape: str | None = None
+        self._high_surrogate: str | None = None
+        self.reply_started = False
+        self.reply_chars: list[str] = []
+        self.fields: dict[str, Any] = {}
+
+    @property
+    def reply(self) -> str:
+        """已解码的 reply 文本"""
+        return "".join(self.reply_chars)
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        events: list[tuple[str, Any]] = []
+        reply_start = len(self.reply_chars)
+        for ch in chunk:
+            if self._state == _DONE:
+                break
+            field = self._step(ch)
+            if field is not None:
+                # 字段事件之前的 reply 片段先行产出，保持顺序
+                if len(self.reply_chars) > reply_start:
+                    events.append(("reply", "".join(self.reply_chars[reply_start:])))
+                    reply_start = len(self.reply_chars)
+                events.append(("field", field))
+        if len(self.reply_chars) > reply_start:
+            events.append(("reply", "".join(self.reply_chars[reply_start:])))
+        return events
+
+    # ---- 状态机 ----
+
+    def _step(self, ch: str) -> tuple[str, Any] | None:
+        state = self._state
+
+        if state == _SEEK_OBJECT:
+            if ch == "{":
+                self._state = _KEY_SEEK
+            return None
+
+        if state in (_KEY_SEEK, _FIELD_KEY_SEEK):
+            if ch == '"':
+                self._key_chars = []
+                self._key_escape = False
+                self._state = _KEY if state == _KEY_SEEK else _FIELD_KEY
+            elif ch == "}":
+                self._state = _DONE if state == _KEY_SEEK else _KEY_SEEK
+            return None
+
+        if state in (_KEY, _FIELD_KEY):
+            if self._key_escape:
+                self._key_escape = False
+            elif ch == "\\":
+                self._key_escape = True
+            elif ch == '"':
+                key = _loads_string("".join(self._key_chars))
+                if state == _KEY:
+                    self._key = key
+                    self._state = _COLON
+                else:
+                    self._field_key = key
+                    self._state = _FIELD_COLON
+                return None
+            self._key_chars.append(ch)
+            return None
+
+        if state == _COLON:
+            if ch == ":":
+                self._state = _VALUE_START
+            return None
+
+        if state == _FIELD_COLON:
+            if ch == ":":
+                self._value = _RawValue()
+                self._state = _FIELD_VALUE
+            return None
+
+        if state == _VALUE_START:
+            if ch.isspace():
+                return None
+            if self._key == self.reply_key and ch == '"':
+                self.reply_started = True
+                self._state = _REPLY
+                return None
+            if self._key == self.fields_key and ch == "{":
+                self._state = _FIELD_KEY_SEEK
+                return None
+            self._value = _RawValue()
+            self._state = _SKIP_VALUE
+            return self._step(ch)
+
+        if state == _REPLY:
+            self._decode_reply_char(ch)
+            return None
+
+        if state in (_FIELD_VALUE, _SKIP_VALUE):
+            finished, consumed = self._value.push(ch)
+            if not finished:
+                return None
+            raw = self._value.text
+            self._value = None
+            field = None
+            if state == _FIELD_VALUE:
+                self._state = _FIELD_KEY_SEEK
+                try:
+                    value = json.loads(raw)
+                except json.JSONDecodeError:
+                    value = None
+                else:
+                    self.fields[self._field_key] = value
+                    field = (self._field_key, value)
+            else:
+                self._state = _KEY_SEEK
+            if not consumed:
+                # 标量值的结束符（"," / "}"）属于上层结构
+                self._step(ch)
+            return field
+
+        return None
+
+    def _decode_reply_char(self, ch: str) -> None:
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] == "u":
+                if len(self._escape) < 5:
+                    return
+                try:
+                    decoded = chr(int(self._escape[1:], 16))
+                except ValueError:
+                    decoded = ""
+            else:
+                decoded = _SIMPLE_ESCAPES.get(ch, ch)
+            self._escape = None
+            self._emit_reply_char(decoded)
+            return
+
+        if ch == "\\":
+            self._escape = ""
+        elif ch == '"':
+            self._state = _KEY_SEEK
+            if self._high_surrogate:
+                self.reply_chars.append(self._high_surrogate)
+                self._high_surrogate = None
+        else:
+            self._emit_reply_char(ch)
+
+    def _emit_reply_char(self, ch: str) -> None:
+        if not ch:
+            return
+        code = ord(ch)
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = ch
+            return
+        if self._high_surrogate:
+            if 0xDC00 <= code <= 0xDFFF:
+                ch = (self._high_surrogate + ch).encode("utf-16", "surrogatepass").decode("utf-16")
+            else:
+                self.reply_chars.append(self._high_surrogate)
+            self._high_surrogate = None
+        self.reply_chars.append(ch)
+
+
+def _loads_string(raw: str) -> str:
+    try:
+        return json.loads(f'"{raw}"')
+    except json.JSONDecodeError:
+        return raw
@@ -14,6 +14,30 @@ def count_tokens(text: str) -> int:
     return len(_encoding.encode(text))
 
 
+def truncate_tokens(text: str, budget: int) -> str:
+    """按 token 数截断文本，不会截出半个字符"""
+    if not text or budget <= 0:
+        return ""
+    tokens = _encoding.encode(text)
+    if len(tokens) <= budget:
+        return text
+    return _decode_prefix(tokens, budget)
+
+
+def _decode_prefix(tokens: list[int], budget: int) -> str:
+    """解码前 budget 个 token
+
+    cl100k 常把一个汉字拆成多个字节级 token，截断处可能只有半个字符：丢弃末尾不完整的
+    字节（而不是解码成 U+FFFD）；重新编码仍超出预算时再少取一个 token。
+    """
+    while budget > 0:
+        text = _encoding.decode(tokens[:budget], errors="ignore")
+        if count_tokens(text) <= budget:
+            return text
+        budget -= 1
+    return ""
+
+
 def compress_markdown(content: str, budget: int) -> str:
     """按 section 裁剪 Markdown，保留标题和每段首要内容，控制在 token 预算内。
 
@@ -82,8 +106,7 @@ def compress_markdown(content: str, budget: int) -> str:
         return result
 
     # 最后兜底：截断到预算
-    tokens = _encoding.encode(result or content)
-    return _encoding.decode(tokens[:budget])
+    return _decode_prefix(_encoding.encode(result or content), budget)
 
 
 def select_memories(entries: list, budget: int) -> tuple[str, int]:
@@ -4,13 +4,23 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.adapters.base import close_shared_http_client, stream_threads
 from app.api.v1.router import api_router
 from app.api.v1.ws_conversation import router as ws_router
 from app.core.config import get_settings
 from app.core.database import engine
+from app.core.db_profiler import QueryProfileMiddleware
+from app.core.event_bus import event_bus
 from app.core.logging_config import setup_logging
 from app.core.rate_limit import RateLimitMiddleware
 from app.core.redis import redis_client
+from app.core.tasks import task_queue
+from app.core.ws_manager import ws_manager
+from app.services.ai_model_cache import ai_model_cache
+from app.services.principal_cache import principal_cache
+from app.services.usage_counter_service import usage_reconciler
+from app.services.usage_log_writer import usage_log_writer
+from app.services.usage_rollup_service import usage_rollup_job
 
 settings = get_settings()
 setup_logging(debug=settings.DEBUG)
@@ -33,9 +43,27 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.warning("Redis连接失败: %s", e)
 
+    task_queue.start()
+    ai_model_cache.start_listener()
+    principal_cache.start_listener()
+    usage_reconciler.start()
+    usage_rollup_job.start()
+    usage_log_writer.start()
+
     yield
 
-    # Shutdown
+    # Shutdown：先断开 WebSocket（取消进行中的回复），写完缓冲的使用日志、
+    # 处理完积压的后台任务，再释放连接
+    await ws_manager.close_all()
+    await event_bus.stop()
+    await usage_log_writer.stop()
+    await usage_reconciler.stop()
+    await usage_rollup_job.stop()
+    await ai_model_cache.stop_listener()
+    await principal_cache.stop_listener()
+    await task_queue.stop()
+    await close_shared_http_client()
+    stream_threads.shutdown()
     await engine.dispose()
     await redis_client.close()
 
@@ -49,6 +77,8 @@ app = FastAPI(
 )
 
 app.add_middleware(RateLimitMiddleware)
+if settings.SQL_PROFILE_ENABLED:
+    app.add_middleware(QueryProfileMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -0,0 +1,62 @@
+"""
+API Key 解密微基准：对比冷启动（每次重新派生密钥）与缓存后的单次解密耗时
+
+用法:
+    cd backend
+    python -m scripts.bench_encryption [--iterations 50]
+
+每个对话轮次至少解密一次模型 API Key，此脚本用于量化该开销。
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# 将 backend 加入 path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils import encryption  # noqa: E402
+
+
+def _bench(label: str, iterations: int, fn) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    per_call_ms = (time.process_time() - start) * 1000 / iterations
+    print(f"{label}: {per_call_ms:.3f} ms CPU / 次")
+    return per_call_ms
+
+
+def main(iterations: int):
+    ciphertext = encryption.encrypt_api_key("sk-bench-0123456789abcdef")
+
+    def cold():
+        encryption._derive_fernet.cache_clear()
+        encryption.invalidate_decrypted_key()
+        encryption.decrypt_api_key(ciphertext)
+
+    def derived_only():
+        encryption.invalidate_decrypted_key()
+        encryption.decrypt_api_key(ciphertext)
+
+    def warm():
+        encryption.decrypt_api_key(ciphertext)
+
+    print(f"迭代次数: {iterations}")
+    print("-" * 48)
+    cold_ms = _bench("无缓存（每次 PBKDF2）", iterations, cold)
+    _bench("仅缓存派生密钥", iterations, derived_only)
+    encryption.decrypt_api_key(ciphertext)
+    warm_ms = _bench("派生密钥 + 明文缓存", iterations, warm)
+    print("-" * 48)
+    if warm_ms > 0:
+        print(f"加速比: {cold_ms / warm_ms:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API Key 解密微基准")
+    parser.add_argument("--iterations", type=int, default=50, help="每组迭代次数")
+    args = parser.parse_args()
+
+    main(args.iterations)
@@ -0,0 +1,213 @@
+"""
+对话 prompt 模板离线基准：回放录制的对话，对比各模板版本的 prompt token 与提取准确率
+
+用法:
+    cd backend
+    python -m scripts.bench_prompts [--versions v1 v2] [--structured] [--data PATH]
+    # 接真实模型（会产生调用费用）
+    python -m scripts.bench_prompts --provider openai --model gpt-4o-mini --api-key sk-...
+
+默认使用回放适配器：按用户消息返回录制的模型输出，不访问网络、结果可重复，
+此时准确率反映的是解析链路，主要对比各版本的 prompt token；接真实模型时
+准确率才反映模板本身的效果。
+
+录制数据格式（JSON 列表）：
+    [{"id": "...", "turns": [{"state": "collecting_basic", "user": "用户消息",
+                              "expected": {期望提取的字段},
+                              "recorded": {录制的 JSON 信封}}]}]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+# 将 backend 加入 path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse, ToolCall  # noqa: E402
+from app.core.config import get_settings  # noqa: E402
+from app.services import conversation_service  # noqa: E402
+from app.services.conversation_service import (  # noqa: E402
+    EXTRACT_TOOL,
+    EXTRACTION_TOOLS,
+    PROMPT_SECTION_BUDGETS,
+)
+from app.services.prompt_templates import PROMPT_TEMPLATES, render_system_prompt  # noqa: E402
+from app.utils.prompt_assembler import PromptAssembler  # noqa: E402
+
+DEFAULT_DATA = Path(__file__).resolve().parent / "data" / "prompt_bench_conversations.json"
+settings = get_settings()
+
+
+class ReplayAdapter(BaseLLMAdapter):
+    """按最后一条用户消息返回录制输出的离线适配器（支持函数调用模式）"""
+
+    SUPPORTS_TOOLS = True
+
+    def __init__(self, conversations: list[dict]):
+        super().__init__(api_key="", model_name="replay")
+        self.recorded = {
+            turn["user"]: turn["recorded"] for conv in conversations for turn in conv["turns"]
+        }
+
+    def _lookup(self, messages: list[ChatMessage]) -> dict:
+        user = next(m.content for m in reversed(messages) if m.role == "user")
+        return self.recorded[user]
+
+    async def _chat_completion(
+        self, messages: list[ChatMessage], tools: list[dict] | None = None
+    ) -> ChatResponse:
+        recorded = self._lookup(messages)
+        if not tools:
+            return ChatResponse(content=json.dumps(recorded, ensure_ascii=False))
+        arguments = dict(recorded.get("extracted_info") or {})
+        for key in ("confidence_scores", "needs_confirmation", "suggested_state"):
+            if key in recorded:
+                arguments[key] = recorded[key]
+        return ChatResponse(
+            content=recorded.get("reply", ""),
+            tool_calls=[ToolCall(EXTRACT_TOOL, arguments)] if recorded.get("extracted_info") else [],
+        )
+
+    async def _chat_completion_stream(self, messages: list[ChatMessage]) -> AsyncIterator[str]:
+        yield json.dumps(self._lookup(messages), ensure_ascii=False)
+
+    def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
+        return 0.0
+
+
+def _normalize(value):
+    """比较用的规范化：标量转字符串，列表忽略顺序"""
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return sorted(json.dumps(_normalize(v), ensure_ascii=False) for v in value)
+    return str(value).strip()
+
+
+def _build_turn_messages(
+    version: str, state: str, structured: bool, collected: dict, history: list[ChatMessage]
+) -> tuple[list[ChatMessage], dict]:
+    """与对话服务相同的 section 组装（不含记忆、相似病例与摘要）"""
+    assembler = PromptAssembler(settings.PROMPT_TOKEN_BUDGET)
+    system_prompt = render_system_prompt(state, structured, version)
+    assembler.add("system", system_prompt, priority=0, cacheable=True)
+    if collected:
+        assembler.add(
+            "state",
+            f"当前已收集的信息：{conversation_service._compact_json(collected)}\n"
+            f"当前对话阶段: {state}",
+            priority=1, budget=PROMPT_SECTION_BUDGETS["state"],
+        )
+    assembler.add_history("history", history, priority=3, budget=PROMPT_SECTION_BUDGETS["history"])
+    return assembler.build()
+
+
+async def run_benchmark(
+    conversations: list[dict], version: str, structured: bool, adapter: BaseLLMAdapter
+) -> dict:
+    """回放全部对话，返回该版本的 token 与准确率汇总"""
+    model = SimpleNamespace(id=uuid.uuid4(), model_name=adapter.model_name)
+    totals = {
+        "turns": 0, "system_tokens": 0, "prompt_tokens": 0,
+        "expected": 0, "predicted": 0, "correct": 0, "parse_failures": 0,
+    }
+    for conv in conversations:
+        collected: dict = {}
+        history: list[ChatMessage] = []
+        for turn in conv["turns"]:
+            history.append(ChatMessage(role="user", content=turn["user"]))
+            messages, report = _build_turn_messages(
+                version, turn["state"], structured, collected, history
+            )
+            response = await adapter.chat_completion(
+                messages, tools=EXTRACTION_TOOLS if structured else None
+            )
+            parsed = conversation_service._parse_reply(model, response, collected, structured)
+
+            extracted = parsed.get("extracted_info") or {}
+            expected = turn["expected"]
+            totals["turns"] += 1
+            totals["system_tokens"] += report["system"]
+            totals["prompt_tokens"] += report["total"]
+            totals["expected"] += len(expected)
+            totals["predicted"] += len(extracted)
+            totals["correct"] += sum(
+                1 for k, v in expected.items()
+                if k in extracted and _normalize(extracted[k]) == _normalize(v)
+            )
+            if "extracted_info" not in parsed:
+                totals["parse_failures"] += 1
+
+            collected = {**collected, **extracted}
+            history.append(ChatMessage(role="assistant", content=parsed["reply"]))
+
+    turns = totals["turns"] or 1
+    return {
+        "version": version,
+        "structured": structured,
+        **totals,
+        "avg_system_tokens": totals["system_tokens"] / turns,
+        "avg_prompt_tokens": totals["prompt_tokens"] / turns,
+        "precision": totals["correct"] / totals["predicted"] if totals["predicted"] else 0.0,
+        "recall": totals["correct"] / totals["expected"] if totals["expected"] else 0.0,
+    }
+
+
+def _print_report(results: list[dict]) -> None:
+    print(f"{'版本':<6}{'模式':<8}{'轮次':>6}{'system':>10}{'prompt':>10}{'精确率':>10}{'召回率':>10}{'解析失败':>10}")
+    print("-" * 72)
+    for r in results:
+        mode = "tools" if r["structured"] else "json"
+        print(
+            f"{r['version']:<6}{mode:<8}{r['turns']:>6}"
+            f"{r['avg_system_tokens']:>10.0f}{r['avg_prompt_tokens']:>10.0f}"
+            f"{r['precision']:>10.1%}{r['recall']:>10.1%}{r['parse_failures']:>10}"
+        )
+    print("-" * 72)
+    print("system / prompt 为每轮平均 token 数")
+    base = results[0]
+    for r in results[1:]:
+        if base["avg_prompt_tokens"]:
+            saved = 1 - r["avg_prompt_tokens"] / base["avg_prompt_tokens"]
+            print(f"{r['version']} 相比 {base['version']}：prompt token 减少 {saved:.1%}")
+
+
+async def main(args) -> None:
+    conversations = json.loads(Path(args.data).read_text(encoding="utf-8"))
+    if args.provider:
+        from app.adapters.factory import LLMAdapterFactory
+
+        adapter = LLMAdapterFactory.create_adapter(
+            provider=args.provider, api_key=args.api_key, model_name=args.model,
+            api_endpoint=args.api_endpoint, config={"temperature": 0},
+        )
+    else:
+        adapter = ReplayAdapter(conversations)
+
+    print(f"对话数: {len(conversations)}  轮次: {sum(len(c['turns']) for c in conversations)}"
+          f"  适配器: {adapter.model_name}")
+    results = [
+        await run_benchmark(conversations, version, args.structured, adapter)
+        for version in args.versions
+    ]
+    _print_report(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话 prompt 模板离线基准")
+    parser.add_argument("--versions", nargs="+", default=list(PROMPT_TEMPLATES), help="对比的模板版本")
+    parser.add_argument("--structured", action="store_true", help="使用函数调用模式")
+    parser.add_argument("--data", default=str(DEFAULT_DATA), help="录制的对话数据")
+    parser.add_argument("--provider", help="接真实模型时的提供商（如 openai / claude / qwen）")
+    parser.add_argument("--model", help="模型名")
+    parser.add_argument("--api-key", help="API Key")
+    parser.add_argument("--api-endpoint", help="自定义接口地址")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,417 @@
+"""
+对话链路压测：模拟多名兽医并发经 REST / WebSocket 对话，报告单轮延迟分位、
+数据库连接池等待与每轮 SQL 条数，用于评估 worker 规模、发布前发现对话热路径的性能回退
+
+用法:
+    cd backend
+    python -m scripts.load_conversations --users 50 --turns 5 [--mode rest|ws|mixed]
+        [--latency-ms 300 --jitter-ms 200 --tps 40 --failure-rate 0.02 --seed 1]
+        [--think-ms 500 --ramp-s 5 --complete --keep-model]
+    # 压测已部署的服务（只有客户端指标；本地 DATABASE_URL 需指向同一数据库以准备账号与模型）
+    python -m scripts.load_conversations --base-url http://10.0.0.5:8000 --users 200
+
+默认在本进程内用 uvicorn 启动应用（单 worker），并在 engine 上统计连接池获取耗时与 SQL 条数；
+模型使用 stub 提供商（app/adapters/stub_adapter.py），不访问任何外部模型接口。
+
+注意：会在 DATABASE_URL 指向的数据库中创建 loadtest_* 账号和一个 stub 模型
+（承担 chat / summary 任务，路由时优先于其他模型），只应对压测 / 预发环境使用；
+结束后（含中断）默认停用该模型，--keep-model 保留。模型变更经 Redis 广播使各 worker 的
+模型缓存立即失效。部署的服务按客户端 IP 限流，压测外部服务前需放开限流。
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# 将 backend 加入 path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+from sqlalchemy import event, select  # noqa: E402
+
+from app.core.config import get_settings  # noqa: E402
+from app.core.database import AsyncSessionLocal, engine  # noqa: E402
+from app.core.security import create_access_token, hash_password  # noqa: E402
+from app.models.ai_model import AIModel  # noqa: E402
+from app.models.user import User, UserRole  # noqa: E402
+from app.services.ai_model_cache import ai_model_cache, invalidate_after_commit  # noqa: E402
+from app.utils.encryption import encrypt_api_key  # noqa: E402
+
+settings = get_settings()
+
+STUB_PROVIDER = "stub"
+STUB_MODEL_NAME = "stub-load"
+MASTER_USERNAME = "loadtest_master"
+VET_PREFIX = "loadtest_vet_"
+
+# 模拟兽医依次发送的消息，超出后循环
+VET_MESSAGES = [
+    "一批45日龄蛋鸡，500只里有30只发病",
+    "打喷嚏、流鼻涕，有的甩头，三天前开始的",
+    "剖检气管有黏液，怀疑是传支",
+    "用的恩诺沙星饮水，0.1%浓度，连用5天",
+    "没有其他情况了",
+]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+@dataclass
+class LoadStats:
+    """客户端侧统计（毫秒）"""
+
+    latencies: dict[str, list[float]] = field(default_factory=lambda: {"rest": [], "ws": []})
+    first_token: list[float] = field(default_factory=list)
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    @property
+    def turns(self) -> int:
+        return sum(len(v) for v in self.latencies.values())
+
+
+class DBProbe:
+    """本进程 engine 的 SQL 条数与连接池获取耗时（仅内嵌模式可用）"""
+
+    def __init__(self):
+        self.queries = 0
+        self.waits: list[float] = []
+        self.max_checked_out = 0
+
+    def install(self) -> None:
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", self._on_execute)
+
+        pool = sync_engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                # 含排队等待与新建物理连接的时间
+                self.waits.append((time.perf_counter() - start) * 1000)
+                checked_out = getattr(pool, "checkedout", None)
+                if checked_out is not None:
+                    self.max_checked_out = max(self.max_checked_out, checked_out())
+
+        pool.connect = timed_connect
+
+    def _on_execute(self, *args) -> None:
+        self.queries += 1
+
+    def reset(self) -> None:
+        self.queries = 0
+        self.waits = []
+        self.max_checked_out = 0
+
+
+# ---- 准备数据 ----
+
+
+async def prepare(args) -> list[str]:
+    """创建 / 更新压测账号与 stub 模型，返回各模拟兽医的 access token"""
+    async with AsyncSessionLocal() as db:
+        password_hash = hash_password(args.password)
+        master = (
+            await db.execute(select(User).where(User.username == MASTER_USERNAME))
+        ).scalar_one_or_none()
+        if master is None:
+            master = User(
+                username=MASTER_USERNAME, phone="19900000000", password_hash=password_hash,
+                full_name="压测管理员", role=UserRole.master,
+            )
+            db.add(master)
+
+        existing = {
+            u.username: u
+            for u in (
+                await db.execute(select(User).where(User.username.like(f"{VET_PREFIX}%")))
+            ).scalars()
+        }
+        vets = []
+        for i in range(args.users):
+            username = f"{VET_PREFIX}{i:04d}"
+            vet = existing.get(username)
+            if vet is None:
+                vet = User(
+                    username=username, phone=f"1990001{i:04d}", password_hash=password_hash,
+                    full_name=f"压测兽医{i}", role=UserRole.veterinarian,
+                )
+                db.add(vet)
+            vet.is_active = True
+            vets.append(vet)
+        await db.flush()
+
+        config = {
+            "tasks": ["chat", "summary"],
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "tokens_per_second": args.tps,
+            "failure_rate": args.failure_rate,
+            "seed": args.seed,
+            "structured_output": not args.no_tools,
+        }
+        model = (
+            await db.execute(
+                select(AIModel).where(
+                    AIModel.provider == STUB_PROVIDER, AIModel.model_name == STUB_MODEL_NAME
+                )
+            )
+        ).scalar_one_or_none()
+        if model is None:
+            db.add(AIModel(
+                provider=STUB_PROVIDER, model_name=STUB_MODEL_NAME, display_name="压测模拟模型",
+                api_key_encrypted=encrypt_api_key("stub"), config=config,
+                is_active=True, created_by=master.id,
+            ))
+        else:
+            model.config = config
+            model.is_active = True
+        invalidate_after_commit(db)
+        await db.commit()
+
+        return [create_access_token({"sub": str(v.id)}) for v in vets]
+
+
+async def cleanup() -> None:
+    """停用 stub 模型，路由恢复使用真实模型"""
+    async with AsyncSessionLocal() as db:
+        model = (
+            await db.execute(
+                select(AIModel).where(
+                    AIModel.provider == STUB_PROVIDER, AIModel.model_name == STUB_MODEL_NAME
+                )
+            )
+        ).scalar_one_or_none()
+        if model is not None:
+            model.is_active = False
+            invalidate_after_commit(db)
+            await db.commit()
+    await ai_model_cache.channel.wait_published()
+
+
+# ---- 模拟兽医 ----
+
+
+async def _rest_turns(
+    http: httpx.AsyncClient, conversation_id: str, headers: dict, args, stats: LoadStats
+) -> None:
+    for turn in range(args.turns):
+        await asyncio.sleep(args.think_ms / 1000)
+        start = time.perf_counter()
+        try:
+            resp = await http.post(
+                f"/api/v1/conversations/{conversation_id}/messages",
+                json={"content": VET_MESSAGES[turn % len(VET_MESSAGES)]}, headers=headers,
+            )
+        except httpx.HTTPError as e:
+            stats.error(f"rest {type(e).__name__}")
+            continue
+        if resp.status_code == 200:
+            stats.latencies["rest"].append((time.perf_counter() - start) * 1000)
+        else:
+            stats.error(f"rest {resp.status_code}")
+
+
+async def _ws_turns(
+    ws_base: str, conversation_id: str, token: str, args, stats: LoadStats
+) -> None:
+    import websockets
+
+    url = f"{ws_base}/api/v1/conversations/{conversation_id}/ws?token={token}"
+    async with websockets.connect(url, max_size=None) as ws:
+        for turn in range(args.turns):
+            await asyncio.sleep(args.think_ms / 1000)
+            await ws.send(json.dumps({
+                "type": "user_message", "content": VET_MESSAGES[turn % len(VET_MESSAGES)],
+            }, ensure_ascii=False))
+            start = time.perf_counter()
+            first_token = None
+            while True:
+                try:
+                    frame = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+                except asyncio.TimeoutError:
+                    stats.error("ws timeout")
+                    return
+                kind = frame.get("type")
+                if kind == "stream_token" and first_token is None:
+                    first_token = (time.perf_counter() - start) * 1000
+                elif kind in ("stream_end", "assistant_message"):
+                    stats.latencies["ws"].append((time.perf_counter() - start) * 1000)
+                    if first_token is not None:
+                        stats.first_token.append(first_token)
+                    break
+                elif kind == "error":
+                    stats.error("ws error")
+                    break
+
+
+async def simulate_vet(
+    index: int, token: str, http: httpx.AsyncClient, ws_base: str, args, stats: LoadStats
+) -> None:
+    """一名兽医：建会话 → 多轮对话 →（可选）确认保存"""
+    await asyncio.sleep(args.ramp_s * index / max(args.users, 1))
+    headers = {"Authorization": f"Bearer {token}"}
+    use_ws = args.mode == "ws" or (args.mode == "mixed" and index % 2 == 1)
+
+    resp = await http.post("/api/v1/conversations", json={}, headers=headers)
+    if resp.status_code != 200:
+        stats.error(f"create {resp.status_code}")
+        return
+    conversation_id = resp.json()["id"]
+
+    try:
+        if use_ws:
+            await _ws_turns(ws_base, conversation_id, token, args, stats)
+        else:
+            await _rest_turns(http, conversation_id, headers, args, stats)
+    except Exception as e:
+        stats.error(f"{'ws' if use_ws else 'rest'} {type(e).__name__}")
+        return
+
+    if args.complete:
+        resp = await http.post(
+            f"/api/v1/conversations/{conversation_id}/complete",
+            json={"confirmed": True}, headers=headers,
+        )
+        if resp.status_code != 200:
+            stats.error(f"complete {resp.status_code}")
+
+
+# ---- 内嵌服务 ----
+
+
+async def _start_server(port: int):
+    import uvicorn
+
+    from app.core.rate_limit import global_limiter
+    from main import app
+
+    # 压测流量都来自本机，取消按 IP 限流
+    global_limiter.max_requests = sys.maxsize
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+            raise RuntimeError("服务启动失败")
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+# ---- 报告 ----
+
+
+def _print_report(stats: LoadStats, elapsed: float, probe: DBProbe | None) -> None:
+    print(f"{'通道':<10}{'轮次':>6}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    print("-" * 61)
+    rows = [(k, v) for k, v in stats.latencies.items() if v]
+    if stats.first_token:
+        rows.append(("ws 首token", stats.first_token))
+    for name, values in rows:
+        print(
+            f"{name:<10}{len(values):>6}"
+            + "".join(f"{_percentile(values, q):>9.0f}" for q in (0.5, 0.9, 0.95, 0.99))
+            + f"{max(values):>9.0f}"
+        )
+    print("-" * 61)
+    print("延迟单位 ms（REST 为请求往返，WS 为发送到 stream_end）")
+    print(f"吞吐: {stats.turns / elapsed:.1f} 轮/秒  总耗时 {elapsed:.1f}s")
+    if stats.errors:
+        print("错误: " + "  ".join(f"{k}={v}" for k, v in sorted(stats.errors.items())))
+
+    if probe is None:
+        print("数据库指标: 外部服务模式不可用")
+        return
+    turns = stats.turns or 1
+    print(f"SQL: 共 {probe.queries} 条，每轮 {probe.queries / turns:.1f} 条（含建会话 / 确认保存及后台任务）")
+    if probe.waits:
+        print(
+            f"连接池获取: p50 {_percentile(probe.waits, 0.5):.1f}ms  "
+            f"p95 {_percentile(probe.waits, 0.95):.1f}ms  max {max(probe.waits):.1f}ms  "
+            f"同时占用最多 {probe.max_checked_out} / "
+            f"{settings.DATABASE_POOL_SIZE + settings.DATABASE_MAX_OVERFLOW}"
+        )
+
+
+async def main(args) -> None:
+    try:
+        await _run(args)
+    finally:
+        if not args.keep_model:
+            await cleanup()
+        await engine.dispose()
+
+
+async def _run(args) -> None:
+    tokens = await prepare(args)
+    await ai_model_cache.channel.wait_published()
+    print(
+        f"模拟兽医 {args.users} 名 × {args.turns} 轮，模式 {args.mode}，"
+        f"stub 延迟 {args.latency_ms}ms (+{args.jitter_ms}) / {args.tps} token/s，失败率 {args.failure_rate}"
+    )
+
+    server = task = probe = None
+    base_url = args.base_url
+    if base_url is None:
+        probe = DBProbe()
+        probe.install()
+        server, task = await _start_server(args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+    ws_base = "ws" + base_url[len("http"):]
+
+    stats = LoadStats()
+    try:
+        limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as http:
+            if probe is not None:
+                probe.reset()
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                simulate_vet(i, token, http, ws_base, args, stats)
+                for i, token in enumerate(tokens)
+            ))
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await task
+
+    _print_report(stats, elapsed, probe)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对话链路压测")
+    parser.add_argument("--users", type=int, default=20, help="并发模拟兽医数")
+    parser.add_argument("--turns", type=int, default=4, help="每名兽医的对话轮次")
+    parser.add_argument("--mode", choices=["rest", "ws", "mixed"], default="mixed",
+                        help="对话通道；mixed 为一半 REST 一半 WebSocket")
+    parser.add_argument("--think-ms", type=float, default=0, help="每轮发送前的思考时间")
+    parser.add_argument("--ramp-s", type=float, default=0, help="在该时间内逐个启动模拟兽医")
+    parser.add_argument("--complete", action="store_true", help="对话结束后确认保存病历")
+    parser.add_argument("--timeout", type=float, default=120, help="单次请求 / 单轮回复超时（秒）")
+    parser.add_argument("--latency-ms", type=float, default=300, help="stub 首 token 延迟")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="stub 延迟随机抖动")
+    parser.add_argument("--tps", type=float, default=50, help="stub 输出速度（token/秒）")
+    parser.add_argument("--failure-rate", type=float, default=0, help="stub 注入失败概率")
+    parser.add_argument("--seed", type=int, default=0, help="stub 随机种子")
+    parser.add_argument("--no-tools", action="store_true", help="关闭函数调用，走 JSON 信封解析")
+    parser.add_argument("--base-url", help="压测已部署的服务，不启动内嵌服务")
+    parser.add_argument("--port", type=int, default=8765, help="内嵌服务端口")
+    parser.add_argument("--password", default="LoadTest#2024", help="压测账号密码")
+    parser.add_argument("--keep-model", action="store_true", help="结束后保留 stub 模型（默认停用）")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -1,15 +1,26 @@
 import asyncio
 import uuid
-from typing import AsyncGenerator
+from contextlib import contextmanager
+from typing import AsyncGenerator, Iterator
+from unittest.mock import patch
 
+import fakeredis
 import pytest
 import pytest_asyncio
 from httpx import ASGITransport, AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
+from app.adapters.guard import reset_provider_guards
+from app.adapters.router import reset_model_stats
 from app.core.database import Base, get_db
+from app.core.db_profiler import QueryProfile, profile_queries
 from app.core.security import hash_password
+from app.core.tasks import task_queue
 from app.models.user import User
+from app.services.ai_model_cache import ai_model_cache
+from app.services.conversation_service import reset_extraction_stats
+from app.services.principal_cache import principal_cache
+from app.services.usage_log_writer import usage_log_writer
 
 # 让 SQLite 能编译 PostgreSQL JSONB 类型（映射为 JSON）
 from sqlalchemy.dialects.sqlite.base import SQLiteTypeCompiler
@@ -25,6 +36,10 @@ TestSessionLocal = async_sessionmaker(
     test_engine, class_=AsyncSession, expire_on_commit=False
 )
 
+# 后台任务使用测试数据库
+task_queue.session_factory = TestSessionLocal
+usage_log_writer.session_factory = TestSessionLocal
+
 
 @pytest.fixture(scope="session")
 def event_loop():
@@ -37,11 +52,47 @@ def event_loop():
 async def setup_db():
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    # 每个用例使用新建的表，进程内模型 / 用户缓存、路由与提取统计与上游保护状态随之清空
+    ai_model_cache.invalidate()
+    principal_cache.invalidate()
+    reset_model_stats()
+    reset_extraction_stats()
+    reset_provider_guards()
     yield
+    # 写完缓冲的使用日志、等待本用例投递的后台任务结束，再清理表
+    await usage_log_writer.flush()
+    try:
+        await task_queue.join(timeout=10)
+    except asyncio.TimeoutError:
+        pass
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
 
 
+@contextmanager
+def assert_max_queries(limit: int) -> Iterator[QueryProfile]:
+    """断言块内执行的 SQL（含经 client 发起的请求）不超过 limit 条
+
+    用法：with assert_max_queries(3): resp = await client.get(...)
+    """
+    with profile_queries() as profile:
+        yield profile
+    statements = "\n".join(
+        f"  {n}× {profile.statements[fp]}"
+        for fp, n in sorted(profile.fingerprints.items(), key=lambda item: -item[1])
+    )
+    assert profile.count <= limit, f"执行了 {profile.count} 条 SQL，超出预算 {limit}：\n{statements}"
+
+
+@pytest_asyncio.fixture
+async def redis_backend():
+    """测试用 Redis：fakeredis 内存实现（含 Lua 脚本），不连接 REDIS_URL 指向的实例"""
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    with patch("app.core.redis.redis_client", client):
+        yield client
+    await client.aclose()
+
+
 async def override_get_db():
     async with TestSessionLocal() as session:
         try:
@@ -32,6 +32,21 @@ async def test_encrypt_different_ciphertext():
     assert decrypt_api_key(enc2) == plaintext
 
 
+@pytest.mark.asyncio
+async def test_decrypt_cache_and_invalidate():
+    """解密结果缓存：命中时不再解密，失效后重新解密"""
+    from app.utils import encryption
+
+    encrypted = encrypt_api_key("sk-cached-key")
+    assert decrypt_api_key(encrypted) == "sk-cached-key"
+
+    with patch.object(encryption, "_get_fernet", side_effect=AssertionError("不应重新解密")):
+        assert decrypt_api_key(encrypted) == "sk-cached-key"
+
+    encryption.invalidate_decrypted_key(encrypted)
+    assert decrypt_api_key(encrypted) == "sk-cached-key"
+
+
 # ==================== Helper ====================
 
 
@@ -257,6 +272,485 @@ async def test_adapter_factory_invalid_provider():
         LLMAdapterFactory.create_adapter("unknown", "key", "model")
 
 
+@pytest.mark.asyncio
+async def test_adapter_pool_reuse_and_invalidate():
+    """池化适配器：同配置复用实例，API Key 轮换或显式失效后重建"""
+    import uuid
+
+    from app.adapters.factory import LLMAdapterFactory
+    from app.models.ai_model import AIModel
+
+    model = AIModel(
+        id=uuid.uuid4(),
+        provider="openai",
+        model_name="gpt-4o",
+        display_name="GPT-4o",
+        api_key_encrypted=encrypt_api_key("sk-old"),
+        config={"temperature": 0.5},
+    )
+    first = LLMAdapterFactory.get_adapter(model)
+    assert LLMAdapterFactory.get_adapter(model) is first
+    assert first.temperature == 0.5
+
+    model.api_key_encrypted = encrypt_api_key("sk-new")
+    rotated = LLMAdapterFactory.get_adapter(model)
+    assert rotated is not first
+    assert rotated.api_key == "sk-new"
+
+    LLMAdapterFactory.invalidate(model.id)
+    assert LLMAdapterFactory.get_adapter(model) is not rotated
+
+
+@pytest.mark.asyncio
+async def test_router_fallback_hedge_and_task_preference():
+    """多模型路由：按任务排序候选，失败降级，慢请求对冲，并维护延迟 / 错误率统计"""
+    import asyncio
+    import uuid
+    from unittest.mock import AsyncMock
+
+    from app.adapters import router as router_module
+    from app.adapters.base import ChatMessage, ChatResponse
+    from app.adapters.router import TASK_SUMMARY, LLMRouter, RouteExhausted, get_model_stats
+    from app.models.ai_model import AIModel
+
+    def _model(name: str, is_default: bool = False, tasks: list | None = None) -> AIModel:
+        return AIModel(
+            id=uuid.uuid4(), provider="openai", model_name=name, display_name=name,
+            api_key_encrypted=encrypt_api_key("sk"), is_default=is_default,
+            config={"tasks": tasks} if tasks else {},
+        )
+
+    primary = _model("primary", is_default=True)
+    backup = _model("backup")
+    summarizer = _model("summarizer", tasks=["summary"])
+    messages = [ChatMessage(role="user", content="hi")]
+
+    assert LLMRouter([backup, summarizer, primary]).models[0] is primary
+    assert LLMRouter([backup, primary, summarizer], TASK_SUMMARY).models[0] is summarizer
+
+    adapters = {m.id: AsyncMock() for m in (primary, backup)}
+    with patch("app.adapters.router.LLMAdapterFactory.get_adapter",
+               side_effect=lambda m: adapters[m.id]):
+        # 主模型失败 → 降级到备用模型
+        adapters[primary.id].chat_completion = AsyncMock(side_effect=RuntimeError("boom"))
+        adapters[backup.id].chat_completion = AsyncMock(return_value=ChatResponse(content="b"))
+        result = await LLMRouter([primary, backup], hedge=False).chat_completion(messages)
+        assert result.model is backup and result.response.content == "b"
+        assert [m for m, _ in result.failures] == [primary]
+        assert get_model_stats(primary.id).error_rate == 1.0
+
+        # 超出限额的模型不发起调用；全部不可用时 failures 为空
+        async def deny(model):
+            return False
+        with pytest.raises(RouteExhausted) as exc:
+            await LLMRouter([primary, backup]).chat_completion(messages, allow=deny)
+        assert exc.value.failures == []
+
+        # 主模型超过对冲等待仍未返回 → 向备用模型发出对冲请求，先成功者胜出
+        async def slow(_messages):
+            await asyncio.sleep(5)
+            return ChatResponse(content="slow")
+        adapters[primary.id].chat_completion = AsyncMock(side_effect=slow)
+        with patch.object(router_module, "HEDGE_MIN_DELAY", 0.05), \
+                patch.object(router_module.settings, "LLM_HEDGE_DELAY", 0.05):
+            result = await LLMRouter([primary, backup], hedge=True).chat_completion(messages)
+        assert result.model is backup and result.failures == []
+        # 落败的主模型请求被取消，随结果返回以记录用量
+        assert result.cancelled == [primary]
+
+    stats = get_model_stats(backup.id)
+    assert len(stats.outcomes) == 2 and stats.error_rate == 0.0
+    assert stats.p50 is not None and stats.p95 >= stats.p50
+
+
+@pytest.mark.asyncio
+async def test_provider_guard_limits_and_circuit_breaker():
+    """上游保护：超出并发上限排队 / 拒绝，失败时上限减半，连续失败熔断后半开探测恢复"""
+    import asyncio
+
+    from app.adapters import guard as guard_module
+    from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+    from app.adapters.guard import CircuitOpenError, ProviderOverloaded
+
+    class FakeAdapter(BaseLLMAdapter):
+        gate: asyncio.Event | None = None
+        fail = False
+
+        async def _chat_completion(self, messages):
+            if self.gate is not None:
+                await self.gate.wait()
+            if self.fail:
+                raise RuntimeError("upstream down")
+            return ChatResponse(content="ok")
+
+        async def _chat_completion_stream(self, messages):
+            yield "a"
+            yield "b"
+
+        def calculate_cost(self, input_tokens, output_tokens):
+            return 0.0
+
+    messages = [ChatMessage(role="user", content="hi")]
+    settings = guard_module.settings
+    with patch.object(settings, "LLM_INITIAL_CONCURRENCY", 2), \
+            patch.object(settings, "LLM_MAX_QUEUE", 1), \
+            patch.object(settings, "LLM_QUEUE_TIMEOUT", 0.05), \
+            patch.object(settings, "LLM_BREAKER_FAILURES", 3), \
+            patch.object(settings, "LLM_BREAKER_COOLDOWN", 0.05):
+        adapter = FakeAdapter(api_key="k", model_name="m", api_endpoint="https://fake.test")
+        guard = adapter.guard
+
+        # 2 个在途 + 1 个排队，第 4 个直接拒绝；排队者超时失败
+        adapter.gate = asyncio.Event()
+        running = [asyncio.create_task(adapter.chat_completion(messages)) for _ in range(2)]
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(adapter.chat_completion(messages))
+        await asyncio.sleep(0)
+        assert guard.limiter.in_flight == 2 and guard.limiter.queued == 1
+        with pytest.raises(ProviderOverloaded):
+            await adapter.chat_completion(messages)
+        with pytest.raises(ProviderOverloaded):
+            await queued
+        adapter.gate.set()
+        assert [r.content for r in await asyncio.gather(*running)] == ["ok", "ok"]
+        adapter.gate = None
+        snap = guard.snapshot()
+        assert snap["rejected_overload"] == 2 and snap["queued"] == 0 and snap["in_flight"] == 0
+
+        # 流式调用同样占用名额，结束后释放
+        assert [t async for t in adapter.chat_completion_stream(messages)] == ["a", "b"]
+        assert guard.limiter.in_flight == 0
+
+        # 连续失败：上限减半，达到阈值后熔断，调用不再发出
+        adapter.fail = True
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                await adapter.chat_completion(messages)
+        assert guard.breaker.state == "open" and int(guard.limiter.limit) == 1
+        with pytest.raises(CircuitOpenError):
+            await adapter.chat_completion(messages)
+
+        # 冷却后半开探测：失败重新打开，成功则关闭
+        await asyncio.sleep(0.06)
+        with pytest.raises(RuntimeError):
+            await adapter.chat_completion(messages)
+        assert guard.breaker.state == "open"
+        await asyncio.sleep(0.06)
+        adapter.fail = False
+        assert (await adapter.chat_completion(messages)).content == "ok"
+        assert guard.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_provider_guard_counts_slow_cancellations_and_first_token_timeouts():
+    """上游保护：等待超过慢调用阈值后被取消按过慢减半；首 token 超时计为失败"""
+    import asyncio
+    import uuid
+
+    from app.adapters import guard as guard_module
+    from app.adapters.base import BaseLLMAdapter, ChatMessage, ChatResponse
+    from app.adapters.router import LLMRouter
+    from app.models.ai_model import AIModel
+
+    class HangingAdapter(BaseLLMAdapter):
+        gate: asyncio.Event | None = None
+
+        async def _chat_completion(self, messages):
+            await self.gate.wait()
+            return ChatResponse(content="ok")
+
+        async def _chat_completion_stream(self, messages):
+            if self.gate is not None:
+                await self.gate.wait()
+            yield "a"
+
+        def calculate_cost(self, input_tokens, output_tokens):
+            return 0.0
+
+    messages = [ChatMessage(role="user", content="hi")]
+    settings = guard_module.settings
+    with patch.object(settings, "LLM_INITIAL_CONCURRENCY", 8), \
+            patch.object(settings, "LLM_SLOW_CALL_SECONDS", 0.05), \
+            patch.object(settings, "LLM_SLOW_FIRST_TOKEN_SECONDS", 0.02), \
+            patch.object(settings, "LLM_FIRST_TOKEN_TIMEOUT", 0.05):
+        adapter = HangingAdapter(api_key="k", model_name="m", api_endpoint=f"https://{uuid.uuid4()}.test")
+        adapter.gate = asyncio.Event()
+        guard = adapter.guard
+
+        # 很快被取消（调用方放弃）：不影响上限
+        call = asyncio.create_task(adapter.chat_completion(messages))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        assert int(guard.limiter.limit) == 8 and guard.stats["slow_calls"] == 0
+
+        # 等待超过慢调用阈值后被取消（对冲落败）：按过慢减半，不计熔断
+        call = asyncio.create_task(adapter.chat_completion(messages))
+        await asyncio.sleep(0.08)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        assert int(guard.limiter.limit) == 4 and guard.stats["slow_calls"] == 1
+        assert guard.breaker.consecutive_failures == 0 and guard.limiter.in_flight == 0
+
+        # 流式首 token 超时：降级到备用模型，主模型上游记一次失败并减半
+        def _model(name: str) -> AIModel:
+            return AIModel(
+                id=uuid.uuid4(), provider="openai", model_name=name, display_name=name,
+                api_key_encrypted=encrypt_api_key("sk"), config={},
+            )
+
+        primary, backup = _model("primary"), _model("backup")
+        backup_adapter = HangingAdapter(api_key="k", model_name="b", api_endpoint=f"https://{uuid.uuid4()}.test")
+        adapters = {primary.id: adapter, backup.id: backup_adapter}
+        with patch("app.adapters.router.LLMAdapterFactory.get_adapter",
+                   side_effect=lambda m: adapters[m.id]):
+            model, stream, failures = await LLMRouter([primary, backup]).open_stream(messages)
+            assert model is backup and [t async for t in stream] == ["a"]
+        assert [m for m, _ in failures] == [primary]
+        snap = guard.snapshot()
+        assert snap["timeouts"] == 1 and snap["failures"] == 1
+        assert guard.breaker.consecutive_failures == 1 and int(guard.limiter.limit) == 2
+
+
+@pytest.mark.asyncio
+async def test_iterate_in_thread_streams_and_cancels():
+    """同步流桥接：逐块到达即产出；消费端提前退出后生产线程停止并关闭上游"""
+    import asyncio
+    import threading
+
+    from app.adapters.base import iterate_in_thread
+
+    release = threading.Event()
+    closed = threading.Event()
+    produced = []
+
+    def _produce():
+        try:
+            for i in range(100):
+                produced.append(i)
+                yield i
+                if i == 0:
+                    # 首块产出后阻塞，验证消费端无需等待整个响应
+                    release.wait(timeout=5)
+        finally:
+            closed.set()
+
+    stream = iterate_in_thread(_produce, max_buffer=2)
+    first = await asyncio.wait_for(stream.__anext__(), timeout=2)
+    assert first == 0
+    release.set()
+    assert await stream.__anext__() == 1
+    await stream.aclose()
+
+    assert await asyncio.to_thread(closed.wait, 2)
+    # 背压：缓冲区有限，不会把上游整个读完
+    assert len(produced) < 10
+
+    def _failing():
+        yield "partial"
+        raise RuntimeError("upstream error")
+
+    chunks = []
+    with pytest.raises(RuntimeError, match="upstream error"):
+        async for chunk in iterate_in_thread(_failing):
+            chunks.append(chunk)
+    assert chunks == ["partial"]
+
+
+@pytest.mark.asyncio
+async def test_stream_threads_isolated_from_default_executor():
+    """流式桥接使用专用线程池：进行中的流计入 active，线程用尽时新的流排队并计数"""
+    import asyncio
+    import threading
+
+    from app.adapters.base import StreamThreadPool, iterate_in_thread, stream_threads
+
+    release = threading.Event()
+    thread_names = []
+
+    def _produce():
+        thread_names.append(threading.current_thread().name)
+        yield "a"
+        release.wait(timeout=5)
+        yield "b"
+
+    stream = iterate_in_thread(_produce)
+    assert await asyncio.wait_for(stream.__anext__(), timeout=2) == "a"
+    assert thread_names[0].startswith("llm-stream")
+    assert stream_threads.snapshot()["active"] >= 1
+    release.set()
+    assert [chunk async for chunk in stream] == ["b"]
+
+    pool = StreamThreadPool(max_threads=1)
+    gate = threading.Event()
+    first = pool.run(lambda: gate.wait(timeout=5))
+    second = pool.run(lambda: None)
+    await asyncio.sleep(0.05)
+    snap = pool.snapshot()
+    assert snap["active"] == 1 and snap["waiting"] == 1 and snap["waited"] == 1
+    # 默认线程池不受占满的流式线程影响
+    assert await asyncio.wait_for(asyncio.to_thread(lambda: "ok"), timeout=1) == "ok"
+    gate.set()
+    await asyncio.gather(first, second)
+    assert pool.snapshot()["active"] == 0 and pool.snapshot()["peak"] == 1
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_prompt_prefix_cache_request_and_cost():
+    """静态前缀排在最前并打缓存断点；命中缓存的 token 按折扣计费"""
+    from types import SimpleNamespace
+
+    from app.adapters.base import ChatMessage
+    from app.adapters.factory import LLMAdapterFactory
+
+    messages = [
+        ChatMessage(role="system", content="static prompt", cacheable=True),
+        ChatMessage(role="system", content="memory"),
+        ChatMessage(role="user", content="hi"),
+    ]
+
+    claude = LLMAdapterFactory.create_adapter("claude", "sk-test", "claude-3-5-sonnet")
+    request = claude._build_request(messages)
+    # 所有 system 消息都保留，断点在静态块上
+    assert [b["text"] for b in request["system"]] == ["static prompt", "memory"]
+    assert request["system"][0]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" not in request["system"][1]
+    assert request["messages"] == [{"role": "user", "content": "hi"}]
+
+    openai = LLMAdapterFactory.create_adapter("openai", "sk-test", "gpt-4o")
+    usage = SimpleNamespace(prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    assert openai._cached_tokens(usage) == 1024
+    assert openai._cached_tokens(SimpleNamespace(prompt_cache_hit_tokens=64)) == 64
+    assert openai._cached_tokens(None) == 0
+
+    full = openai.cost_with_cache(2000, 100)
+    discounted = openai.cost_with_cache(2000, 100, cached_tokens=1024)
+    assert discounted < full
+    assert discounted == pytest.approx(openai.calculate_cost(2000 - 512, 100))
+
+    # Kimi 按模型 config 开启句柄缓存，不影响同类其他实例
+    kimi = LLMAdapterFactory.create_adapter("kimi", "sk-test", "moonshot-v1-8k", config={"context_cache": True})
+    plain = LLMAdapterFactory.create_adapter("kimi", "sk-test", "moonshot-v1-8k")
+    assert kimi.prompt_cache_mode == "handle"
+    assert plain.prompt_cache_mode == type(plain).PROMPT_CACHE == "none"
+
+
+@pytest.mark.asyncio
+async def test_claude_request_accepted_by_sdk():
+    """Claude 请求（system 块 + tools）经真实 SDK 发出，回复中的 tool_use 与缓存用量被解析"""
+    import inspect
+    import json
+
+    import httpx
+    from anthropic import AsyncAnthropic
+    from anthropic.resources.messages import AsyncMessages
+
+    from app.adapters.base import ChatMessage
+    from app.adapters.factory import LLMAdapterFactory
+    from app.services.conversation_service import EXTRACTION_TOOLS
+
+    messages = [
+        ChatMessage(role="system", content="static prompt", cacheable=True),
+        ChatMessage(role="user", content="500只蛋鸡有30只发病"),
+    ]
+    claude = LLMAdapterFactory.create_adapter("claude", "sk-test", "claude-3-5-sonnet-20241022")
+    request = claude._build_request(messages, EXTRACTION_TOOLS)
+    inspect.signature(AsyncMessages.create).bind(None, **request)
+    inspect.signature(AsyncMessages.stream).bind(None, **claude._build_request(messages))
+
+    sent = []
+
+    def _handler(http_request: httpx.Request) -> httpx.Response:
+        sent.append(json.loads(http_request.content))
+        return httpx.Response(200, json={
+            "id": "msg_1", "type": "message", "role": "assistant",
+            "model": "claude-3-5-sonnet-20241022", "stop_reason": "tool_use", "stop_sequence": None,
+            "content": [
+                {"type": "text", "text": "请问发病几天了？"},
+                {"type": "tool_use", "id": "tu_1", "name": "extract_medical_info",
+                 "input": {"breed": "蛋鸡", "affected_count": 30}},
+            ],
+            "usage": {"input_tokens": 20, "output_tokens": 10,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 1000},
+        })
+
+    claude.client = AsyncAnthropic(
+        api_key="sk-test", http_client=httpx.AsyncClient(transport=httpx.MockTransport(_handler))
+    )
+    response = await claude._chat_completion(messages, EXTRACTION_TOOLS)
+
+    (body,) = sent
+    assert body["system"][0]["cache_control"] == {"type": "ephemeral"}
+    assert body["tools"][0]["name"] == "extract_medical_info"
+    assert "properties" in body["tools"][0]["input_schema"]
+    assert response.content == "请问发病几天了？"
+    assert response.tool_calls[0].arguments == {"breed": "蛋鸡", "affected_count": 30}
+    assert response.cached_tokens == 1000 and response.input_tokens == 1020
+
+
+@pytest.mark.asyncio
+async def test_model_config_cache_and_invalidation(
+    client: AsyncClient, master_user: User, db_session
+):
+    """稳态下读取默认模型不查库；设置默认模型提交后本地失效并广播"""
+    import asyncio
+    import uuid
+
+    from sqlalchemy import event
+
+    from app.services.ai_model_cache import INVALIDATE_CHANNEL, ai_model_cache
+    from tests.conftest import test_engine
+
+    token = await _get_master_token(client, master_user)
+    headers = {"Authorization": f"Bearer {token}"}
+    with patch("app.core.redis.redis_client.publish", new_callable=AsyncMock) as publish:
+        resp_a = await client.post(
+            "/api/v1/ai-models",
+            json={"provider": "openai", "model_name": "gpt-4o", "display_name": "A",
+                  "api_key": "sk-a", "is_default": True},
+            headers=headers,
+        )
+        resp_b = await client.post(
+            "/api/v1/ai-models",
+            json={"provider": "qwen", "model_name": "qwen-max", "display_name": "B",
+                  "api_key": "sk-b", "usage_limit": {"daily_requests": 5}},
+            headers=headers,
+        )
+        await asyncio.gather(*ai_model_cache.channel._publishes)
+    assert publish.await_count == 2
+    assert publish.await_args.args[0] == INVALIDATE_CHANNEL
+
+    queries = []
+
+    def _count(conn, cursor, statement, *args):
+        if "ai_models" in statement:
+            queries.append(statement)
+
+    event.listen(test_engine.sync_engine, "before_cursor_execute", _count)
+    try:
+        first = await ai_model_cache.get_default(db_session)
+        assert str(first.id) == resp_a.json()["id"]
+        assert len(queries) == 1
+
+        for _ in range(3):
+            assert (await ai_model_cache.get_default(db_session)).id == first.id
+        cached_b = await ai_model_cache.get(db_session, uuid.UUID(resp_b.json()["id"]))
+        assert cached_b.usage_limit["daily_requests"] == 5
+        assert len(queries) == 1
+
+        with patch("app.core.redis.redis_client.publish", new_callable=AsyncMock):
+            resp = await client.post(
+                f"/api/v1/ai-models/{resp_b.json()['id']}/set-default", headers=headers,
+            )
+        assert resp.status_code == 200
+        queries.clear()
+        assert str((await ai_model_cache.get_default(db_session)).id) == resp_b.json()["id"]
+        assert len(queries) == 1
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", _count)
+
+
 @pytest.mark.asyncio
 async def test_usage_stats_empty(client: AsyncClient, master_user: User):
     """空的使用统计"""
@@ -267,3 +761,219 @@ async def test_usage_stats_empty(client: AsyncClient, master_user: User):
     )
     assert response.status_code == 200
     assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_usage_limit_without_redis_counters(db_session, master_user: User):
+    """Redis 不可用时限额检查退回使用日志聚合"""
+    from redis.exceptions import ConnectionError as RedisConnectionError
+
+    from app.models.ai_model import AIModel
+    from app.services import ai_model_service
+    from app.services.usage_log_writer import usage_log_writer
+
+    model = AIModel(
+        provider="openai", model_name="gpt-4o", display_name="Limited",
+        api_key_encrypted=encrypt_api_key("sk"), created_by=master_user.id,
+        usage_limit={"daily_requests": 2},
+    )
+    db_session.add(model)
+    await db_session.commit()
+
+    with patch("app.core.redis.redis_client.hmget",
+               new_callable=AsyncMock, side_effect=RedisConnectionError("down")):
+        assert await ai_model_service.check_usage_limit(db_session, model.id, master_user.id)
+        for _ in range(2):
+            await ai_model_service.log_usage(
+                db_session, model.id, master_user.id, total_tokens=10, cost=0.01,
+            )
+        await usage_log_writer.flush()
+        assert not await ai_model_service.check_usage_limit(db_session, model.id, master_user.id)
+
+
+@pytest.mark.asyncio
+async def test_usage_counters_seed_increment_reconcile(db_session, master_user: User, redis_backend):
+    """计数器：首次检查初始化，记录日志时原子累加；对账截止点前以日志为准，之后保留实时增量"""
+    from datetime import timedelta
+
+    from app.core.tasks import task_queue
+    from app.models.ai_model import AIModel, AIUsageLog
+    from app.services import ai_model_service, usage_counter_service
+    from app.services.usage_log_writer import usage_log_writer
+
+    day = usage_counter_service._day_start()
+    cutoff_slot, cutoff = usage_counter_service._reconcile_cutoff()
+    if cutoff - timedelta(seconds=usage_counter_service.SLOT_SECONDS) < day:
+        pytest.skip("UTC 零点附近对账截止点落在前一天")
+
+    model = AIModel(
+        provider="openai", model_name="gpt-4o", display_name="Counted",
+        api_key_encrypted=encrypt_api_key("sk"), created_by=master_user.id,
+        usage_limit={"daily_tokens": 100},
+    )
+    db_session.add(model)
+    await db_session.commit()
+    key = usage_counter_service.counter_key(model.id, master_user.id, day)
+
+    # 日志尚在写入器缓冲区：总量未初始化，只记槽位增量
+    await ai_model_service.log_usage(db_session, model.id, master_user.id, total_tokens=40)
+    await task_queue.join(timeout=5)
+    assert await redis_backend.hget(key, "requests") is None
+
+    # 初始化时截止点之后的用量取自槽位增量，未写入数据库的日志也已计入
+    usage = await usage_counter_service.get_daily_usage(db_session, model.id, master_user.id)
+    assert usage == {"requests": 1, "tokens": 40, "cost": 0.0}
+
+    await ai_model_service.log_usage(db_session, model.id, master_user.id, total_tokens=70, cost=0.5)
+    await task_queue.join(timeout=5)
+    assert await redis_backend.hget(key, "tokens") == "110"
+    assert not await ai_model_service.check_usage_limit(db_session, model.id, master_user.id)
+
+    # 截止点之前的一条日志已入库，其槽位增量偏大；总量也人为制造偏差
+    old_slot = cutoff_slot - 1
+    db_session.add(AIUsageLog(
+        model_id=model.id, user_id=master_user.id, total_tokens=5, cost=0,
+        created_at=cutoff - timedelta(seconds=1), status="success",
+    ))
+    await db_session.commit()
+    await redis_backend.hset(key, mapping={"tokens": 999, f"t:{old_slot}": 500})
+
+    # 对账：截止点前取数据库（5），之后保留槽位增量（110，其中 70 仍在缓冲区）
+    await usage_counter_service.reconcile_counters_task(db_session)
+    assert await redis_backend.hget(key, "tokens") == "115"
+    assert await redis_backend.hget(key, "requests") == "3"
+    assert float(await redis_backend.hget(key, "cost")) == pytest.approx(0.5)
+    assert not await redis_backend.hexists(key, f"t:{old_slot}")
+
+    await usage_log_writer.flush()
+    await redis_backend.delete(key)
+
+
+@pytest.mark.asyncio
+async def test_usage_log_writer_batches_and_retries(db_session, master_user: User):
+    """使用日志按批写入；写入失败时保留在缓冲区，下次写入"""
+    import uuid
+    from datetime import datetime, timezone
+
+    from sqlalchemy import func, select
+
+    from app.models.ai_model import AIModel, AIUsageLog
+    from app.services.usage_log_writer import UsageLogWriter
+    from tests.conftest import TestSessionLocal
+
+    model = AIModel(
+        provider="openai", model_name="gpt-4o", display_name="Batched",
+        api_key_encrypted=encrypt_api_key("sk"), created_by=master_user.id,
+    )
+    db_session.add(model)
+    await db_session.commit()
+
+    def _row(i: int) -> dict:
+        return {
+            "id": uuid.uuid4(), "created_at": datetime.now(timezone.utc),
+            "model_id": model.id, "user_id": master_user.id, "conversation_id": None,
+            "request_tokens": i, "response_tokens": 0, "total_tokens": i, "cached_tokens": 0,
+            "cost": 0, "latency_ms": 0, "status": "success", "error_message": None,
+            "prompt_tokens_detail": None,
+        }
+
+    writer = UsageLogWriter(batch_size=3, flush_interval=60, session_factory=TestSessionLocal)
+    with patch.object(writer, "_session_factory", side_effect=RuntimeError("db down")):
+        assert writer.submit(_row(1))
+        assert not await writer.flush()
+    assert writer.stats["failed_batches"] == 1
+
+    for i in range(2, 6):
+        assert writer.submit(_row(i))
+    await writer.stop()
+
+    count = (await db_session.execute(select(func.count()).select_from(AIUsageLog))).scalar()
+    assert count == 5
+    assert writer.stats["batches"] == 2 and writer.stats["written"] == 5
+
+
+@pytest.mark.asyncio
+async def test_usage_stats_served_from_rollups(db_session, master_user: User):
+    """统计：整天读 day 汇总、已汇总小时读 hour 汇总、其余扫描原始日志，结果与原始日志一致"""
+    import uuid
+    from datetime import date, datetime, timezone
+
+    from sqlalchemy import func, select
+
+    from app.models.ai_model import AIModel, AIUsageLog, AIUsageRollup
+    from app.services import ai_model_service, usage_rollup_service
+
+    model = AIModel(
+        provider="openai", model_name="gpt-4o", display_name="Rolled",
+        api_key_encrypted=encrypt_api_key("sk"), created_by=master_user.id,
+    )
+    db_session.add(model)
+    await db_session.commit()
+
+    def _log(ts: datetime, tokens: int, status: str = "success") -> AIUsageLog:
+        return AIUsageLog(
+            id=uuid.uuid4(), created_at=ts, model_id=model.id, user_id=master_user.id,
+            request_tokens=tokens, total_tokens=tokens, cost=0.01, latency_ms=100,
+            status=status,
+        )
+
+    utc = timezone.utc
+    db_session.add_all([
+        _log(datetime(2026, 1, 30, 9, 15, tzinfo=utc), 10),
+        _log(datetime(2026, 1, 31, 10, 5, tzinfo=utc), 20),
+        _log(datetime(2026, 1, 31, 23, 30, tzinfo=utc), 40, status="error"),
+        _log(datetime(2026, 2, 1, 8, 0, tzinfo=utc), 80),
+    ])
+    await db_session.commit()
+
+    marks = await usage_rollup_service.rollup_usage(
+        db_session, now=datetime(2026, 2, 1, 9, 30, tzinfo=utc)
+    )
+    await db_session.commit()
+    assert marks == {
+        "hour": datetime(2026, 2, 1, 9, tzinfo=utc),
+        "day": datetime(2026, 2, 1, tzinfo=utc),
+    }
+    # 汇总后新到的日志在水位之后，由原始日志补齐
+    db_session.add(_log(datetime(2026, 2, 1, 9, 10, tzinfo=utc), 160))
+    await db_session.commit()
+
+    day_rows = (await db_session.execute(
+        select(func.count()).select_from(AIUsageRollup).where(AIUsageRollup.period == "day")
+    )).scalar()
+    assert day_rows == 3  # 1/30、1/31 success、1/31 error
+
+    # 月末作为结束日期（含当天）
+    stats = await ai_model_service.get_usage_stats(
+        db_session, start_date=date(2026, 1, 31), end_date=date(2026, 1, 31)
+    )
+    assert len(stats) == 1
+    assert stats[0].model_name == "gpt-4o"
+    assert stats[0].total_requests == 2 and stats[0].total_tokens == 60
+    assert stats[0].success_count == 1 and stats[0].error_count == 1
+    assert stats[0].avg_latency_ms == 100
+
+    stats = await ai_model_service.get_usage_stats(db_session, start_date=date(2026, 1, 31))
+    assert stats[0].total_requests == 4 and stats[0].total_tokens == 300
+
+    stats = await ai_model_service.get_usage_stats(db_session)
+    assert stats[0].total_requests == 5 and stats[0].total_cost == pytest.approx(0.05)
+
+    # 重复执行幂等
+    await usage_rollup_service.rollup_usage(db_session, now=datetime(2026, 2, 1, 9, 30, tzinfo=utc))
+    stats = await ai_model_service.get_usage_stats(db_session)
+    assert stats[0].total_requests == 5
+
+    # 水位已越过的小时收到迟到日志：下次执行重算最近的小时桶（原行就地更新）
+    db_session.add(_log(datetime(2026, 2, 1, 8, 40, tzinfo=utc), 320))
+    await db_session.commit()
+    await usage_rollup_service.rollup_usage(db_session, now=datetime(2026, 2, 1, 9, 40, tzinfo=utc))
+    hour_rows = (await db_session.execute(
+        select(AIUsageRollup.requests).where(
+            AIUsageRollup.period == "hour",
+            AIUsageRollup.bucket_start == datetime(2026, 2, 1, 8, tzinfo=utc),
+        )
+    )).scalars().all()
+    assert hour_rows == [2]
+    stats = await ai_model_service.get_usage_stats(db_session)
+    assert stats[0].total_requests == 6 and stats[0].total_tokens == 630
@@ -97,3 +97,51 @@ async def test_me(client: AsyncClient, vet_user: User):
     )
     assert response.status_code == 200
     assert response.json()["phone"] == "13800000002"
+
+
+@pytest.mark.asyncio
+async def test_current_user_cache_and_invalidation(
+    client: AsyncClient, master_user: User, vet_user: User
+):
+    """认证用户走进程内缓存：重复请求不查 users 表，禁用 / 记忆更新提交后立即生效"""
+    from app.services.principal_cache import principal_cache
+
+    async def _token(phone: str, password: str) -> dict:
+        resp = await client.post("/api/v1/auth/login", json={"phone": phone, "password": password})
+        return {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+    vet_headers = await _token("13800000002", "vet123456")
+    master_headers = await _token("13800000001", "master123")
+
+    loads = principal_cache.stats["user_loads"]
+    for _ in range(3):
+        resp = await client.get("/api/v1/auth/me", headers=vet_headers)
+        assert resp.status_code == 200
+    assert principal_cache.stats["user_loads"] == loads + 1
+
+    # 记忆上下文：首次渲染后命中缓存，更新记忆后重新渲染
+    from app.services import memory_service
+    from tests.conftest import TestSessionLocal
+
+    async with TestSessionLocal() as db:
+        assert await memory_service.build_memory_context(db, vet_user.id) == ""
+        resp = await client.put(
+            "/api/v1/memory",
+            json={"content": {"preferences": {"语言": "简洁"}, "farm_context": {}, "common_issues": [], "notes": []}},
+            headers=vet_headers,
+        )
+        assert resp.status_code == 200
+        context = await memory_service.build_memory_context(db, vet_user.id)
+        assert "语言: 简洁" in context
+        renders = principal_cache.stats["memory_renders"]
+        assert await memory_service.build_memory_context(db, vet_user.id) == context
+        assert principal_cache.stats["memory_renders"] == renders
+
+    resp = await client.patch(
+        f"/api/v1/admin/users/{vet_user.id}/status",
+        json={"is_active": False},
+        headers=master_headers,
+    )
+    assert resp.status_code == 200
+    resp = await client.get("/api/v1/auth/me", headers=vet_headers)
+    assert resp.status_code == 403
@@ -176,8 +176,8 @@ async def test_send_message(
     )
 
     with patch(
-        "app.services.conversation_service._get_adapter_and_model",
-        return_value=(mock_adapter, ai_model),
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
     ):
         response = await client.post(
             f"/api/v1/conversations/{conv_id}/messages",
@@ -191,6 +191,131 @@ async def test_send_message(
     assert data["collected_info"].get("poultry_type") == "蛋鸡"
 
 
+@pytest.mark.asyncio
+async def test_send_message_releases_connection_and_retries_on_conflict(
+    client: AsyncClient, vet_user: User, ai_model: AIModel
+):
+    """LLM 调用期间不占用数据库连接；期间对话被并发修改时按版本号重读后写回"""
+    from sqlalchemy import event, select
+
+    from app.models.conversation import Conversation
+    from tests.conftest import TestSessionLocal, test_engine
+
+    token = _make_token(vet_user)
+    create_resp = await client.post(
+        "/api/v1/conversations", json={}, headers={"Authorization": f"Bearer {token}"},
+    )
+    conv_id = uuid.UUID(create_resp.json()["id"])
+
+    in_use = {"n": 0}
+    checked_out = []
+
+    def _checkout(*args):
+        in_use["n"] += 1
+
+    def _checkin(*args):
+        in_use["n"] -= 1
+
+    async def _llm_call(messages, **kwargs):
+        checked_out.append(in_use["n"])
+        # 模拟另一请求在 LLM 调用期间修改同一对话
+        async with TestSessionLocal() as other:
+            conv = await other.get(Conversation, conv_id)
+            conv.tags = ["并发标签"]
+            await other.commit()
+        return _mock_llm_response(extracted_info={"poultry_type": "蛋鸡"})
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(side_effect=_llm_call)
+    pool = test_engine.sync_engine.pool
+    event.listen(pool, "checkout", _checkout)
+    event.listen(pool, "checkin", _checkin)
+    try:
+        with patch(
+            "app.adapters.router.LLMAdapterFactory.get_adapter",
+            return_value=mock_adapter,
+        ):
+            response = await client.post(
+                f"/api/v1/conversations/{conv_id}/messages",
+                json={"content": "蛋鸡咳嗽"},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+    finally:
+        event.remove(pool, "checkout", _checkout)
+        event.remove(pool, "checkin", _checkin)
+
+    assert response.status_code == 200
+    assert checked_out == [0]
+    async with TestSessionLocal() as check:
+        conv = (await check.execute(
+            select(Conversation).where(Conversation.id == conv_id)
+        )).scalar_one()
+    # 并发修改与本轮结果都保留：问候 + 用户消息 + AI 回复
+    assert conv.tags == ["并发标签"]
+    assert conv.collected_info["poultry_type"] == "蛋鸡"
+    assert conv.message_count == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_turn_discards_user_message_and_logs_usage(
+    client: AsyncClient, vet_user: User, ai_model: AIModel
+):
+    """LLM 调用失败或回复无法写回时撤回用户消息；已发生的调用都记录使用日志"""
+    from sqlalchemy import select
+
+    from app.models.ai_model import AIUsageLog
+    from app.models.conversation import Conversation, ConversationMessage
+    from app.services.usage_log_writer import usage_log_writer
+    from tests.conftest import TestSessionLocal
+
+    token = _make_token(vet_user)
+    headers = {"Authorization": f"Bearer {token}"}
+    conv_id = uuid.UUID((await client.post(
+        "/api/v1/conversations", json={}, headers=headers,
+    )).json()["id"])
+
+    async def _state() -> tuple[int, list[str], list[str]]:
+        await usage_log_writer.flush()
+        async with TestSessionLocal() as check:
+            conv = await check.get(Conversation, conv_id)
+            roles = (await check.execute(
+                select(ConversationMessage.role)
+                .where(ConversationMessage.conversation_id == conv_id)
+            )).scalars().all()
+            statuses = (await check.execute(
+                select(AIUsageLog.status).order_by(AIUsageLog.created_at)
+            )).scalars().all()
+        return conv.message_count, sorted(roles), list(statuses)
+
+    # 全部模型失败 → 502，用户消息撤回，错误调用有日志
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(side_effect=RuntimeError("upstream down"))
+    with patch("app.adapters.router.LLMAdapterFactory.get_adapter", return_value=mock_adapter):
+        resp = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "蛋鸡咳嗽"}, headers=headers,
+        )
+    assert resp.status_code == 502
+    assert await _state() == (1, ["assistant"], ["error"])
+
+    # LLM 调用期间对话被结束 → 409，用户消息撤回，成功的调用仍记录用量
+    async def _llm_call(messages, **kwargs):
+        async with TestSessionLocal() as other:
+            conv = await other.get(Conversation, conv_id)
+            conv.status = "completed"
+            await other.commit()
+        return _mock_llm_response(extracted_info={"poultry_type": "蛋鸡"})
+
+    mock_adapter.chat_completion = AsyncMock(side_effect=_llm_call)
+    with patch("app.adapters.router.LLMAdapterFactory.get_adapter", return_value=mock_adapter):
+        resp = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "蛋鸡咳嗽"}, headers=headers,
+        )
+    assert resp.status_code == 409
+    assert await _state() == (1, ["assistant"], ["error", "success"])
+
+
 @pytest.mark.asyncio
 async def test_complete_conversation(
     client: AsyncClient, vet_user: User, ai_model: AIModel
@@ -229,8 +354,8 @@ async def test_complete_conversation(
     )
 
     with patch(
-        "app.services.conversation_service._get_adapter_and_model",
-        return_value=(mock_adapter, ai_model),
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
     ):
         await client.post(
             f"/api/v1/conversations/{conv_id}/messages",
@@ -301,3 +426,687 @@ async def test_conversation_access_control(
         headers={"Authorization": f"Bearer {master_token}"},
     )
     assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_similar_cases_searched_once_per_change(
+    client: AsyncClient, vet_user: User, ai_model: AIModel
+):
+    """测试相似病例每轮最多检索一次，collected_info 未变化时复用"""
+    token = _make_token(vet_user)
+
+    create_resp = await client.post(
+        "/api/v1/conversations",
+        json={},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    conv_id = create_resp.json()["id"]
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(
+        return_value=_mock_llm_response(
+            reply="了解，请问出现了什么症状？",
+            extracted_info={"poultry_type": "蛋鸡"},
+        )
+    )
+    similar = [{
+        "id": str(uuid.uuid4()),
+        "record_no": "EMR-20260101-0001",
+        "poultry_type": "鸡",
+        "primary_diagnosis": "新城疫",
+        "severity": "moderate",
+        "record_json": {"symptoms": ["咳嗽"]},
+        "similarity": 0.88,
+    }]
+    mock_search = AsyncMock(return_value=similar)
+
+    with patch(
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
+    ), patch(
+        "app.services.embedding_service.search_similar_by_collected_info",
+        mock_search,
+    ):
+        first = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "我养的是蛋鸡"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        second = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "还是蛋鸡"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert first.json()["similar_cases"][0]["record_no"] == "EMR-20260101-0001"
+    assert second.json()["similar_cases"][0]["record_no"] == "EMR-20260101-0001"
+    # 第一轮回复后检索一次，第二轮 collected_info 未变化，prompt 与返回均复用
+    assert mock_search.await_count == 1
+    # 第二轮 prompt 中注入了相似病例
+    second_messages = mock_adapter.chat_completion.await_args_list[1].args[0]
+    assert any("相似历史病例参考" in m.content for m in second_messages)
+
+
+@pytest.mark.asyncio
+async def test_stream_emits_decoded_reply_and_field_deltas(
+    client: AsyncClient, db_session: AsyncSession, vet_user: User, ai_model: AIModel
+):
+    """测试流式回复只推送解码后的 reply 文本，extracted_info 字段闭合即推送增量"""
+    from app.services import conversation_service
+
+    token = _make_token(vet_user)
+    create_resp = await client.post(
+        "/api/v1/conversations",
+        json={},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    conv_id = uuid.UUID(create_resp.json()["id"])
+
+    envelope = _mock_llm_response(
+        reply="了解，\"蛋鸡\"出现咳嗽。\n请问日龄？",
+        extracted_info={"poultry_type": "蛋鸡", "symptoms": ["咳嗽"]},
+    ).content
+    # 按 5 个字符切块模拟 token 流
+    chunks = [envelope[i:i + 5] for i in range(0, len(envelope), 5)]
+
+    async def _stream(messages):
+        for chunk in chunks:
+            yield chunk
+
+    mock_adapter = MagicMock()
+    mock_adapter.chat_completion_stream = _stream
+
+    with patch(
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
+    ), patch(
+        "app.services.embedding_service.search_similar_by_collected_info",
+        AsyncMock(return_value=[]),
+    ):
+        events = [
+            event async for event in conversation_service.send_message_stream(
+                db_session, conv_id, vet_user, content="蛋鸡咳嗽",
+            )
+        ]
+
+    tokens = "".join(e["content"] for e in events if e["type"] == "stream_token")
+    assert tokens == "了解，\"蛋鸡\"出现咳嗽。\n请问日龄？"
+    deltas = [e["collected_info"] for e in events if e["type"] == "info_delta"]
+    assert deltas == [{"poultry_type": "蛋鸡"}, {"symptoms": ["咳嗽"]}]
+    # 字段增量先于 stream_end 到达
+    assert events[-1]["type"] == "stream_end"
+    assert events[-1]["collected_info"]["poultry_type"] == "蛋鸡"
+
+
+@pytest.mark.asyncio
+async def test_summary_trigger_uses_counter_and_watermark(
+    db_session: AsyncSession, vet_user: User, ai_model: AIModel
+):
+    """测试摘要按消息计数触发，只读取水位之后的新消息，失败时不推进水位"""
+    from datetime import datetime, timedelta, timezone
+
+    from app.models.conversation import Conversation, ConversationMessage
+    from app.services import summary_service
+
+    conversation = Conversation(user_id=vet_user.id, status="active", state="collecting_basic")
+    db_session.add(conversation)
+    await db_session.flush()
+
+    base = datetime(2026, 2, 13, 8, 0, tzinfo=timezone.utc)
+
+    def _add(i: int, role: str, content: str):
+        db_session.add(ConversationMessage(
+            conversation_id=conversation.id, role=role, content=content,
+            created_at=base + timedelta(minutes=i),
+        ))
+        conversation.message_count += 1
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(side_effect=[
+        ChatResponse(content="摘要一"),
+        RuntimeError("upstream down"),
+        ChatResponse(content="摘要二"),
+    ])
+
+    with patch(
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
+    ):
+        _add(0, "user", "第一轮：蛋鸡咳嗽")
+        _add(1, "assistant", "请问日龄？")
+        await db_session.flush()
+        # 未达到触发阈值，不调用 LLM
+        assert await summary_service.update_summary_if_needed(db_session, conversation.id) is None
+        assert mock_adapter.chat_completion.await_count == 0
+
+        _add(2, "user", "45日龄")
+        _add(3, "assistant", "还有其他症状吗？")
+        await db_session.flush()
+        assert await summary_service.update_summary_if_needed(db_session, conversation.id) == "摘要一"
+        assert conversation.summary_message_count == 4
+
+        for i, text in enumerate(["第三轮：流鼻涕", "好的", "第四轮：已用药", "记录了"], start=4):
+            _add(i, "user" if i % 2 == 0 else "assistant", text)
+        await db_session.flush()
+        # 摘要失败：保留已有摘要，水位不动
+        watermark = conversation.summarized_until
+        assert await summary_service.update_summary_if_needed(db_session, conversation.id) == "摘要一"
+        assert conversation.summary_message_count == 4
+        assert conversation.summarized_until == watermark
+        # 下次重试仍覆盖这批消息
+        assert await summary_service.update_summary_if_needed(db_session, conversation.id) == "摘要二"
+
+    second_prompt = mock_adapter.chat_completion.await_args_list[2].args[0][0].content
+    assert "摘要一" in second_prompt
+    assert "第三轮" in second_prompt
+    assert "第一轮" not in second_prompt
+    assert conversation.summary_message_count == 8
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_token_budget(
+    db_session: AsyncSession, vet_user: User, ai_model: AIModel
+):
+    """测试滚动摘要：积压按时间正序在 token 预算内截取，水位停在最后纳入的消息，下次继续"""
+    from datetime import datetime, timedelta, timezone
+
+    from app.models.conversation import Conversation, ConversationMessage
+    from app.services import conversation_service, summary_service
+    from app.utils.token_utils import count_tokens
+
+    conversation = Conversation(
+        user_id=vet_user.id, status="active", state="collecting_symptoms",
+        summary="蛋鸡，咳嗽", message_count=30, summary_message_count=26,
+    )
+    db_session.add(conversation)
+    await db_session.flush()
+    base = datetime(2026, 2, 13, 8, 0, tzinfo=timezone.utc)
+    for i in range(4):
+        db_session.add(ConversationMessage(
+            conversation_id=conversation.id, role="user" if i % 2 == 0 else "assistant",
+            content=f"第{i}条" + "很长的描述" * 200,
+            created_at=base + timedelta(minutes=i),
+        ))
+    await db_session.flush()
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(return_value=ChatResponse(content="新摘要" * 500))
+
+    with patch.object(summary_service.settings, "SUMMARY_INPUT_TOKEN_BUDGET", 800), \
+            patch.object(summary_service.settings, "SUMMARY_TOKEN_BUDGET", 100), \
+            patch("app.adapters.router.LLMAdapterFactory.get_adapter",
+                  return_value=mock_adapter):
+        summary = await summary_service.update_summary_if_needed(db_session, conversation.id)
+
+    prompt = mock_adapter.chat_completion.await_args.args[0][0].content
+    assert "蛋鸡，咳嗽" in prompt
+    new_messages = prompt.split("新增对话内容：\n")[1].split("\n\n已收集信息")[0]
+    assert 0 < count_tokens(new_messages) <= 800
+    # 最早的未摘要消息优先，超出预算的留待下次
+    assert "第0条" in new_messages and "第3条" not in new_messages
+    assert count_tokens(summary) <= 100
+    assert conversation.summarized_until.replace(tzinfo=timezone.utc) == base
+    assert conversation.summary_message_count == 27
+
+    # 下次从水位继续，不跳过较早的积压
+    with patch.object(summary_service.settings, "SUMMARY_INPUT_TOKEN_BUDGET", 800), \
+            patch("app.adapters.router.LLMAdapterFactory.get_adapter",
+                  return_value=mock_adapter):
+        await summary_service.update_summary_if_needed(db_session, conversation.id, force=True)
+    prompt = mock_adapter.chat_completion.await_args.args[0][0].content
+    assert "第1条" in prompt and "第0条" not in prompt
+    assert conversation.summary_message_count == 28
+
+    # 有摘要且无积压时，prompt 只带最近 MAX_HISTORY_MESSAGES 条原文
+    assert conversation_service._history_limit(conversation) == conversation_service.MAX_HISTORY_MESSAGES
+    conversation.summary = None
+    assert conversation_service._history_limit(conversation) == conversation_service.HISTORY_MESSAGES_CAP
+
+
+def test_prompt_assembler_trims_by_priority():
+    """测试 prompt 组装：各部分先按自身上限裁剪，总量超出时从低优先级开始压缩"""
+    from app.adapters.base import ChatMessage
+    from app.utils.prompt_assembler import PromptAssembler
+
+    assembler = PromptAssembler(total_budget=320)
+    assembler.add("system", "s" * 100, priority=0, cacheable=True)
+    assembler.add("memory", "m" * 80, priority=4, budget=50)
+    assembler.add("similar_cases", "c" * 100, priority=5)
+    assembler.add("state", "t" * 40, priority=1)
+    assembler.add_history(
+        "history", [ChatMessage(role="user", content="h" * 30) for _ in range(4)], priority=3,
+    )
+    messages, report = assembler.build()
+
+    assert report["memory"] == 50  # 自身上限
+    assert report["system"] == 100  # 优先级 0 不裁剪
+    assert report["state"] == 40
+    assert report["similar_cases"] == 10  # 最低优先级最先被压缩，刚好落入总预算
+    assert report["total"] <= 320
+    assert "similar_cases" in report["trimmed"]
+    # 静态 system prompt 原样在前且标记为可缓存，动态内容单独成条
+    assert messages[0].content == "s" * 100 and messages[0].cacheable
+    assert messages[1].content == "m" * 50 and not messages[1].cacheable
+    assert report["history"] == 120 and len(messages) == 1 + 1 + 1 + 1 + 4
+
+
+def test_prompt_templates_select_examples_by_state():
+    """测试 prompt 模板：v2 按阶段只带一个示例，v1 保留全部示例，未知版本回退默认"""
+    from app.services.prompt_templates import (
+        DEFAULT_VERSION,
+        PROMPT_TEMPLATES,
+        get_template,
+        render_system_prompt,
+    )
+
+    v1, v2 = PROMPT_TEMPLATES["v1"], PROMPT_TEMPLATES["v2"]
+    assert len(v1.examples_for("collecting_symptoms", structured=False)) == 4
+    assert v2.examples_for("collecting_symptoms", structured=False) == [v2.json_examples["ambiguous"]]
+    assert v2.examples_for("confirming", structured=True) == [v2.tool_examples["confirm"]]
+
+    for state in ("collecting_basic", "collecting_diagnosis", "confirming"):
+        for structured in (False, True):
+            compact = render_system_prompt(state, structured, "v2")
+            assert len(compact) < len(render_system_prompt(state, structured, "v1"))
+            # 同一阶段渲染结果不变，可作为缓存前缀
+            assert render_system_prompt(state, structured, "v2") is compact
+
+    assert "extract_medical_info" in render_system_prompt("collecting_basic", True, "v2")
+    assert get_template("v9").version == DEFAULT_VERSION
+
+
+@pytest.mark.asyncio
+async def test_prompt_report_logged_to_usage(
+    client: AsyncClient, db_session: AsyncSession, vet_user: User, ai_model: AIModel
+):
+    """测试每轮 prompt 的 token 分布写入使用日志"""
+    from sqlalchemy import select
+
+    from app.models.ai_model import AIUsageLog
+    from app.services.usage_log_writer import usage_log_writer
+
+    token = _make_token(vet_user)
+    create_resp = await client.post(
+        "/api/v1/conversations", json={}, headers={"Authorization": f"Bearer {token}"},
+    )
+    conv_id = create_resp.json()["id"]
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(
+        return_value=_mock_llm_response(extracted_info={"poultry_type": "蛋鸡"})
+    )
+    with patch(
+        "app.adapters.router.LLMAdapterFactory.get_adapter",
+        return_value=mock_adapter,
+    ):
+        resp = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "蛋鸡咳嗽"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    assert resp.status_code == 200
+
+    await usage_log_writer.flush()
+    log = (await db_session.execute(select(AIUsageLog))).scalar_one()
+    detail = log.prompt_tokens_detail
+    assert detail["system"] > 0 and detail["history"] > 0
+    assert detail["total"] == sum(
+        v for k, v in detail.items() if k not in ("total", "budget", "trimmed")
+    )
+    # 状态以紧凑 JSON 注入
+    messages = mock_adapter.chat_completion.await_args.args[0]
+    assert not any("```json" in m.content for m in messages[1:])
+
+
+@pytest.mark.asyncio
+async def test_hedged_loser_logged_as_cancelled(
+    client: AsyncClient, db_session: AsyncSession, vet_user: User,
+    master_user: User, ai_model: AIModel,
+):
+    """测试对冲落败被取消的调用以 cancelled 状态按 prompt 估算记录用量"""
+    import asyncio
+
+    from sqlalchemy import select
+
+    from app.adapters import router as router_module
+    from app.models.ai_model import AIUsageLog
+    from app.services.usage_log_writer import usage_log_writer
+
+    backup = AIModel(
+        provider="openai", model_name="gpt-4o-mini", display_name="Backup",
+        api_key_encrypted=encrypt_api_key("test-key"), is_active=True,
+        created_by=master_user.id,
+    )
+    db_session.add(backup)
+    await db_session.commit()
+
+    async def _slow(messages, **kwargs):
+        await asyncio.sleep(5)
+        return _mock_llm_response()
+
+    primary_adapter, backup_adapter = AsyncMock(), AsyncMock()
+    primary_adapter.chat_completion = AsyncMock(side_effect=_slow)
+    primary_adapter.calculate_cost = MagicMock(return_value=0.002)
+    backup_adapter.chat_completion = AsyncMock(return_value=_mock_llm_response())
+    adapters = {ai_model.id: primary_adapter, backup.id: backup_adapter}
+
+    token = _make_token(vet_user)
+    conv_id = (await client.post(
+        "/api/v1/conversations", json={}, headers={"Authorization": f"Bearer {token}"},
+    )).json()["id"]
+    with patch("app.adapters.router.LLMAdapterFactory.get_adapter",
+               side_effect=lambda m: adapters[m.id]), \
+            patch.object(router_module.settings, "LLM_HEDGING", True), \
+            patch.object(router_module.settings, "LLM_HEDGE_DELAY", 0.05), \
+            patch.object(router_module, "HEDGE_MIN_DELAY", 0.05):
+        resp = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "蛋鸡咳嗽"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    assert resp.status_code == 200
+
+    await usage_log_writer.flush()
+    logs = {log.status: log for log in (await db_session.execute(select(AIUsageLog))).scalars()}
+    assert set(logs) == {"success", "cancelled"}
+    cancelled = logs["cancelled"]
+    assert cancelled.model_id == ai_model.id and logs["success"].model_id == backup.id
+    assert cancelled.request_tokens == cancelled.prompt_tokens_detail["total"] > 0
+    assert float(cancelled.cost) == pytest.approx(0.002)
+
+
+class _FakeWebSocket:
+    """记录发出的帧；block 为 Event 时发送阻塞直到其被设置（模拟弱网客户端）"""
+
+    def __init__(self, block=None):
+        self.frames: list[str] = []
+        self.block = block
+        self.closed_with = None
+
+    async def send_text(self, frame: str) -> None:
+        if self.block is not None:
+            await self.block.wait()
+        self.frames.append(frame)
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+async def test_ws_connection_coalesces_tokens_and_keeps_order():
+    """WebSocket 发送：token 按间隔合并成帧，其他事件排在已缓冲 token 之后"""
+    import asyncio
+
+    from app.core.ws_manager import WSConnection
+
+    ws = _FakeWebSocket()
+    conn = WSConnection(ws, "conv", max_queue=8, flush_interval=0.02, send_timeout=1)
+    conn.start()
+    for ch in "逐字输出的回复":
+        conn.send_token(ch)
+    await asyncio.sleep(0.05)
+    conn.send_token("，继续")
+    await conn.send_json({"type": "stream_end", "content": "完"})
+    await conn.drain()
+    await conn.close()
+
+    events = [json.loads(f) for f in ws.frames]
+    assert events == [
+        {"type": "stream_token", "content": "逐字输出的回复"},
+        {"type": "stream_token", "content": "，继续"},
+        {"type": "stream_end", "content": "完"},
+    ]
+    assert conn.stats["tokens"] == 8 and conn.stats["token_frames"] == 2
+
+
+@pytest.mark.asyncio
+async def test_ws_connection_slow_client_and_disconnect_cancel_turn():
+    """发送队列满且超时判定客户端过慢；断开连接时取消进行中的轮次并关闭上游流"""
+    import asyncio
+    from contextlib import aclosing
+
+    from app.core.ws_manager import ConnectionClosed, ConnectionManager, WSConnection
+
+    ws = _FakeWebSocket(block=asyncio.Event())
+    conn = WSConnection(ws, "slow", max_queue=2, flush_interval=0.01, send_timeout=0.05)
+    conn.start()
+    with pytest.raises(ConnectionClosed):
+        for i in range(10):
+            await conn.send_json({"type": "info_delta", "i": i})
+    assert conn.closed and ws.closed_with == 1013
+
+    manager = ConnectionManager()
+    conn = manager.connect(_FakeWebSocket(), "conv")
+    upstream_closed = asyncio.Event()
+
+    async def _upstream():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "tok"
+        finally:
+            upstream_closed.set()
+
+    async def _turn():
+        async with aclosing(_upstream()) as stream:
+            async for token in stream:
+                conn.send_token(token)
+
+    conn.run_turn(_turn())
+    await asyncio.sleep(0.05)
+    assert conn.busy
+    await manager.disconnect(conn)
+    assert upstream_closed.is_set() and not conn.busy
+    assert manager.stats()["connections"] == 0
+
+
+@pytest.mark.asyncio
+async def test_event_bus_fans_out_turn_to_other_connections():
+    """对话事件总线：一轮回复推送给观察同一对话的其他连接，发起方与其他对话不重复收到"""
+    import asyncio
+
+    from app.core.event_bus import TurnPublisher, event_bus
+    from app.core.ws_manager import ws_manager
+
+    origin = ws_manager.connect(_FakeWebSocket(), "conv-a")
+    observer_ws, other_ws = _FakeWebSocket(), _FakeWebSocket()
+    observer = ws_manager.connect(observer_ws, "conv-a")
+    other = ws_manager.connect(other_ws, "conv-b")
+    for conn in (origin, observer, other):
+        await event_bus.join(conn)
+    try:
+        publisher = TurnPublisher(event_bus, "conv-a", origin=origin.id, flush_interval=0)
+        publisher.event({"type": "user_message", "content": "蛋鸡咳嗽"})
+        for token in ("了解", "，", "请问日龄？"):
+            publisher.token(token)
+        publisher.event({"type": "stream_end", "content": "了解，请问日龄？"})
+
+        for _ in range(200):
+            if any('"stream_end"' in f for f in observer_ws.frames):
+                break
+            await asyncio.sleep(0.01)
+        events = [json.loads(f) for f in observer_ws.frames]
+        assert events[0] == {"type": "user_message", "content": "蛋鸡咳嗽"}
+        assert "".join(e["content"] for e in events if e["type"] == "stream_token") == "了解，请问日龄？"
+        assert events[-1]["type"] == "stream_end"
+        assert origin.websocket.frames == [] and other_ws.frames == []
+    finally:
+        for conn in (origin, observer, other):
+            await event_bus.leave(conn)
+            await ws_manager.disconnect(conn)
+        await event_bus.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_bus_retries_subscription_and_never_blocks_publisher(redis_backend):
+    """对话事件总线：订阅失败后由监听任务重试；Redis 发布卡住时发布方不等待，队列满则只投递本 worker"""
+    import asyncio
+
+    from app.core import event_bus as bus_module
+    from app.core.event_bus import ConversationEventBus, TurnPublisher
+    from app.core.ws_manager import ws_manager
+
+    bus = ConversationEventBus()
+    observer_ws = _FakeWebSocket()
+    observer = ws_manager.connect(observer_ws, "conv-r")
+    real_pubsub = redis_backend.pubsub
+    calls = {"n": 0}
+
+    def _flaky_pubsub(**kwargs):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise ConnectionError("redis down")
+        return real_pubsub(**kwargs)
+
+    try:
+        with patch.object(redis_backend, "pubsub", side_effect=_flaky_pubsub):
+            await bus.join(observer)
+            assert bus.stats["subscribe_errors"] == 1
+            for _ in range(300):
+                if "conv:conv-r:events" in bus._subscribed:
+                    break
+                await asyncio.sleep(0.01)
+        assert "conv:conv-r:events" in bus._subscribed
+
+        # 订阅恢复后收到其他 worker 发布的事件
+        await redis_backend.publish(
+            "conv:conv-r:events", json.dumps({"origin": None, "event": {"type": "ping"}})
+        )
+        for _ in range(300):
+            if observer_ws.frames:
+                break
+            await asyncio.sleep(0.01)
+        assert json.loads(observer_ws.frames[0]) == {"type": "ping"}
+
+        # 发布卡住：token 循环不等待，队列满的事件直接投递本 worker
+        stalled = asyncio.Event()
+
+        async def _stuck_publish(*args):
+            await stalled.wait()
+
+        observer_ws.frames.clear()
+        with patch.object(redis_backend, "publish", side_effect=_stuck_publish), \
+                patch.object(bus_module.settings, "EVENT_BUS_QUEUE_SIZE", 1), \
+                patch.object(bus_module.settings, "EVENT_BUS_PUBLISH_TIMEOUT", 5.0):
+            publisher = TurnPublisher(bus, "conv-r", origin="other-conn", flush_interval=0)
+            for token in ("a", "b", "c"):
+                publisher.token(token)
+            await asyncio.sleep(0)
+            assert bus.stats["dropped"] >= 1
+            stalled.set()
+    finally:
+        await bus.leave(observer)
+        await ws_manager.disconnect(observer)
+        await bus.stop()
+
+
+@pytest.mark.asyncio
+async def test_send_message_structured_output_and_fallback(
+    client: AsyncClient, vet_user: User, master_user: User, ai_model: AIModel
+):
+    """函数调用模式：提取结果取自 extract_medical_info 参数，完整度本地计算；参数损坏时退回文本解析并计入统计"""
+    from app.adapters.base import ToolCall
+    from app.services.conversation_service import EXTRACTION_TOOLS
+    from app.services.prompt_templates import render_system_prompt
+
+    headers = {"Authorization": f"Bearer {_make_token(vet_user)}"}
+    conv_id = (await client.post("/api/v1/conversations", json={}, headers=headers)).json()["id"]
+
+    mock_adapter = AsyncMock()
+    mock_adapter.chat_completion = AsyncMock(side_effect=[
+        ChatResponse(
+            content="了解，45日龄蛋鸡出现打喷嚏。请问什么时候开始的？",
+            tool_calls=[ToolCall("extract_medical_info", {
+                "poultry_type": "鸡", "breed": "蛋鸡", "age_days": 45, "symptoms": ["打喷嚏"],
+                "confidence_scores": {"breed": 0.9}, "needs_confirmation": ["breed"],
+                "suggested_state": "collecting_symptoms",
+            })],
+        ),
+        # 参数不是合法 JSON，且文本也不是 JSON 信封
+        ChatResponse(
+            content="好的，三天前开始。",
+            tool_calls=[ToolCall.from_json("extract_medical_info", '{"onset_date": ')],
+        ),
+    ])
+
+    with patch("app.adapters.router.LLMAdapterFactory.get_adapter", return_value=mock_adapter):
+        first = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "45日龄蛋鸡打喷嚏"}, headers=headers,
+        )
+        second = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages",
+            json={"content": "三天前开始的"}, headers=headers,
+        )
+
+    assert first.status_code == 200
+    data = first.json()
+    assert data["message"]["content"].startswith("了解")
+    assert data["collected_info"] == {
+        "poultry_type": "鸡", "breed": "蛋鸡", "age_days": 45, "symptoms": ["打喷嚏"],
+    }
+    assert data["confidence_scores"] == {"breed": 0.9}
+    assert data["needs_confirmation"] == ["breed"]
+    assert data["completeness"]["breed"] is True and data["completeness"]["onset_date"] is False
+
+    call = mock_adapter.chat_completion.await_args_list[0]
+    assert call.kwargs["tools"] == EXTRACTION_TOOLS
+    assert call.args[0][0].content == render_system_prompt("initializing", structured=True)
+
+    assert second.status_code == 200
+    assert second.json()["message"]["content"] == "好的，三天前开始。"
+    assert "onset_date" not in second.json()["collected_info"]
+
+    master_token = _make_token(master_user)
+    stats = (await client.get(
+        "/api/v1/ai-models/extraction-stats",
+        headers={"Authorization": f"Bearer {master_token}"},
+    )).json()
+    assert stats == [{
+        "model_id": str(ai_model.id), "model_name": ai_model.model_name, "mode": "tools",
+        "turns": 2, "tool_calls": 1, "fallbacks": 0, "failures": 1, "failure_rate": 0.5,
+    }]
+
+
+@pytest.mark.asyncio
+async def test_stub_adapter_drives_conversation_without_provider(
+    client: AsyncClient, db_session: AsyncSession, vet_user: User, master_user: User
+):
+    """测试 stub 模型：不打桩即可走完对话链路，输出确定，可注入失败"""
+    from app.adapters.base import ChatMessage
+    from app.adapters.factory import LLMAdapterFactory
+    from app.adapters.stub_adapter import STUB_SCRIPT, StubAdapterError
+
+    db_session.add(AIModel(
+        provider="stub", model_name="stub-load", display_name="Stub",
+        api_key_encrypted=encrypt_api_key("stub"), is_active=True, is_default=True,
+        config={"latency_ms": 0, "tokens_per_second": 0}, created_by=master_user.id,
+    ))
+    await db_session.commit()
+
+    headers = {"Authorization": f"Bearer {_make_token(vet_user)}"}
+    conv_id = (await client.post("/api/v1/conversations", json={}, headers=headers)).json()["id"]
+    for content in ("一批45日龄蛋鸡", "打喷嚏、流鼻涕"):
+        resp = await client.post(
+            f"/api/v1/conversations/{conv_id}/messages", json={"content": content}, headers=headers,
+        )
+        assert resp.status_code == 200
+    assert resp.json()["collected_info"] == {**STUB_SCRIPT[0][0], **STUB_SCRIPT[1][0]}
+    assert resp.json()["message"]["content"].startswith("（模拟回复）第2轮")
+
+    # JSON 信封模式的流式输出与同步输出一致
+    adapter = LLMAdapterFactory.create_adapter(
+        "stub", "stub", "stub-load", config={"latency_ms": 0, "tokens_per_second": 0},
+    )
+    messages = [ChatMessage(role="user", content="一批45日龄蛋鸡")]
+    streamed = "".join([t async for t in adapter.chat_completion_stream(messages)])
+    assert streamed == (await adapter.chat_completion(messages)).content
+    assert json.loads(streamed)["extracted_info"] == STUB_SCRIPT[0][0]
+
+    failing = LLMAdapterFactory.create_adapter(
+        "stub", "stub", "stub-fail", config={"latency_ms": 0, "failure_rate": 1},
+    )
+    with pytest.raises(StubAdapterError):
+        await failing.chat_completion(messages)
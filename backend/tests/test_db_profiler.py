@@ -0,0 +1,74 @@
+"""SQL 查询分析测试"""
+
+import logging
+import re
+import uuid
+from unittest.mock import patch
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import db_profiler
+from app.core.db_profiler import fingerprint, log_profile, profile_queries
+from app.core.security import create_access_token
+from app.models.user import User
+from tests.conftest import assert_max_queries
+
+SERVER_TIMING = re.compile(r'^db;dur=[\d.]+;desc="(\d+) queries", app;dur=[\d.]+$')
+
+
+def test_fingerprint_ignores_bound_parameter_layout():
+    """测试语句指纹：空白、IN 列表长度与多行 VALUES 不影响指纹"""
+    base = fingerprint("SELECT a FROM t WHERE id IN (?)")
+    assert fingerprint("SELECT a\n  FROM t WHERE id IN (?, ?, ?)") == base
+    assert fingerprint("SELECT a FROM t WHERE id IN ($1, $2)") == base
+    assert fingerprint("SELECT a FROM t WHERE id = ?") != base
+    assert fingerprint("INSERT INTO t (a, b) VALUES (?, ?), (?, ?)") == fingerprint(
+        "INSERT INTO t (a, b) VALUES (?, ?)"
+    )
+
+
+@pytest.mark.asyncio
+async def test_endpoint_query_budgets_and_server_timing(client: AsyncClient, vet_user: User):
+    """测试常用列表 / 详情端点的查询预算，响应带 Server-Timing"""
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': str(vet_user.id)})}"}
+    conv_id = (await client.post("/api/v1/conversations", json={}, headers=headers)).json()["id"]
+
+    budgets = {
+        "/api/v1/conversations": 2,
+        f"/api/v1/conversations/{conv_id}": 1,
+        f"/api/v1/conversations/{conv_id}/messages": 3,
+        "/api/v1/reminders": 2,
+        "/api/v1/records": 2,
+    }
+    for url, limit in budgets.items():
+        with assert_max_queries(limit) as profile:
+            resp = await client.get(url, headers=headers)
+        assert resp.status_code == 200
+        timing = SERVER_TIMING.match(resp.headers["Server-Timing"])
+        assert timing and int(timing.group(1)) == profile.count
+
+
+@pytest.mark.asyncio
+async def test_slow_and_repeated_statements_logged(db_session: AsyncSession, caplog):
+    """测试慢查询按指纹记录参数类型，同一语句反复执行标记为疑似 N+1"""
+    caplog.set_level(logging.DEBUG, logger=db_profiler.__name__)
+    with patch.object(db_profiler.settings, "SLOW_QUERY_MS", 0), profile_queries() as profile:
+        for _ in range(12):
+            await db_session.execute(select(User).where(User.id == uuid.uuid4()))
+
+    fp, count = profile.repeated()[0]
+    assert count == 12 and profile.count == 12
+    assert len(profile.slow) == 12 and {s.fingerprint for s in profile.slow} == {fp}
+    slow_lines = [r.getMessage() for r in caplog.records if r.getMessage().startswith("慢查询")]
+    assert len(slow_lines) == 12
+    assert f"fingerprint={fp}" in slow_lines[0] and "params=(" in slow_lines[0]
+
+    caplog.clear()
+    log_profile(profile, 5.0, method="GET", path="/api/v1/example")
+    (record,) = caplog.records
+    assert record.levelno == logging.WARNING
+    assert f"n_plus_one={fp}×12" in record.getMessage()
+    assert "path=/api/v1/example" in record.getMessage()
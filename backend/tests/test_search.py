@@ -1,3 +1,6 @@
+import uuid
+from unittest.mock import AsyncMock, MagicMock, patch
+
 import pytest
 from httpx import AsyncClient
 
@@ -105,3 +108,28 @@ async def test_search_requires_keyword(client: AsyncClient, vet_user: User):
         headers={"Authorization": f"Bearer {token}"},
     )
     assert response.status_code == 422  # Missing required param
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache():
+    """相同查询文本（空白差异归一化）只调用一次 embedding 接口"""
+    from app.services import embedding_service
+
+    adapter = MagicMock()
+    adapter.model_name = "text-embedding-v1"
+    adapter.dimensions = 4
+    adapter.embed_text = AsyncMock(return_value=[0.1, 0.2, 0.3, 0.4])
+    query = f"禽类: 鸡\n症状: 咳嗽 {uuid.uuid4()}"
+
+    before = embedding_service.get_query_cache_stats()
+    with patch.object(embedding_service, "_get_adapter", return_value=adapter):
+        first = await embedding_service.embed_query(query)
+        second = await embedding_service.embed_query(query.replace("\n", "  "))
+
+    assert adapter.embed_text.await_count == 1
+    assert second == pytest.approx(first, rel=1e-6)
+    assert first == pytest.approx([0.1, 0.2, 0.3, 0.4], rel=1e-6)
+
+    after = embedding_service.get_query_cache_stats()
+    assert after["misses"] == before["misses"] + 1
+    assert after["local_hits"] == before["local_hits"] + 1
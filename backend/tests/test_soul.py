@@ -7,7 +7,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.security import create_access_token
 from app.models.soul import MemoryEntry, SoulConfig
 from app.models.user import User
-from app.utils.token_utils import compress_markdown, count_tokens, select_memories
+from app.utils.token_utils import compress_markdown, count_tokens, select_memories, truncate_tokens
 
 
 # ── Token 工具测试 ──
@@ -20,6 +20,15 @@ class TestTokenUtils:
         tokens = count_tokens("Hello, world!")
         assert tokens > 0
 
+    def test_truncate_tokens_keeps_whole_characters(self):
+        """中文截断不出现半个字符，结果不超出预算"""
+        text = "鸡群出现呼吸道症状，疑似传染性支气管炎，建议剖检气管并送检。" * 5
+        for budget in range(1, 40):
+            result = truncate_tokens(text, budget)
+            assert count_tokens(result) <= budget
+            assert "\ufffd" not in result
+            assert text.startswith(result)
+
     def test_compress_markdown_within_budget(self):
         """原文在预算内，不压缩"""
         content = "# Title\n\nShort content."
@@ -0,0 +1,143 @@
+"""后台任务队列测试"""
+
+import asyncio
+import time
+import uuid
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.tasks import (
+    InProcessTaskQueue,
+    Job,
+    RedisTaskQueue,
+    enqueue_after_commit,
+    task,
+    task_queue,
+)
+from tests.conftest import TestSessionLocal
+
+
+@pytest.mark.asyncio
+async def test_tasks_dispatched_only_after_commit(db_session: AsyncSession):
+    """任务在事务提交后才投递，回滚则丢弃；处理函数拿到独立会话"""
+    calls = []
+
+    @task("test.record_call")
+    async def _record_call(db, value: str):
+        calls.append((value, db is not db_session))
+
+    await db_session.execute(text("SELECT 1"))
+    enqueue_after_commit(db_session, "test.record_call", value="rolled-back")
+    await db_session.rollback()
+
+    await db_session.execute(text("SELECT 1"))
+    enqueue_after_commit(db_session, "test.record_call", value="committed")
+    assert calls == []
+
+    await db_session.commit()
+    await task_queue.join(timeout=5)
+    assert calls == [("committed", True)]
+
+
+@pytest.mark.asyncio
+async def test_tasks_survive_savepoint_rollback(db_session: AsyncSession):
+    """保存点释放不提前投递；保存点回滚只丢弃其中登记的任务"""
+    calls = []
+
+    @task("test.savepoint_call")
+    async def _record_call(db, value: str):
+        calls.append(value)
+
+    await db_session.execute(text("SELECT 1"))
+    enqueue_after_commit(db_session, "test.savepoint_call", value="outer")
+    async with db_session.begin_nested():
+        enqueue_after_commit(db_session, "test.savepoint_call", value="released")
+    with pytest.raises(RuntimeError):
+        async with db_session.begin_nested():
+            enqueue_after_commit(db_session, "test.savepoint_call", value="rolled-back")
+            raise RuntimeError("冲突重试")
+    await task_queue.join(timeout=5)
+    assert calls == []
+
+    await db_session.commit()
+    await task_queue.join(timeout=5)
+    assert sorted(calls) == ["outer", "released"]
+
+
+@pytest.mark.asyncio
+async def test_task_retry_with_backoff():
+    """处理失败按退避重试，超过重试次数后放弃"""
+    queue = InProcessTaskQueue(
+        workers=2, max_retries=2, retry_base_delay=0.01,
+        session_factory=TestSessionLocal,
+    )
+    attempts = {"flaky": 0, "broken": 0}
+
+    @task("test.flaky")
+    async def _flaky(db):
+        attempts["flaky"] += 1
+        if attempts["flaky"] < 2:
+            raise RuntimeError("temporary")
+
+    @task("test.broken")
+    async def _broken(db):
+        attempts["broken"] += 1
+        raise RuntimeError("permanent")
+
+    queue.submit(Job(name="test.flaky"))
+    queue.submit(Job(name="test.broken"))
+    await queue.join(timeout=5)
+    await queue.stop()
+
+    assert attempts == {"flaky": 2, "broken": 3}
+    assert queue.stats["completed"] == 1
+    assert queue.stats["failed"] == 1
+    assert queue.stats["retried"] == 3
+
+
+@pytest.mark.asyncio
+async def test_redis_queue_acknowledges_and_recovers_interrupted_jobs(redis_backend):
+    """Redis 队列：处理完才确认；心跳超时 worker 的任务被恢复，停止时未完成的任务归还队列"""
+    queue = RedisTaskQueue(
+        workers=1, session_factory=TestSessionLocal, queue_key=f"test:tasks:{uuid.uuid4().hex}",
+    )
+    done = []
+    release = asyncio.Event()
+
+    @task("test.recovered")
+    async def _recovered(db):
+        done.append("recovered")
+
+    @task("test.hanging")
+    async def _hanging(db):
+        await release.wait()
+
+    # 已崩溃的进程：任务留在其处理中列表，心跳早已过期
+    dead = "dead-host:1:0000:0"
+    await redis_backend.lpush(queue.processing_key(dead), Job(name="test.recovered").dumps())
+    await redis_backend.zadd(queue.workers_key, {dead: time.time() - 3600})
+
+    queue.start()
+    processing = queue.processing_key(queue.worker_ids[0])
+    for _ in range(100):
+        if done and not await redis_backend.llen(processing):
+            break
+        await asyncio.sleep(0.05)
+    assert done == ["recovered"]
+    assert queue.stats["recovered"] == 1
+    assert await redis_backend.llen(queue.processing_key(dead)) == 0
+    assert await redis_backend.llen(processing) == 0
+
+    # 处理中被停止（如部署）：任务不丢失，回到队列
+    queue.submit(Job(name="test.hanging"))
+    for _ in range(100):
+        if await redis_backend.llen(processing):
+            break
+        await asyncio.sleep(0.05)
+    assert await redis_backend.llen(processing) == 1
+    await queue.stop(timeout=0.1)
+    assert await redis_backend.llen(processing) == 0
+    assert Job.loads(await redis_backend.rpop(queue.queue_key)).name == "test.hanging"
+    release.set()